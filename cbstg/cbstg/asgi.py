@@ -7,10 +7,37 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cbstg.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from cbstg_app.consumers import live_transcription  # noqa: E402 (needs configured apps)
+
+websocket_routes = {
+    "/ws/live/": live_transcription,
+}
+
+# Django runs every sync view in a thread of its own, WEB_THREADS bounds how
+# many run at once (what gunicorn's --threads did under WSGI), later requests
+# wait for a free slot. WebSocket sessions are not counted.
+http_slots = asyncio.Semaphore(settings.WEB_THREADS)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        consumer = websocket_routes.get(scope["path"])
+        if consumer is None:
+            await receive()
+            await send({"type": "websocket.close"})
+            return
+        return await consumer(scope, receive, send)
+    if scope["type"] == "http":
+        async with http_slots:
+            return await django_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'cbstg_app.middleware.PrecompressedStaticMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,6 +84,20 @@ DATABASES = {
 }
 
 
+# RoleModelBackend loads the user's role together with the user. ModelBackend stays
+# listed so sessions created before it was introduced remain valid.
+AUTHENTICATION_BACKENDS = [
+    'cbstg_app.backends.RoleModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# Uploads are hashed while they stream in, for content-addressed storage (blobs.py)
+FILE_UPLOAD_HANDLERS = [
+    'cbstg_app.blobs.HashingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -152,6 +167,9 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
 
+# Serve collected files from STATIC_ROOT in-process (no static bucket)
+SERVE_STATIC_FROM_APP = False
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -2,49 +2,149 @@ import io
 from urllib.parse import urlparse
 
 import environ
-import google.auth
-import requests
-from google.cloud.run_v2.services.services.client import ServicesClient
-from google.oauth2 import service_account
+from django.core.exceptions import ImproperlyConfigured
 
 from .basesettings import *
+from .startup import SETTINGS_TIMINGS, default_project_id, deployment_values, timed
 import local_secrets
 
 AUTH_USER_MODEL = 'cbstg_app.CustomUser'
 
 env = environ.Env()
-if env("APPLICATION_SETTINGS", default=None):
-    env.read_env(io.StringIO(os.environ.get("APPLICATION_SETTINGS", None)))
-else:
-    env_file = BASE_DIR / ".env"
-    env.read_env(env_file)
+with timed("environment"):
+    if env("APPLICATION_SETTINGS", default=None):
+        env.read_env(io.StringIO(os.environ.get("APPLICATION_SETTINGS", None)))
+    else:
+        env_file = BASE_DIR / ".env"
+        env.read_env(env_file)
 
 SECRET_KEY = env("SECRET_KEY")
 DEBUG = env("DEBUG", default=False)
 DATABASES = {"default": env.db()}
 SERVICE_NAME = env("SERVICE_NAME", default=None)
 
-try:
-    _, PROJECT_ID = google.auth.default()
-except google.auth.exceptions.DefaultCredentialsError:
-    PROJECT_ID = env("PROJECT_ID", default=None)
+# HTTP requests served at once per server process (asgi.py), each in a thread
+# of its own; sizes the database connection pool
+WEB_THREADS = env.int("WEB_THREADS", default=8)
 
-try:
-    response = requests.get(
-        "http://metadata.google.internal/computeMetadata/v1/instance/region",
-        headers={"Metadata-Flavor": "Google"},
-    )
-    REGION = response.text.split("/")[-1]
-except requests.exceptions.ConnectionError:
-    REGION = None
-
-if all((PROJECT_ID, REGION, SERVICE_NAME)):
-    service_path = f"projects/{PROJECT_ID}/locations/{REGION}/services/{SERVICE_NAME}"
-    client = ServicesClient()
-    service_uri = client.get_service(name=service_path).uri
-    ALLOWED_HOSTS = [urlparse(service_uri).netloc]
-    CSRF_TRUSTED_ORIGINS = [service_uri]
+# Under ASGI every request runs its sync view in a thread of its own, connections
+# kept by those threads (CONN_MAX_AGE > 0) are never reused and pile up. PostgreSQL
+# connections therefore come from psycopg's in-process pool instead, sized for the
+# WEB_THREADS request threads plus the shared thread of websocket consumers and
+# the usage flusher. Other databases connect per request. Connections are
+# health-checked before reuse.
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+DATABASES["default"]["CONN_MAX_AGE"] = env.int("DB_CONN_MAX_AGE", default=0)
+if env.bool("DB_POOL", default=True) and DATABASES["default"]["ENGINE"] == "django.db.backends.postgresql":
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"].setdefault("OPTIONS", {})["pool"] = {
+        "min_size": env.int("DB_POOL_MIN_SIZE", default=1),
+        "max_size": env.int("DB_POOL_MAX_SIZE", default=WEB_THREADS + 2),
+        "timeout": env.float("DB_POOL_TIMEOUT", default=10.0),
+    }
+
+# Silence trimming before speech recognition, aggressiveness 0 (gentle) - 3 (strict)
+VAD_ENABLED = env.bool("VAD_ENABLED", default=True)
+VAD_AGGRESSIVENESS = env.int("VAD_AGGRESSIVENESS", default=2)
+if VAD_AGGRESSIVENESS not in range(4):  # The keys of vad.AGGRESSIVENESS_LEVELS
+    raise ImproperlyConfigured(f"VAD_AGGRESSIVENESS must be 0-3, not {VAD_AGGRESSIVENESS}")
+
+# Use the offline speech emulator instead of the Speech API (development and tests)
+SPEECH_EMULATOR = env.bool("SPEECH_EMULATOR", default=False)
+
+# Mono WAV and FLAC uploads are recognized by the Speech API straight from the
+# bucket (long-running, no silence trimming), the job page reloads this often.
+# Streamed requests (stream=1, one target language) take precedence and are
+# always recognized inline, segment by segment
+RECOGNITION_FROM_STORAGE = env.bool("RECOGNITION_FROM_STORAGE", default=True)
+RECOGNITION_POLL_SECONDS = env.int("RECOGNITION_POLL_SECONDS", default=5)
+# Seconds a poller may take to translate and save a finished recognition
+# before the job is taken over by the next poll (its worker is presumed dead)
+RECOGNITION_FINISH_LEASE = env.int("RECOGNITION_FINISH_LEASE", default=300)
+
+# Process pool for CPU-bound audio/PDF processing, requests beyond
+# DSP_POOL_MAX_PENDING queued or running tasks get a "busy" response
+DSP_POOL_ENABLED = env.bool("DSP_POOL_ENABLED", default=True)
+DSP_POOL_WORKERS = env.int("DSP_POOL_WORKERS", default=os.cpu_count() or 1)
+DSP_POOL_MAX_PENDING = env.int("DSP_POOL_MAX_PENDING", default=8)
+
+# Files fetched from storage ahead of the one being written into a ZIP export
+EXPORT_PREFETCH = env.int("EXPORT_PREFETCH", default=2)
+
+# Stored .txt files are compressed with "gzip" (GCS transcodes it for any client),
+# "zstd" (smaller, needs the zstandard package) or "" to store them raw
+TEXT_COMPRESSION = env("TEXT_COMPRESSION", default="gzip")
+
+# Translated sentences kept for reuse, pruned by the prune_translation_memory command
+TRANSLATION_MEMORY_MAX_ENTRIES = env.int("TRANSLATION_MEMORY_MAX_ENTRIES", default=200000)
+TRANSLATION_MEMORY_MAX_AGE_DAYS = env.int("TRANSLATION_MEMORY_MAX_AGE_DAYS", default=90)
+
+# Usage events are buffered in memory and written in bulk every
+# USAGE_FLUSH_INTERVAL seconds or once USAGE_FLUSH_SIZE are waiting
+USAGE_FLUSH_INTERVAL = env.float("USAGE_FLUSH_INTERVAL", default=10.0)
+USAGE_FLUSH_SIZE = env.int("USAGE_FLUSH_SIZE", default=200)
+
+# Identical transcriptions and syntheses running at once share one result,
+# followers wait at most SINGLEFLIGHT_WAIT seconds before doing the work
+# themselves. SINGLEFLIGHT_SHARED extends this across processes through a
+# lock in the cache, which requires a cache shared by the processes.
+SINGLEFLIGHT_WAIT = env.float("SINGLEFLIGHT_WAIT", default=120.0)
+SINGLEFLIGHT_SHARED = env.bool("SINGLEFLIGHT_SHARED", default=False)
+
+# Google API calls made for a request share an end-to-end budget of
+# UPSTREAM_DEADLINE seconds, transient failures are retried UPSTREAM_RETRIES
+# times with jittered backoff starting at UPSTREAM_BACKOFF seconds. With
+# UPSTREAM_HEDGING a duplicate synthesis or translation is sent when the first
+# is slower than the recent p95. After UPSTREAM_BREAKER_FAILURES failures in a
+# row a service is not called for UPSTREAM_BREAKER_COOLDOWN seconds.
+UPSTREAM_DEADLINE = env.float("UPSTREAM_DEADLINE", default=60.0)
+UPSTREAM_RETRIES = env.int("UPSTREAM_RETRIES", default=2)
+UPSTREAM_BACKOFF = env.float("UPSTREAM_BACKOFF", default=0.5)
+UPSTREAM_HEDGING = env.bool("UPSTREAM_HEDGING", default=False)
+UPSTREAM_BREAKER_FAILURES = env.int("UPSTREAM_BREAKER_FAILURES", default=5)
+UPSTREAM_BREAKER_COOLDOWN = env.float("UPSTREAM_BREAKER_COOLDOWN", default=30.0)
+
+# Concurrent translate calls are merged into one API request per language
+# pair, waiting at most TRANSLATION_BATCH_WINDOW seconds (0 disables) or
+# until TRANSLATION_BATCH_MAX_SEGMENTS segments are queued
+TRANSLATION_BATCH_WINDOW = env.float("TRANSLATION_BATCH_WINDOW", default=0.005)
+TRANSLATION_BATCH_MAX_SEGMENTS = env.int("TRANSLATION_BATCH_MAX_SEGMENTS", default=100)
+
+# Synthesized audio (the MP3 master and smaller renditions) is cached this long,
+# saving a synthesis needs its master to still be cached
+TTS_CACHE_TIMEOUT = env.int("TTS_CACHE_TIMEOUT", default=86400)
+
+# Waveform peaks: files per listing request, older files summarised per request
+# while serving it, browser cache lifetime and cache lifetime for pre-blob files
+PEAKS_MAX_FILES = env.int("PEAKS_MAX_FILES", default=200)
+PEAKS_BACKFILL_PER_REQUEST = env.int("PEAKS_BACKFILL_PER_REQUEST", default=4)
+PEAKS_MAX_AGE = env.int("PEAKS_MAX_AGE", default=86400)
+PEAKS_CACHE_TIMEOUT = env.int("PEAKS_CACHE_TIMEOUT", default=30 * 86400)
+
+# Streamed transcriptions are recognized in chunks of at most this many
+# seconds of speech, split at pauses where possible
+TRANSCRIPT_STREAM_CHUNK_SECONDS = env.float("TRANSCRIPT_STREAM_CHUNK_SECONDS", default=20.0)
+
+# Rendered "my files" tables, cached per listing version (derived from the files in
+# the database, see listing.py), a changed listing is simply rendered under its new version
+MYFILES_CACHE_TIMEOUT = env.int("MYFILES_CACHE_TIMEOUT", default=86400)
+
+# Cloud Run revision, part of page ETags so a deploy with new templates invalidates them
+RELEASE_ID = env("K_REVISION", default="")
+
+with timed("project_id"):
+    PROJECT_ID = env("PROJECT_ID", default=None) or default_project_id()
+
+# REGION and SERVICE_URI are set at deploy time, discovery is only a fallback
+DEPLOYMENT_CACHE_FILE = env("DEPLOYMENT_CACHE_FILE", default="/tmp/cbstg-deployment.json")
+with timed("deployment_discovery"):
+    REGION, SERVICE_URI = deployment_values(env, PROJECT_ID, SERVICE_NAME, DEPLOYMENT_CACHE_FILE)
+
+if SERVICE_URI:
+    ALLOWED_HOSTS = [urlparse(SERVICE_URI).netloc]
+    CSRF_TRUSTED_ORIGINS = [SERVICE_URI]
 else:
+    # Outside Cloud Run only, deployment_values refuses to start there without a URL
     ALLOWED_HOSTS = ["*"]
 
 if GS_BUCKET_NAME := env("MEDIAFILES_BUCKET_NAME", default=None):
@@ -52,25 +152,33 @@ if GS_BUCKET_NAME := env("MEDIAFILES_BUCKET_NAME", default=None):
     if STATICFILES_BUCKET_NAME := env("STATICFILES_BUCKET_NAME", default=None):
         STORAGES = {
             "default": {
-                "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+                "BACKEND": "cbstg_app.storage.CompressedTextGoogleCloudStorage",
                 "OPTIONS": {
                     "bucket_name": GS_BUCKET_NAME,
                 },
             },
             "staticfiles": {
-                "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+                "BACKEND": "cbstg_app.storage.CompressedManifestGoogleCloudStorage",
                 "OPTIONS": {
                     "bucket_name": STATICFILES_BUCKET_NAME,
+                    "gzip": True,
+                    # Unsigned URLs, a signature per render would defeat browser caching
+                    "querystring_auth": False,
                 },
             },
         }
     else:
         STORAGES = {
             "default": {
-                "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+                "BACKEND": "cbstg_app.storage.CompressedTextGoogleCloudStorage",
             },
             "staticfiles": {
-                "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+                "BACKEND": "cbstg_app.storage.CompressedManifestGoogleCloudStorage",
+                "OPTIONS": {
+                    "gzip": True,
+                    # Unsigned URLs, a signature per render would defeat browser caching
+                    "querystring_auth": False,
+                },
             },
         }
 
@@ -80,6 +188,8 @@ else:
     MEDIA_URL = f"https://storage.googleapis.com/{local_secrets.GS_BUCKET_NAME}/"
     GS_BUCKET_NAME = local_secrets.GS_BUCKET_NAME
 
+    from google.oauth2 import service_account
+
     GS_CREDENTIALS = service_account.Credentials.from_service_account_file(
         os.path.join(BASE_DIR, local_secrets.BUCKET_CREDENTIALS_PATH)
     )
@@ -87,7 +197,7 @@ else:
 
     STORAGES = {
         "default": {
-            "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+            "BACKEND": "cbstg_app.storage.CompressedTextGoogleCloudStorage",
             "OPTIONS": {
                 "project_id": local_secrets.PROJECT_ID,
                 "bucket_name": local_secrets.GS_BUCKET_NAME,
@@ -95,6 +205,7 @@ else:
             },
         },
         "staticfiles": {
-            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+            "BACKEND": "cbstg_app.storage.CompressedManifestStaticFilesStorage",
         },
     }
+    SERVE_STATIC_FROM_APP = True
@@ -0,0 +1,109 @@
+"""Cold start helpers for settings.py.
+
+Discovering the Cloud Run region and service URL costs a metadata server call
+and a Cloud Run API RPC. Values are taken from the environment when the
+deployment provides them (terraform sets REGION and SERVICE_URI), then from a
+cache file written by the first discovery in the container, and only then
+discovered with short timeouts. On Cloud Run (K_SERVICE is set) a service URL
+that cannot be found stops the start: settings.py would otherwise fall back to
+accepting any host without trusted CSRF origins.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger('cbstg')
+
+SETTINGS_TIMINGS = {}
+
+METADATA_TIMEOUT = 1.0
+SERVICE_LOOKUP_TIMEOUT = 5.0
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SETTINGS_TIMINGS[phase] = time.perf_counter() - started
+
+
+def default_project_id():
+    import google.auth
+
+    try:
+        return google.auth.default()[1]
+    except google.auth.exceptions.DefaultCredentialsError:
+        return None
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache_file, values):
+    try:
+        with open(cache_file, "w") as f:
+            json.dump(values, f)
+    except OSError as e:
+        logger.info(f"Could not write deployment cache {cache_file}: {e}")
+
+
+def discover_region():
+    import requests
+
+    try:
+        response = requests.get(
+            "http://metadata.google.internal/computeMetadata/v1/instance/region",
+            headers={"Metadata-Flavor": "Google"},
+            timeout=METADATA_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.text.split("/")[-1]
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not read the region from the metadata server: {e}")
+        return None
+
+
+def discover_service_uri(project_id, region, service_name):
+    from google.cloud.run_v2.services.services.client import ServicesClient
+
+    service_path = f"projects/{project_id}/locations/{region}/services/{service_name}"
+    try:
+        return ServicesClient().get_service(name=service_path, timeout=SERVICE_LOOKUP_TIMEOUT).uri
+    except Exception as e:
+        logger.error(f"Could not look up Cloud Run service {service_path}: {e}")
+        return None
+
+
+def deployment_values(env, project_id, service_name, cache_file):
+    """Return (region, service_uri), either may be None outside Cloud Run.
+
+    Raises ImproperlyConfigured on Cloud Run when the service URL is neither
+    configured nor discoverable.
+    """
+    cached = _read_cache(cache_file) if cache_file else {}
+    region = env("REGION", default=None) or cached.get("region")
+    service_uri = env("SERVICE_URI", default=None) or cached.get("service_uri")
+
+    if region is None and service_name:
+        region = discover_region()
+    if service_uri is None and all((project_id, region, service_name)):
+        service_uri = discover_service_uri(project_id, region, service_name)
+        if service_uri and cache_file:
+            _write_cache(cache_file, {"region": region, "service_uri": service_uri})
+    if service_uri is None and env("K_SERVICE", default=None):
+        raise ImproperlyConfigured(
+            "Could not determine the Cloud Run service URL for ALLOWED_HOSTS and CSRF_TRUSTED_ORIGINS, "
+            "set SERVICE_URI (and SERVICE_NAME) in the service's environment."
+        )
+    return region, service_uri
+
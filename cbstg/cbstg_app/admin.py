@@ -1,3 +1,14 @@
 from django.contrib import admin
 
+from .models import DailyUsage
+
 # Register your models here.
+
+
+@admin.register(DailyUsage)
+class DailyUsageAdmin(admin.ModelAdmin):
+    list_display = ("date", "user", "action", "count", "units")
+    list_filter = ("action", "date")
+    search_fields = ("user__username",)
+    date_hierarchy = "date"
+    list_select_related = ("user",)
@@ -6,3 +6,4 @@ class CbstgAppConfig(AppConfig):
 
     def ready(self):
         import cbstg_app.signals  # ważne: rejestruje sygnały
+        import cbstg_app.db  # connection counters and pool metrics
@@ -0,0 +1,87 @@
+"""Content-addressed storage for submitted files.
+
+Identical bytes are stored once, under blobs/<sha256[:2]>/<sha256><extension>.
+Every SubmittedFile pointing at a StoredBlob holds one reference. Deleting the
+file only drops the reference (see signals.py), and the sweep_blobs command
+removes blobs nobody references any more.
+"""
+import hashlib
+import os
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import StoredBlob, SubmittedFile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Hash uploads while they stream in, ahead of the handlers that buffer them.
+
+    Chunks are passed on unchanged, the digest ends up in
+    ``request.upload_digests[field_name]``.
+    """
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not hasattr(self.request, "upload_digests"):
+            self.request.upload_digests = {}
+        self.request.upload_digests[self.field_name] = self.sha256.hexdigest()
+        return None
+
+
+def content_digest(content):
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks(CHUNK_SIZE):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def acquire_blob(content, extension, digest=None):
+    """Return the blob holding content with its reference count raised by one.
+
+    Storage is only written when no blob with the same digest exists yet.
+    """
+    digest = digest or content_digest(content)
+    key = digest + extension
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                blob = StoredBlob.objects.select_for_update().filter(key=key).first()
+                if blob is not None:
+                    StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+                    blob.ref_count += 1
+                    return blob
+
+                name = default_storage.save(f"blobs/{digest[:2]}/{key}", content)
+                return StoredBlob.objects.create(key=key, file=name, size=content.size, ref_count=1)
+        except IntegrityError:
+            # A concurrent upload of the same bytes created the row first
+            if attempt:
+                raise
+            if name != f"blobs/{digest[:2]}/{key}":
+                default_storage.delete(name)
+
+
+def release_blob(blob_id):
+    StoredBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F("ref_count") - 1)
+
+
+def save_submitted_file(user, filename, content, digest=None):
+    """Store content deduplicated and create the user's SubmittedFile for it."""
+    extension = os.path.splitext(filename)[1].lower()
+    with transaction.atomic():
+        blob = acquire_blob(content, extension, digest)
+        return SubmittedFile.objects.create(
+            user=user, file=blob.file.name, blob=blob, original_name=os.path.basename(filename)
+        )
@@ -0,0 +1,11 @@
+import re
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, max-age=60, must-revalidate"
+
+# ManifestFilesMixin inserts a 12 character md5 prefix before the extension
+_HASHED_NAME_RE = re.compile(r"\.[0-9a-f]{12}\.[^/.]+$")
+
+
+def is_hashed_name(name):
+    return bool(_HASHED_NAME_RE.search(name))
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import math
+import queue
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.files.base import ContentFile
+from django.http import parse_cookie
+from django.http.request import validate_host
+
+from .emulators import speech_client
+from .langid import get_stt_language_hint
+from .limits import check_and_increment_limit, get_user_limit, initialize_limit_if_needed
+from .usage import record_usage
+from .blobs import save_submitted_file
+
+logger = logging.getLogger('cbstg')
+
+# Browsers send 16-bit little endian mono PCM at this rate
+LIVE_SAMPLE_RATE = 16000
+BYTES_PER_SECOND = LIVE_SAMPLE_RATE * 2
+
+
+async def live_transcription(scope, receive, send):
+    """ASGI websocket application streaming microphone audio to the Speech API."""
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+
+    headers = dict(scope["headers"])
+    user = await _get_scope_user(headers)
+    if not user.is_authenticated or not _origin_allowed(headers):
+        await send({"type": "websocket.close", "code": 4403})
+        return
+
+    params = parse_qs(scope.get("query_string", b"").decode())
+    session = LiveTranscriptionSession(
+        user,
+        send,
+        language=params.get("lang", ["en"])[0],
+        save=params.get("save", ["0"])[0] == "1",
+        filename=params.get("filename", ["live_transcription.txt"])[0],
+    )
+    await send({"type": "websocket.accept"})
+    await session.run(receive)
+
+
+class LiveTranscriptionSession:
+
+    def __init__(self, user, send, language, save, filename):
+        self.user = user
+        self.send = send
+        self.language = language
+        self.save = save
+        self.filename = filename if filename.endswith('.txt') else filename + '.txt'
+        self.received_bytes = 0
+        self.finals = []
+        self.connected = True
+
+    @property
+    def streamed_seconds(self):
+        return self.received_bytes / BYTES_PER_SECOND
+
+    async def run(self, receive):
+        if not await sync_to_async(self._start_quota)():
+            await self._send_json({"type": "error", "error": "Daily STT limit exceeded."})
+            await self.send({"type": "websocket.close"})
+            return
+
+        max_seconds = await sync_to_async(get_user_limit)(self.user, "audio_duration")
+        audio_chunks = queue.Queue()
+        results = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        recognition = loop.run_in_executor(None, self._recognize, audio_chunks, results, loop)
+        forwarding = asyncio.create_task(self._forward_results(results))
+
+        malformed = False
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    self.connected = False
+                    break
+                if message.get("text") is not None:
+                    try:
+                        control = json.loads(message["text"])
+                    except ValueError:
+                        control = None
+                    if not isinstance(control, dict):
+                        logger.info("Live transcription ended by a malformed control message")
+                        await self._send_json({"type": "error", "error": "Malformed control message."})
+                        malformed = True
+                        break
+                    if control.get("type") == "stop":
+                        break
+                    continue
+
+                chunk = message.get("bytes") or b""
+                self.received_bytes += len(chunk)
+                if self.streamed_seconds > max_seconds:
+                    logger.info(f"Live transcription duration limit exceeded: {self.streamed_seconds:.1f}s")
+                    await self._send_json({"type": "error", "error": "Audio duration limit exceeded."})
+                    break
+                if recognition.done():
+                    break
+                audio_chunks.put(chunk)
+        finally:
+            audio_chunks.put(None)
+            try:
+                await recognition
+            except Exception as e:
+                logger.error(f"Live transcription failed: {e}")
+                await self._send_json({"type": "error", "error": f"Transcription failed: {e}"})
+            await results.put(None)
+            await forwarding
+
+        # The charge stands however the session ended, a disconnect is the usual end
+        await sync_to_async(record_usage)(self.user.id, "stt", math.ceil(self.streamed_seconds))
+        if not self.connected:
+            return
+        if malformed:
+            # 1007: invalid frame payload data
+            await self.send({"type": "websocket.close", "code": 1007})
+            return
+
+        transcript = " ".join(self.finals)
+        file_id = None
+        if self.save and transcript:
+            file_id = await sync_to_async(self._save_transcript)(transcript)
+
+        logger.info(f"Live transcription finished after {self.streamed_seconds:.1f}s of audio")
+        await self._send_json({
+            "type": "done",
+            "transcript": transcript,
+            "seconds": round(self.streamed_seconds, 2),
+            "file_id": file_id,
+        })
+        await self.send({"type": "websocket.close"})
+
+    def _start_quota(self):
+        initialize_limit_if_needed(self.user, "daily_stt")
+        return check_and_increment_limit(self.user, "daily_stt")
+
+    def _recognize(self, audio_chunks, results, loop):
+        from google.cloud import speech
+
+        config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                language_code=self.language,
+                alternative_language_codes=[
+                    hint for hint in [get_stt_language_hint(self.user.id)] if hint and hint != self.language
+                ],
+                sample_rate_hertz=LIVE_SAMPLE_RATE,
+                enable_automatic_punctuation=True,
+            ),
+            interim_results=True,
+        )
+
+        def requests():
+            while (chunk := audio_chunks.get()) is not None:
+                yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+        logger.info("Connecting to SpeechClient for streaming recognition")
+        for response in speech_client().streaming_recognize(config=config, requests=requests()):
+            for result in response.results:
+                if not result.alternatives:
+                    continue
+                item = (result.is_final, result.alternatives[0].transcript)
+                loop.call_soon_threadsafe(results.put_nowait, item)
+
+    async def _forward_results(self, results):
+        while (item := await results.get()) is not None:
+            is_final, transcript = item
+            if is_final:
+                self.finals.append(transcript.strip())
+            await self._send_json({"type": "final" if is_final else "interim", "transcript": transcript})
+
+    def _save_transcript(self, transcript):
+        return save_submitted_file(self.user, self.filename, ContentFile(transcript.encode())).id
+
+    async def _send_json(self, data):
+        if not self.connected:
+            return
+        await self.send({"type": "websocket.send", "text": json.dumps(data)})
+
+
+async def _get_scope_user(headers):
+    cookies = parse_cookie(headers.get(b"cookie", b"").decode())
+    engine = import_module(settings.SESSION_ENGINE)
+    request = SimpleNamespace(session=engine.SessionStore(cookies.get(settings.SESSION_COOKIE_NAME)))
+    return await sync_to_async(get_user)(request)
+
+
+def _origin_allowed(headers):
+    # Browsers always send Origin on websocket handshakes, reject cross-site ones
+    origin = headers.get(b"origin")
+    if origin is None:
+        return False
+    host = urlparse(origin.decode()).netloc
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = [".localhost", "127.0.0.1", "[::1]"]
+    return validate_host(host, allowed_hosts)
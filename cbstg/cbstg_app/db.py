@@ -0,0 +1,56 @@
+import threading
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+_lock = threading.Lock()
+_created = {}
+
+
+@receiver(connection_created)
+def count_connection(sender, connection, **kwargs):
+    with _lock:
+        _created[connection.alias] = _created.get(connection.alias, 0) + 1
+
+
+def connections_created(alias="default"):
+    with _lock:
+        return _created.get(alias, 0)
+
+
+def database_stats():
+    connection = connections["default"]
+    stats = {
+        "vendor": connection.vendor,
+        "conn_max_age": connection.settings_dict["CONN_MAX_AGE"],
+        "health_checks": connection.settings_dict["CONN_HEALTH_CHECKS"],
+        "connections_created": connections_created(),
+    }
+    pool = getattr(connection, "pool", None)
+    if pool is None:
+        stats["pooled"] = False
+        return stats
+
+    pool_stats = pool.get_stats()
+    requests_num = pool_stats.get("requests_num", 0)
+    stats.update({
+        "pooled": True,
+        "min_size": pool_stats.get("pool_min"),
+        "max_size": pool_stats.get("pool_max"),
+        "size": pool_stats.get("pool_size", 0),
+        "in_use": pool_stats.get("pool_size", 0) - pool_stats.get("pool_available", 0),
+        "waiting": pool_stats.get("requests_waiting", 0),
+        "requests": requests_num,
+        "wait_ms_total": pool_stats.get("requests_wait_ms", 0),
+        "wait_ms_avg": pool_stats.get("requests_wait_ms", 0) / requests_num if requests_num else 0.0,
+        "timeouts": pool_stats.get("requests_errors", 0),
+        "created": pool_stats.get("connections_num", 0),
+        "lost": pool_stats.get("connections_lost", 0),
+    })
+    return stats
+
+
+metrics.register("database", database_stats)
@@ -0,0 +1,241 @@
+"""CPU-bound audio and document processing run inside the worker process pool.
+
+Nothing here may import Django, worker processes are spawned without settings.
+Large buffers cross the process boundary through shared memory blocks: the
+caller passes a block name and size, and results are written into a block the
+worker creates, so samples are never pickled through the pool's pipes.
+"""
+import io
+import struct
+import time
+from multiprocessing import shared_memory
+
+RECOGNITION_SAMPLE_RATE = 16000
+
+# Waveform zoom levels in buckets per recording, each 4x finer than the last
+PEAK_BUCKETS = (64, 256, 1024)
+PEAKS_HEADER = struct.Struct("<2sBfB")  # magic, version, duration, number of levels
+PEAKS_LEVEL = struct.Struct("<H")  # buckets, followed by interleaved int8 (min, max) pairs
+
+
+class SharedBuffer:
+    """Context manager owning a shared memory block, unlinked on exit."""
+
+    def __init__(self, data=None, name=None):
+        if name is not None:
+            self.shm = shared_memory.SharedMemory(name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+            self.shm.buf[:len(data)] = data
+        self.size = len(data) if data is not None else self.shm.size
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _BufferReader(io.RawIOBase):
+    """Seekable read-only file over a memoryview, soundfile reads it via readinto()."""
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._buf) - self._pos))
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._buf)}[whence]
+        self._pos = base + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def _read_audio(name, size):
+    """Decode the audio in a shared memory block to float32 samples and their rate."""
+    import soundfile as sf
+
+    shm = shared_memory.SharedMemory(name=name)
+    view = shm.buf[:size]
+    try:
+        return sf.read(_BufferReader(view), dtype="float32")
+    finally:
+        # A decoding error's traceback still holds the reader, the block can
+        # only be closed once the view on it is released
+        view.release()
+        shm.close()
+
+
+def timed_call(fn, *args):
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time()
+
+
+def prepare_for_recognition(name, size, vad_enabled, vad_aggressiveness):
+    """Decode, downmix, resample to 16 kHz and optionally trim silence.
+
+    The 16-bit PCM result is written to a new shared memory block which the caller
+    must read and unlink. Returns (block name, samples, time map, peaks), the
+    vad.TimeMap leads from the trimmed samples back to the original recording
+    (one segment covering everything without trimming) and peaks is the packed
+    waveform summary of the original audio.
+    """
+    import numpy as np
+    from scipy.signal import resample
+
+    from .vad import TimeMap, trim_silence
+
+    audio_data, sample_rate = _read_audio(name, size)
+
+    # If stereo, convert to mono by averaging channels
+    if audio_data.ndim > 1 and audio_data.shape[1] > 1:
+        audio_data = np.mean(audio_data, axis=1)
+    audio_data = audio_data.reshape(-1)
+    peaks = compute_peaks(audio_data, sample_rate)
+
+    if sample_rate != RECOGNITION_SAMPLE_RATE:
+        num_samples = int(len(audio_data) * RECOGNITION_SAMPLE_RATE / sample_rate)
+        audio_data = resample(audio_data, num_samples)
+
+    duration = len(audio_data) / RECOGNITION_SAMPLE_RATE
+    if vad_enabled:
+        audio_data, time_map = trim_silence(audio_data, RECOGNITION_SAMPLE_RATE, vad_aggressiveness)
+    else:
+        time_map = TimeMap([(0.0, duration, 0.0)], duration)
+
+    out = shared_memory.SharedMemory(create=True, size=max(len(audio_data) * 2, 1))
+    pcm = np.ndarray((len(audio_data),), dtype="<i2", buffer=out.buf)
+    np.multiply(np.clip(audio_data, -1.0, 1.0), 32767, out=pcm, casting="unsafe")
+    del pcm
+    out.close()
+    return out.name, len(audio_data), time_map, peaks
+
+
+def split_at_pauses(num_samples, cuts, max_samples):
+    """Split num_samples into (start, end) chunks of at most max_samples.
+
+    Chunks end at the last cut (a pause) that fits, so words are not split,
+    and only fall back to a hard cut when speech runs on for longer.
+    """
+    cuts = sorted(cuts)
+    chunks = []
+    start = 0
+    while start < num_samples:
+        limit = start + max_samples
+        if limit >= num_samples:
+            end = num_samples
+        else:
+            end = max((cut for cut in cuts if start < cut <= limit), default=limit)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def transcode(name, size, container, subtype, sample_rate, compression_level):
+    """Re-encode audio as a smaller rendition, e.g. MP3 to 16 kHz OGG/Opus.
+
+    The encoded file is written to a new shared memory block which the caller
+    must read and unlink. Returns (block name, size).
+    """
+    import numpy as np
+    import soundfile as sf
+    from scipy.signal import resample_poly
+
+    audio_data, source_rate = _read_audio(name, size)
+
+    if audio_data.ndim > 1 and audio_data.shape[1] > 1:
+        audio_data = np.mean(audio_data, axis=1)
+    audio_data = audio_data.reshape(-1)
+    if source_rate != sample_rate:
+        audio_data = resample_poly(audio_data, sample_rate, source_rate).astype(np.float32)
+
+    encoded = io.BytesIO()
+    sf.write(encoded, audio_data, sample_rate, format=container, subtype=subtype, compression_level=compression_level)
+    encoded = encoded.getbuffer()
+
+    out = shared_memory.SharedMemory(create=True, size=max(len(encoded), 1))
+    out.buf[:len(encoded)] = encoded
+    out.close()
+    return out.name, len(encoded)
+
+
+def compute_peaks(samples, sample_rate):
+    """Pack min/max sample values per bucket at every PEAK_BUCKETS zoom level.
+
+    The finest level is reduced from the samples in one pass, coarser levels
+    from the finer ones, values are scaled to int8.
+    """
+    import numpy as np
+
+    finest = PEAK_BUCKETS[-1]
+    if len(samples):
+        edges = np.linspace(0, len(samples), finest + 1).astype(np.int64)[:-1]
+        # Recordings shorter than the bucket count repeat samples instead of leaving gaps
+        edges = np.minimum(edges, len(samples) - 1)
+        lows = np.minimum.reduceat(samples, edges)
+        highs = np.maximum.reduceat(samples, edges)
+    else:
+        lows = highs = np.zeros(finest, dtype=np.float32)
+
+    levels = []
+    for buckets in PEAK_BUCKETS:
+        factor = finest // buckets
+        pairs = np.empty((buckets, 2), dtype=np.int8)
+        pairs[:, 0] = np.round(np.clip(lows.reshape(buckets, factor).min(axis=1), -1, 1) * 127)
+        pairs[:, 1] = np.round(np.clip(highs.reshape(buckets, factor).max(axis=1), -1, 1) * 127)
+        levels.append(PEAKS_LEVEL.pack(buckets) + pairs.tobytes())
+    return PEAKS_HEADER.pack(b"PK", 1, len(samples) / sample_rate, len(levels)) + b"".join(levels)
+
+
+def unpack_peaks(data):
+    """Return (duration, {buckets: interleaved int8 min/max bytes}) of packed peaks."""
+    magic, version, duration, count = PEAKS_HEADER.unpack_from(data)
+    if magic != b"PK" or version != 1:
+        raise ValueError("Not a peaks summary.")
+    levels = {}
+    offset = PEAKS_HEADER.size
+    for _ in range(count):
+        buckets, = PEAKS_LEVEL.unpack_from(data, offset)
+        offset += PEAKS_LEVEL.size
+        levels[buckets] = bytes(data[offset:offset + buckets * 2])
+        offset += buckets * 2
+    return duration, levels
+
+
+def waveform_peaks(name, size):
+    import numpy as np
+
+    audio_data, sample_rate = _read_audio(name, size)
+    if audio_data.ndim > 1:
+        audio_data = np.mean(audio_data, axis=1)
+    return compute_peaks(audio_data, sample_rate)
+
+
+def extract_pdf_text(name, size):
+    import pymupdf
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        doc = pymupdf.open(stream=bytes(shm.buf[:size]), filetype="pdf")
+    finally:
+        shm.close()
+    return "".join(page.get_text() for page in doc)
@@ -0,0 +1,157 @@
+import io
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+
+def speech_client():
+    if settings.SPEECH_EMULATOR:
+        return LocalSpeechEmulator()
+
+    from google.cloud import speech
+
+    return speech.SpeechClient()
+
+
+class LocalSpeechEmulator:
+    """Offline stand-in for speech.SpeechClient used in development and tests.
+
+    Instead of words it reports the speech regions it finds in the audio, so the
+    whole pipeline can be exercised without credentials or billing.
+    """
+
+    interim_every_seconds = 1.0
+
+    # Operations of every emulator instance, as they would be on the server
+    _operations = {}
+    _operations_lock = threading.Lock()
+
+    def recognize(self, config, audio, **kwargs):
+        import numpy as np
+        import soundfile as sf
+        from google.cloud import speech
+
+        if audio.content[:4] in (b"RIFF", b"fLaC"):
+            samples, sample_rate = sf.read(io.BytesIO(audio.content), dtype="float32")
+            if samples.ndim > 1:
+                samples = samples.mean(axis=1)
+        else:
+            # Headerless LINEAR16
+            samples = np.frombuffer(audio.content, dtype="<i2").astype(np.float32) / 32768
+            sample_rate = config.sample_rate_hertz
+        return speech.RecognizeResponse(results=[
+            speech.SpeechRecognitionResult(alternatives=[speech.SpeechRecognitionAlternative(transcript=text)])
+            for text in self._describe(samples, sample_rate)
+        ])
+
+    def long_running_recognize(self, config, audio, **kwargs):
+        """Recognize gs://<bucket>/<name> from default_storage, the operation is done when first polled."""
+        from google.cloud import speech
+        from google.longrunning import operations_pb2
+        from google.protobuf import any_pb2
+
+        if not audio.uri.startswith("gs://"):
+            raise ValueError(f"Unsupported audio URI: {audio.uri}")
+        name = audio.uri[len("gs://"):].partition("/")[2]
+        with default_storage.open(name, "rb") as audio_file:
+            content = audio_file.read()
+        response = speech.LongRunningRecognizeResponse(
+            results=self.recognize(config, speech.RecognitionAudio(content=content)).results
+        )
+
+        operation_name = f"emulator/{uuid.uuid4().hex}"
+        with self._operations_lock:
+            self._operations[operation_name] = operations_pb2.Operation(
+                name=operation_name, done=True, response=any_pb2.Any(
+                    type_url="type.googleapis.com/google.cloud.speech.v1.LongRunningRecognizeResponse",
+                    value=speech.LongRunningRecognizeResponse.serialize(response),
+                ),
+            )
+        return SimpleNamespace(operation=operations_pb2.Operation(name=operation_name, done=False))
+
+    @property
+    def transport(self):
+        return SimpleNamespace(operations_client=self)
+
+    def get_operation(self, name, **kwargs):
+        with self._operations_lock:
+            return self._operations[name]
+
+    def streaming_recognize(self, config, requests, **kwargs):
+        import numpy as np
+
+        sample_rate = config.config.sample_rate_hertz
+        chunks = []
+        received = 0
+        reported = 0.0
+        for request in requests:
+            chunks.append(request.audio_content)
+            received += len(request.audio_content)
+            seconds = received / 2 / sample_rate
+            if config.interim_results and seconds - reported >= self.interim_every_seconds:
+                reported = seconds
+                yield self._streaming_response(f"[listening {seconds:.1f}s]", is_final=False)
+
+        pcm = np.frombuffer(b"".join(chunks), dtype="<i2").astype(np.float32) / 32768
+        for text in self._describe(pcm, sample_rate):
+            yield self._streaming_response(text, is_final=True)
+
+    @staticmethod
+    def _describe(samples, sample_rate):
+        from .vad import trim_silence
+
+        if not len(samples):
+            return []
+        _, time_map = trim_silence(samples, sample_rate)
+        return [f"[speech {start:.2f}s-{end:.2f}s]" for start, end, _ in time_map.segments]
+
+    @staticmethod
+    def _streaming_response(text, is_final):
+        from google.cloud import speech
+
+        return speech.StreamingRecognizeResponse(results=[
+            speech.StreamingRecognitionResult(
+                alternatives=[speech.SpeechRecognitionAlternative(transcript=text)],
+                is_final=is_final,
+            )
+        ])
+
+
+class FaultInjectingClient:
+    """Wraps an API client and makes chosen methods slow or failing, for tests and drills.
+
+    Keyword arguments map a method name to the faults its next calls suffer,
+    one per call: an exception to raise or a delay in seconds. A delay longer
+    than the call's timeout ends in TimeoutError, like a real RPC would. Calls
+    past the end of the list reach the wrapped client unharmed.
+    """
+
+    def __init__(self, client, **faults):
+        self._client = client
+        self._faults = {name: list(steps) for name, steps in faults.items()}
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if name not in self._faults:
+            return method
+
+        def faulty(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+                fault = self._faults[name].pop(0) if self._faults[name] else None
+            if isinstance(fault, BaseException) or isinstance(fault, type) and issubclass(fault, BaseException):
+                raise fault
+            if fault:
+                timeout = kwargs.get("timeout")
+                time.sleep(fault if timeout is None else min(fault, timeout))
+                if timeout is not None and fault > timeout:
+                    raise TimeoutError(f"{name} timed out after {timeout:.2f}s")
+            return method(*args, **kwargs)
+        return faulty
@@ -0,0 +1,106 @@
+"""Streamed ZIP export of submitted files.
+
+The archive is produced while the response is sent: every file is read from
+storage in chunks (ranged reads for the bucket, see
+TextCompressionMixin.iter_chunks) and written through zipfile into a small
+buffer that the generator drains. The first chunk of the next few files is
+fetched in background threads while the current one streams, nothing is
+spooled to a temporary file and the full archive never exists in memory.
+The view hands the generator to the server through stream_in_thread, under
+ASGI a plain sync generator would be drained completely before sending.
+"""
+import logging
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import chain
+
+from django.core.files.storage import default_storage
+
+from .models import AUDIO_EXTENSIONS
+
+logger = logging.getLogger('cbstg')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkSink:
+    """Write-only, unseekable file for zipfile, it falls back to data descriptors."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _fetch(name):
+    chunks = default_storage.iter_chunks(name, CHUNK_SIZE)
+    try:
+        # The first read, where a missing object fails, happens in the prefetch thread
+        return next(chunks, b""), chunks
+    except Exception:
+        chunks.close()
+        raise
+
+
+def _compress_type(arcname):
+    # Audio is already compressed, deflating it costs CPU for nothing
+    return zipfile.ZIP_STORED if arcname.lower().endswith(AUDIO_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries, prefetch=2):
+    """Yield a ZIP archive of entries, (storage name, archive name, date_time) tuples.
+
+    At most ``prefetch`` files are fetched ahead of the one being written.
+    Files that cannot be read are logged and left out.
+    """
+    entries = iter(entries)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max(prefetch, 1), thread_name_prefix="zip-prefetch")
+
+    def fetch_next():
+        entry = next(entries, None)
+        if entry is not None:
+            pending.append((entry, executor.submit(_fetch, entry[0])))
+
+    sink = _ChunkSink()
+    try:
+        for _ in range(max(prefetch, 1)):
+            fetch_next()
+
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            while pending:
+                (name, arcname, date_time), future = pending.popleft()
+                fetch_next()
+                try:
+                    first, chunks = future.result()
+                except Exception as e:
+                    logger.error(f"Skipping {name} in export: {e}")
+                    continue
+
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.compress_type = _compress_type(arcname)
+                with closing(chunks), archive.open(info, "w") as target:
+                    for chunk in chain((first,), chunks):
+                        target.write(chunk)
+                        if data := sink.drain():
+                            yield data
+                if data := sink.drain():
+                    yield data
+        yield sink.drain()
+    finally:
+        # Client went away or the archive is complete, release prefetched files
+        executor.shutdown(wait=True, cancel_futures=True)
+        for _, future in pending:
+            if not future.cancelled() and future.exception() is None:
+                future.result()[1].close()
@@ -0,0 +1,154 @@
+"""Offline language identification for the languages the app offers.
+
+Character 1-3 gram profiles are built from the sample texts in langdata/ on
+first use. A text is scored against every language at once as a naive Bayes
+sum of log probabilities over the profile matrix. Translation calls use it to
+skip text that is already in the target language and to correct a mislabelled
+source language.
+
+A classifier that only knows the offered languages would put Italian or
+Portuguese text confidently into Spanish. Neighbouring languages the app does
+not offer are profiled too: text that scores best for one of them, or that no
+language explains clearly, is not classified and the declared source language
+is used as it is.
+"""
+import re
+import threading
+from collections import Counter, namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+from django.core.cache import cache
+
+from . import metrics
+
+SUPPORTED_LANGUAGES = ("en", "es", "fr", "de", "pl")
+# Profiled only to reject text in them, it is never reported as a supported language
+UNSUPPORTED_LANGUAGES = ("it", "pt", "ca", "nl", "cs")
+PROFILED_LANGUAGES = SUPPORTED_LANGUAGES + UNSUPPORTED_LANGUAGES
+LANGDATA_DIR = Path(__file__).resolve().parent / "langdata"
+
+# Shorter texts are not classified, a few letters fit every language
+MIN_LETTERS = 12
+MIN_CONFIDENCE = 0.95
+MAX_CHARS = 2000
+
+STT_HINT_TIMEOUT = 30 * 86400
+
+TranslationPlan = namedtuple("TranslationPlan", "source detected translate")
+
+_lock = threading.Lock()
+_stats = Counter()
+
+
+def _ngrams(text):
+    text = " " + " ".join(re.sub(r"[\W\d_]+", " ", text.lower()).split()) + " "
+    for n in (1, 2, 3):
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            if not gram.isspace():
+                yield gram
+
+
+@lru_cache(maxsize=1)
+def _profiles():
+    """Return (n-gram -> row index, log probability matrix of n-grams x languages)."""
+    import numpy as np
+
+    counts = [Counter(_ngrams((LANGDATA_DIR / f"{language}.txt").read_text(encoding="utf-8")))
+              for language in PROFILED_LANGUAGES]
+    vocabulary = {gram: i for i, gram in enumerate(sorted(set().union(*counts)))}
+
+    # Add-one smoothing, n-grams unseen in a language are unlikely but not impossible
+    frequencies = np.ones((len(vocabulary), len(PROFILED_LANGUAGES)))
+    for column, language_counts in enumerate(counts):
+        for gram, count in language_counts.items():
+            frequencies[vocabulary[gram], column] += count
+    return vocabulary, np.log(frequencies / frequencies.sum(axis=0))
+
+
+def detect(text):
+    """Return (language, confidence), language is None when it cannot be told confidently.
+
+    Text that looks most like one of UNSUPPORTED_LANGUAGES is rejected the same way.
+    """
+    import numpy as np
+
+    text = text[:MAX_CHARS]
+    if sum(c.isalpha() for c in text) < MIN_LETTERS:
+        return None, 0.0
+
+    vocabulary, log_probabilities = _profiles()
+    rows = [vocabulary[gram] for gram in _ngrams(text) if gram in vocabulary]
+    if not rows:
+        return None, 0.0
+
+    scores = log_probabilities[np.asarray(rows)].sum(axis=0)
+    probabilities = np.exp(scores - scores.max())
+    probabilities /= probabilities.sum()
+    best = int(probabilities.argmax())
+    confidence = float(probabilities[best])
+    if confidence < MIN_CONFIDENCE or PROFILED_LANGUAGES[best] not in SUPPORTED_LANGUAGES:
+        return None, confidence
+    return PROFILED_LANGUAGES[best], confidence
+
+
+def _base_language(code):
+    return code.split("-")[0].lower() if code else code
+
+
+def plan_translation(text, declared_source, target):
+    """Decide whether text needs translating to target, and from which language.
+
+    Only a confident detection is trusted: it overrides the declared source
+    language. Otherwise the declared source stands. Either way, text already in
+    the target language is not sent to the API at all.
+    """
+    return plan_translations(text, declared_source, [target])[target]
+
+
+def plan_translations(text, declared_source, targets):
+    """plan_translation for several target languages, text is only classified once."""
+    declared_source = _base_language(declared_source)
+    detected, _ = detect(text)
+
+    plans = {}
+    with _lock:
+        _stats["checked"] += 1
+        if detected is None:
+            _stats["undetected"] += 1
+        elif detected != declared_source:
+            _stats["source_corrected"] += 1
+        source = detected or declared_source
+        for target in targets:
+            base_target = _base_language(target)
+            if source == base_target and declared_source != base_target:
+                _stats["translation_skipped"] += 1
+            plans[target] = TranslationPlan(source=source, detected=detected, translate=source != base_target)
+    return plans
+
+
+def _hint_key(user_id):
+    return f"{user_id}:stt_language_hint"
+
+
+def get_stt_language_hint(user_id):
+    return cache.get(_hint_key(user_id))
+
+
+def remember_stt_language(user_id, declared, detected):
+    """Remember a language the user's recordings were detected in despite a different label.
+
+    The next recognition lists it as an alternative language, so the Speech API
+    can switch to it instead of transcribing in the wrong language.
+    """
+    if detected and detected != _base_language(declared):
+        cache.set(_hint_key(user_id), detected, timeout=STT_HINT_TIMEOUT)
+
+
+def language_stats():
+    with _lock:
+        return dict(_stats)
+
+
+metrics.register("language_detection", language_stats)
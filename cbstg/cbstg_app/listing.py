@@ -0,0 +1,57 @@
+"""Cached rendering of the file listing and its conditional-request validators.
+
+The listing version is derived from the user's files in the database rather
+than kept in the cache: every instance computes the same version for the same
+files, so a change made on one instance is seen by all of them, even though
+each keeps its rendered listings in its own cache.
+
+The price is one aggregate query per visit, an unchanged listing included,
+where a version kept in the cache cost none. With the per-process caches
+this deployment has, a cached version would miss changes made on other
+instances. The query reads the user's rows through the submitted file's
+user index, and a 304 is answered from it without rendering anything.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from .models import SubmittedFile
+
+# Rendered listings are shared across sessions, the real token is swapped in per request
+CSRF_PLACEHOLDER = "__csrf_token_placeholder__"
+
+
+def get_listing_version(user_id):
+    """Version of the user's listing, in one aggregate query.
+
+    Any save bumps a file's modified_at and new files get a higher id, deletes
+    lower the count. Files left untouched can only drop out of the listing, so
+    no earlier combination ever comes back for different files.
+    """
+    state = SubmittedFile.objects.filter(user_id=user_id).aggregate(
+        count=Count("id"), last_id=Max("id"), modified=Max("modified_at"))
+    modified = state["modified"].timestamp() if state["modified"] else 0
+    return f"{state['count']}.{state['last_id'] or 0}.{modified:.6f}"
+
+
+def get_cached_listing(user_id, version):
+    return cache.get(f"{user_id}:myfiles:{version}")
+
+
+def set_cached_listing(user_id, version, html):
+    cache.set(f"{user_id}:myfiles:{version}", html, timeout=settings.MYFILES_CACHE_TIMEOUT)
+
+
+def listing_etag(user, version, csrf_secret):
+    """ETag of a rendered listing page.
+
+    Weak, the embedded CSRF token is masked differently on every render, but
+    any of them is valid for the session.
+    """
+    digest = hashlib.sha256(
+        f"{user.id}:{user.username}:{version}:{csrf_secret}:{settings.RELEASE_ID}".encode()
+    ).hexdigest()
+    return f'W/"{digest[:32]}"'
+
@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter: this process has already imported everything
+PROBE = """
+import json, time
+started = time.perf_counter()
+import django
+from django.conf import settings
+settings_started = time.perf_counter()
+settings.INSTALLED_APPS
+settings_seconds = time.perf_counter() - settings_started
+django.setup()
+import {entrypoint}
+import {urlconf}
+from cbstg.startup import SETTINGS_TIMINGS
+print(json.dumps({{
+    "total": time.perf_counter() - started,
+    "settings": settings_seconds,
+    "settings_phases": SETTINGS_TIMINGS,
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Report import-time and settings-time breakdown of a cold start."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list.")
+        parser.add_argument("--entrypoint", default="cbstg.asgi", help="Module the server loads.")
+        parser.add_argument("--max-seconds", type=float, default=None,
+                            help="Fail when the cold start takes longer than this.")
+
+    def handle(self, *args, **options):
+        probe = PROBE.format(entrypoint=options["entrypoint"], urlconf="cbstg.urls")
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", probe],
+            capture_output=True, text=True, env=os.environ.copy(),
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Cold start probe failed:\n{result.stderr[-2000:]}")
+
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+        imports = self._parse_importtime(result.stderr)
+
+        self.stdout.write(f"Cold start: {report['total'] * 1000:.0f} ms")
+        self.stdout.write(f"  settings: {report['settings'] * 1000:.0f} ms")
+        for phase, seconds in sorted(report["settings_phases"].items(), key=lambda item: -item[1]):
+            self.stdout.write(f"    {phase:<24} {seconds * 1000:8.1f} ms")
+
+        self.stdout.write(f"Slowest imports (cumulative):")
+        for module, cumulative, own in imports[:options["top"]]:
+            self.stdout.write(f"  {module:<48} {cumulative / 1000:8.1f} ms  (self {own / 1000:.1f} ms)")
+
+        if options["max_seconds"] is not None and report["total"] > options["max_seconds"]:
+            raise CommandError(f"Cold start took {report['total']:.2f}s, budget is {options['max_seconds']:.2f}s")
+
+    @staticmethod
+    def _parse_importtime(stderr):
+        # "import time: self [us] | cumulative | imported package", nesting shown by indentation;
+        # only top-level packages are listed so nested costs are not counted twice
+        imports = []
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+            own, cumulative, module = line[len("import time:"):].split("|")
+            if module.startswith("  "):
+                continue
+            imports.append((module.strip(), int(cumulative), int(own)))
+        return sorted(imports, key=lambda item: -item[1])
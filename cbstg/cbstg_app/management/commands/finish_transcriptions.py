@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from cbstg_app.emulators import speech_client
+from cbstg_app.models import RecognitionJob
+from cbstg_app.recognition import poll, unfinished_jobs
+from cbstg_app.upstream import UpstreamUnavailable
+
+
+class Command(BaseCommand):
+    help = ("Poll running long-running recognitions once and save the finished transcripts, "
+            "jobs left finishing by a dead poller are finished again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=100, help="Poll at most this many jobs, oldest first.")
+
+    def handle(self, *args, **options):
+        client = speech_client()
+        counts = {RecognitionJob.RUNNING: 0, RecognitionJob.FINISHING: 0, RecognitionJob.DONE: 0,
+                  RecognitionJob.FAILED: 0}
+        jobs = unfinished_jobs().select_related("source__blob", "user").order_by("created_at")[:options["limit"]]
+        for job in jobs:
+            try:
+                job = poll(client, job)
+            except UpstreamUnavailable as e:
+                self.stderr.write(f"Speech API unavailable, stopping: {e}")
+                break
+            counts[job.status] = counts.get(job.status, 0) + 1
+        self.stdout.write(self.style.SUCCESS(
+            f"{counts[RecognitionJob.DONE]} finished, {counts[RecognitionJob.FAILED]} failed, "
+            f"{counts[RecognitionJob.RUNNING]} still running, "
+            f"{counts[RecognitionJob.FINISHING]} being finished elsewhere"
+        ))
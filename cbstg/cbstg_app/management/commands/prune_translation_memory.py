@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cbstg_app.translation import evict
+
+
+class Command(BaseCommand):
+    help = "Evict stale and least recently used entries from the translation memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-entries", type=int, default=settings.TRANSLATION_MEMORY_MAX_ENTRIES,
+                            help="Entries to keep, the least recently used beyond this are removed.")
+        parser.add_argument("--max-age-days", type=int, default=settings.TRANSLATION_MEMORY_MAX_AGE_DAYS,
+                            help="Remove entries not used for this many days.")
+
+    def handle(self, *args, **options):
+        expired, overflow = evict(options["max_entries"], options["max_age_days"])
+        self.stdout.write(self.style.SUCCESS(f"Removed {expired} expired and {overflow} least recently used entries"))
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from cbstg_app.models import StoredBlob, SubmittedFile
+
+
+class Command(BaseCommand):
+    help = "Delete stored blobs that no submitted file references any more."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-age", type=int, default=3600,
+                            help="Only sweep blobs created at least this many seconds ago.")
+        parser.add_argument("--recount", action="store_true",
+                            help="Recompute reference counts from submitted files first.")
+        parser.add_argument("--dry-run", action="store_true", help="List blobs without deleting them.")
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            fixed = 0
+            for blob in StoredBlob.objects.annotate(references=Count("submittedfile")):
+                if blob.ref_count != blob.references:
+                    StoredBlob.objects.filter(pk=blob.pk).update(ref_count=blob.references)
+                    fixed += 1
+            self.stdout.write(f"Corrected {fixed} reference counts")
+
+        cutoff = timezone.now() - timedelta(seconds=options["min_age"])
+        candidates = StoredBlob.objects.filter(ref_count__lte=0, created_at__lte=cutoff).values_list("pk", flat=True)
+
+        swept = freed = 0
+        for pk in list(candidates):
+            with transaction.atomic():
+                # Re-check under the row lock, an upload may have just reused the blob
+                blob = StoredBlob.objects.select_for_update().filter(pk=pk, ref_count__lte=0).first()
+                if blob is None or SubmittedFile.objects.filter(blob=blob).exists():
+                    continue
+                if not options["dry_run"]:
+                    default_storage.delete(blob.file.name)
+                    blob.delete()
+            swept += 1
+            freed += blob.size
+            self.stdout.write(f"{'Would delete' if options['dry_run'] else 'Deleted'} {blob.file.name}")
+
+        self.stdout.write(self.style.SUCCESS(f"Swept {swept} blobs, {freed} bytes"))
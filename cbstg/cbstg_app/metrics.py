@@ -0,0 +1,11 @@
+"""In-process metrics registry, served to staff users by metrics_view."""
+
+_providers = {}
+
+
+def register(name, provider):
+    _providers[name] = provider
+
+
+def snapshot():
+    return {name: provider() for name, provider in _providers.items()}
@@ -0,0 +1,81 @@
+import hashlib
+import mimetypes
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .cache_control import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, is_hashed_name
+
+
+def accepted_encodings(request):
+    return {value.split(";")[0].strip() for value in request.headers.get("Accept-Encoding", "").split(",")}
+
+
+@lru_cache(maxsize=1024)
+def _content_etag(path, mtime_ns, size):
+    """Strong ETag of a file's bytes, rehashed only when its mtime or size changes."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha256.update(chunk)
+    return f'"{sha256.hexdigest()[:32]}"'
+
+
+class PrecompressedStaticMiddleware:
+    """Serve collected static files from STATIC_ROOT when they are not in a bucket.
+
+    Picks the .br or .gz variant written by collectstatic when the client accepts
+    it, and marks hashed file names as immutable. Each variant has its own ETag,
+    revalidations of unchanged files are answered with 304 without reading them.
+    """
+
+    encodings = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Decided from settings, instantiating staticfiles_storage here would load
+        # the manifest (and storage client) during startup
+        self.enabled = settings.SERVE_STATIC_FROM_APP and bool(settings.STATIC_ROOT)
+
+    def __call__(self, request):
+        if not self.enabled or request.method not in ("GET", "HEAD") \
+                or not request.path.startswith(settings.STATIC_URL):
+            return self.get_response(request)
+
+        name = request.path[len(settings.STATIC_URL):]
+        if name.endswith(tuple(suffix for _, suffix in self.encodings)):
+            return self.get_response(request)
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            return self.get_response(request)
+        if not os.path.isfile(path):
+            return self.get_response(request)
+
+        accepted = accepted_encodings(request)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        serve_path, content_encoding = path, None
+        for encoding, suffix in self.encodings:
+            if encoding in accepted and os.path.isfile(path + suffix):
+                serve_path, content_encoding = path + suffix, encoding
+                break
+
+        stat = os.stat(serve_path)
+        etag = _content_etag(serve_path, stat.st_mtime_ns, stat.st_size)
+        response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+        if response is None:
+            response = FileResponse(open(serve_path, "rb"), content_type=content_type,
+                                    filename=os.path.basename(path))
+            if content_encoding:
+                response["Content-Encoding"] = content_encoding
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(int(stat.st_mtime))
+        response["Vary"] = "Accept-Encoding"
+        response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if is_hashed_name(name) else REVALIDATE_CACHE_CONTROL
+        return response
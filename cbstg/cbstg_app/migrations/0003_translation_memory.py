@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbstg_app', '0002_stored_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranslationMemory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sentence_hash', models.CharField(max_length=64)),
+                ('source_language', models.CharField(max_length=16)),
+                ('target_language', models.CharField(max_length=16)),
+                ('translation', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('hits', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('sentence_hash', 'target_language'), name='unique_sentence_translation')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbstg_app', '0004_usage_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='peaks',
+            field=models.BinaryField(null=True),
+        ),
+    ]
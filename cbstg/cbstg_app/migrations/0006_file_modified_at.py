@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbstg_app', '0005_blob_peaks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submittedfile',
+            name='modified_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-19 12:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbstg_app', '0006_file_modified_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='audio_info',
+            field=models.JSONField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='RecognitionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(max_length=255, unique=True)),
+                ('input_language', models.CharField(max_length=16)),
+                ('target_languages', models.CharField(max_length=100)),
+                ('status', models.CharField(db_index=True, default='running', max_length=10)),
+                ('results', models.JSONField(default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cbstg_app.submittedfile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
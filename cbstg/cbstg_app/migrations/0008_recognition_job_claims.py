@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbstg_app', '0007_recognition_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recognitionjob',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
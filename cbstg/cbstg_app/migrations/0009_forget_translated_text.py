@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """TranslatedText was removed from models.py before migrations caught up.
+
+    Only the migration state forgets it, the table and any rows in it are
+    kept. Drop it in a migration of its own once it is confirmed empty.
+    """
+
+    dependencies = [
+        ('cbstg_app', '0008_recognition_job_claims'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.DeleteModel(
+                    name='TranslatedText',
+                ),
+            ],
+        ),
+    ]
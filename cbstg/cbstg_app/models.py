@@ -1,10 +1,15 @@
+import os
+
 from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 # Create your models here.
 
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".aac", ".ogg", ".flac", ".webm")
+
 class Role(models.Model):
     role_id = models.AutoField(primary_key=True)
     role_name = models.CharField(max_length=20, unique=True)
@@ -21,7 +26,113 @@ class CustomUser(AbstractUser):
     role = models.ForeignKey(Role, on_delete=models.SET_DEFAULT, default=1)
 
 
+class StoredBlob(models.Model):
+    """File content stored once under its SHA-256, shared by every SubmittedFile with the same bytes.
+
+    ref_count is maintained by blobs.py, unreferenced blobs are removed by the
+    sweep_blobs command.
+    """
+    key = models.CharField(max_length=80, unique=True)  # <sha256><extension>
+    file = models.FileField(upload_to="blobs")
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Packed waveform summary of audio blobs, see dsp.compute_peaks
+    peaks = models.BinaryField(null=True, editable=False)
+    # soundfile header of uploaded audio, decides whether recognition.py can
+    # hand the object to the Speech API as it is
+    audio_info = models.JSONField(null=True, editable=False)
+
+
 class SubmittedFile(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     file = models.FileField(upload_to="textfiles/textsubmissions")
     creation_date = models.DateField(auto_now_add=True)
+    # Last-Modified of downloads, creation_date has no time of day
+    modified_at = models.DateTimeField(auto_now=True)
+    # Files saved before deduplication have no blob and own their storage object
+    blob = models.ForeignKey(StoredBlob, null=True, blank=True, on_delete=models.PROTECT)
+    original_name = models.CharField(max_length=255, blank=True)
+
+    @property
+    def display_name(self):
+        return self.original_name or os.path.basename(self.file.name)
+
+    @property
+    def is_audio(self):
+        return self.file.name.lower().endswith(AUDIO_EXTENSIONS)
+
+
+class RecognitionJob(models.Model):
+    """A long-running recognition of a stored recording, polled by recognition.py.
+
+    results holds the transcript per target language once the job is done,
+    each is also saved to the user's files.
+    """
+    RUNNING = "running"
+    FINISHING = "finishing"
+    DONE = "done"
+    FAILED = "failed"
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    source = models.ForeignKey(SubmittedFile, on_delete=models.CASCADE)
+    operation = models.CharField(max_length=255, unique=True)
+    input_language = models.CharField(max_length=16)
+    target_languages = models.CharField(max_length=100)  # Comma separated
+    status = models.CharField(max_length=10, default=RUNNING, db_index=True)
+    results = models.JSONField(default=dict)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When a poller moved the job to FINISHING, another one takes it over once
+    # RECOGNITION_FINISH_LEASE has passed without it being done
+    claimed_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+
+class TranslationMemory(models.Model):
+    """One translated sentence, keyed by the hash of its normalised source text and language.
+
+    Maintained by translation.py, old entries are evicted by the
+    prune_translation_memory command.
+    """
+    sentence_hash = models.CharField(max_length=64)
+    source_language = models.CharField(max_length=16)
+    target_language = models.CharField(max_length=16)
+    translation = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    hits = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["sentence_hash", "target_language"], name="unique_sentence_translation"),
+        ]
+
+
+class UsageEvent(models.Model):
+    """One billable action, written in bulk by the usage buffer in usage.py.
+
+    units depend on the action: audio seconds for "stt", characters for "tts"
+    and "translation".
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    action = models.CharField(max_length=20)
+    units = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "created_at"])]
+
+
+class DailyUsage(models.Model):
+    """Per user, action and day totals of UsageEvent, recomputed on every flush."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    action = models.CharField(max_length=20)
+    date = models.DateField()
+    count = models.IntegerField(default=0)
+    units = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "action", "date"], name="unique_daily_usage"),
+        ]
@@ -0,0 +1,67 @@
+"""Waveform peaks for the audio files in the listing.
+
+A recording is summarised once, as min/max values per bucket at a few zoom
+levels (see dsp.compute_peaks), when it is uploaded, saved from synthesis or
+transcribed. The summary lives on the file's StoredBlob, so every copy of the
+same bytes shares it, files saved before deduplication keep theirs in the
+cache. The listing then draws waveforms for all files from a single request
+of a few kilobytes instead of downloading the audio.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+from .dsp import SharedBuffer, waveform_peaks
+from .models import StoredBlob
+from .workers import PoolBusy, run_cpu_bound
+
+logger = logging.getLogger('cbstg')
+
+
+def _cache_key(submitted_file):
+    return f"peaks:file:{submitted_file.id}"
+
+
+def get_peaks(submitted_file):
+    """Return the file's packed peaks, None when they were not computed yet."""
+    if submitted_file.blob_id is None:
+        return cache.get(_cache_key(submitted_file))
+    peaks = submitted_file.blob.peaks
+    return bytes(peaks) if peaks is not None else None
+
+
+def store_peaks(submitted_file, peaks):
+    if submitted_file.blob_id is None:
+        cache.set(_cache_key(submitted_file), peaks, timeout=settings.PEAKS_CACHE_TIMEOUT)
+    else:
+        # Identical bytes give identical peaks, whoever stored them first wins
+        StoredBlob.objects.filter(pk=submitted_file.blob_id, peaks__isnull=True).update(peaks=peaks)
+
+
+def ensure_peaks(submitted_file, raw_audio=None):
+    """Compute and store peaks for an audio file that has none, return them or None.
+
+    raw_audio spares reading back a file the caller still has in memory.
+    Waveforms are cosmetic: a busy worker pool or undecodable audio only leaves
+    the file without one, the listing retries on a later visit.
+    """
+    if not submitted_file.is_audio:
+        return None
+    peaks = get_peaks(submitted_file)
+    if peaks is not None:
+        return peaks
+    try:
+        if raw_audio is None:
+            with default_storage.open(submitted_file.file.name, "rb") as audio_file:
+                raw_audio = audio_file.read()
+        with SharedBuffer(raw_audio) as shared_audio:
+            peaks = run_cpu_bound(waveform_peaks, shared_audio.name, shared_audio.size)
+    except PoolBusy:
+        return None
+    except Exception as e:
+        logger.error(f"Waveform peaks for file {submitted_file.id} failed: {e}")
+        return None
+    store_peaks(submitted_file, peaks)
+    return peaks
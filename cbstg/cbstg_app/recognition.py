@@ -0,0 +1,195 @@
+"""Long-running recognition of recordings straight from Cloud Storage.
+
+The inline path downloads a recording, decodes and re-encodes it in the worker
+pool and uploads it to the Speech API again. Recordings the API can read as
+they are (mono WAV or FLAC, see storage_uri) skip all of that:
+long_running_recognize gets the object's gs:// URI and the API fetches it
+itself. The operation runs on Google's side and a RecognitionJob remembers
+it. Every poll is one get_operation call, made by the job page while the user
+waits or by the finish_transcriptions command (run every minute by Cloud
+Scheduler) for jobs nobody is watching. A finished job translates the
+transcript and saves it to the user's files. The poller doing that holds a
+lease on the job, a job whose poller died while finishing is taken over once
+RECOGNITION_FINISH_LEASE has passed.
+"""
+import logging
+import math
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import upstream
+from .blobs import save_submitted_file
+from .langid import get_stt_language_hint, plan_translations, remember_stt_language
+from .limits import refund_limit
+from .models import RecognitionJob, StoredBlob
+from .translation import translate_texts
+from .usage import withdraw_usage
+
+logger = logging.getLogger('cbstg')
+
+# What the Speech API reads without an explicit encoding, by soundfile format
+RECOGNIZABLE_SUBTYPES = {"WAV": ("PCM_16",), "FLAC": ("PCM_16", "PCM_24")}
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+
+
+def remember_audio_format(submitted_file, info):
+    """Keep the soundfile header of an uploaded recording on its blob."""
+    if submitted_file.blob_id is None:
+        return
+    StoredBlob.objects.filter(pk=submitted_file.blob_id, audio_info__isnull=True).update(audio_info={
+        "format": info.format,
+        "subtype": info.subtype,
+        "channels": info.channels,
+        "sample_rate": info.samplerate,
+        "frames": info.frames,
+    })
+
+
+def storage_uri(submitted_file):
+    """gs:// URI to recognize the file from, None when it has to go through the inline path."""
+    if not settings.RECOGNITION_FROM_STORAGE or not settings.GS_BUCKET_NAME or submitted_file.blob_id is None:
+        return None
+    info = submitted_file.blob.audio_info
+    if not info or info["subtype"] not in RECOGNIZABLE_SUBTYPES.get(info["format"], ()):
+        return None
+    if info["channels"] != 1 or not MIN_SAMPLE_RATE <= info["sample_rate"] <= MAX_SAMPLE_RATE:
+        return None
+    return f"gs://{settings.GS_BUCKET_NAME}/{submitted_file.file.name}"
+
+
+def _lease_expiry():
+    return timezone.now() - timedelta(seconds=settings.RECOGNITION_FINISH_LEASE)
+
+
+def _stale_finishing():
+    """Jobs whose poller has held them in FINISHING for longer than the lease.
+
+    Jobs claimed before leases existed have no claimed_at and count as stale.
+    """
+    return Q(status=RecognitionJob.FINISHING) & (Q(claimed_at__lt=_lease_expiry()) | Q(claimed_at__isnull=True))
+
+
+def unfinished_jobs():
+    """Jobs a poll can move on: running, or left finishing by a poller that died."""
+    return RecognitionJob.objects.filter(Q(status=RecognitionJob.RUNNING) | _stale_finishing())
+
+
+def running_job(user, submitted_file, input_lang, target_langs):
+    """The job already recognizing the file for the same languages, a double click joins it.
+
+    Jobs stuck finishing are not joined, a new recognition is started instead.
+    """
+    return RecognitionJob.objects.filter(
+        user=user, source=submitted_file, input_language=input_lang,
+        target_languages=",".join(target_langs), status__in=(RecognitionJob.RUNNING, RecognitionJob.FINISHING),
+    ).exclude(_stale_finishing()).first()
+
+
+def recognized_seconds(submitted_file):
+    """Units of the usage event recorded when a job is charged, withdrawn when it fails."""
+    info = submitted_file.blob.audio_info
+    return math.ceil(info["frames"] / info["sample_rate"])
+
+
+def start_recognition(client, user, submitted_file, uri, input_lang, target_langs):
+    """Submit the recognition and return its RecognitionJob, the daily limit is charged by the caller."""
+    from google.cloud import speech
+
+    info = submitted_file.blob.audio_info
+    hint = get_stt_language_hint(user.id)
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding[
+            "LINEAR16" if info["format"] == "WAV" else "FLAC"],
+        sample_rate_hertz=info["sample_rate"],
+        language_code=input_lang,
+        alternative_language_codes=[hint] if hint and hint != input_lang else [],
+        enable_automatic_punctuation=True,
+    )
+    # Not idempotent, a retried submission would run (and bill) twice
+    operation = upstream.call("speech", lambda timeout: client.long_running_recognize(
+        config=config, audio=speech.RecognitionAudio(uri=uri), timeout=timeout, retry=None), idempotent=False)
+    logger.info(f"Started long-running recognition {operation.operation.name}")
+    return RecognitionJob.objects.create(
+        user=user, source=submitted_file, operation=operation.operation.name,
+        input_language=input_lang, target_languages=",".join(target_langs),
+    )
+
+
+def poll(client, job):
+    """Check a running job once and finish it when its operation is done.
+
+    A job left finishing past its lease is finished again. Returns the job,
+    refreshed. Raises UpstreamUnavailable when the Speech API cannot be
+    reached, the job then stays as it is for the next poll.
+    """
+    from google.cloud import speech
+
+    stale = job.status == RecognitionJob.FINISHING and (job.claimed_at is None or job.claimed_at < _lease_expiry())
+    if job.status != RecognitionJob.RUNNING and not stale:
+        return job
+    operation = upstream.call("speech", lambda timeout: client.transport.operations_client.get_operation(
+        job.operation, timeout=timeout))
+    if not operation.done:
+        return job
+
+    # Only one poller finishes a job, the others see it finishing until its lease expires
+    claimed_at = timezone.now()
+    if not unfinished_jobs().filter(pk=job.pk).update(status=RecognitionJob.FINISHING, claimed_at=claimed_at):
+        job.refresh_from_db()
+        return job
+    job.status, job.claimed_at = RecognitionJob.FINISHING, claimed_at
+    try:
+        if operation.HasField("error"):
+            raise RuntimeError(operation.error.message)
+        response = speech.LongRunningRecognizeResponse.deserialize(operation.response.value)
+        transcript = " ".join(result.alternatives[0].transcript for result in response.results)
+        _finish(job, transcript)
+    except Exception as e:
+        logger.error(f"Recognition {job.operation} failed: {e}")
+        if _complete(job, status=RecognitionJob.FAILED, error=f"Transcription failed: {e}"):
+            refund_limit(job.user, "daily_stt")
+            withdraw_usage(job.user_id, "stt", recognized_seconds(job.source), since=job.created_at)
+    return job
+
+
+def _complete(job, **fields):
+    """Mark a claimed job done or failed, False when another poller has taken it over meanwhile."""
+    fields["finished_at"] = timezone.now()
+    if not RecognitionJob.objects.filter(pk=job.pk, status=RecognitionJob.FINISHING, claimed_at=job.claimed_at) \
+            .update(**fields):
+        logger.info(f"Recognition {job.operation} was taken over by another poller")
+        job.refresh_from_db()
+        return False
+    for name, value in fields.items():
+        setattr(job, name, value)
+    return True
+
+
+def _finish(job, transcript):
+    """Translate the transcript, save it for the user and mark the job done."""
+    source = job.source
+    targets = job.target_languages.split(",")
+
+    plans = plan_translations(transcript, job.input_language, targets)
+    remember_stt_language(job.user_id, job.input_language, plans[targets[0]].detected)
+    translations = translate_texts(transcript, plans, user_id=job.user_id)
+
+    stem = os.path.splitext(source.display_name)[0]
+    with transaction.atomic():
+        # The files are only saved by the poller still holding the job
+        if not _complete(
+            job, status=RecognitionJob.DONE,
+            results={language: text for language, (text, _) in translations.items()},
+            error="".join(error for _, error in translations.values() if error).strip(),
+        ):
+            return
+        for language, (text, _) in translations.items():
+            filename = f"{stem}.txt" if len(targets) == 1 else f"{stem}.{language}.txt"
+            save_submitted_file(job.user, filename, ContentFile(text.encode()))
@@ -0,0 +1,161 @@
+"""Synthesized audio renditions negotiated per client.
+
+Text-to-Speech is asked once per (text, voice) for MP3, the master rendition
+that is kept when the user saves the audio. The master is written to storage
+under tts/ right away, so any instance can play or save it, and the page only
+carries a signed token for it. The bucket deletes tts/ objects after a day,
+saving copies the master into the user's files. Its <audio> element lists one
+source per codec and the browser fetches the first it can play from
+synthesized_audio, client hints then pick the normal or the low-bitrate
+rendition. Smaller renditions are transcoded from the master in the worker
+pool when first requested and cached under the master's digest.
+"""
+import hashlib
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.signing import BadSignature, Signer
+from django.urls import reverse
+
+from .dsp import SharedBuffer, transcode
+from .workers import run_cpu_bound
+
+logger = logging.getLogger('cbstg')
+
+AudioProfile = namedtuple("AudioProfile", "content_type container subtype sample_rate compression_level")
+
+MASTER_PROFILE = "mp3"
+# Google returns 32 kbps MP3, the others come to roughly 16-24 kbps
+PROFILES = {
+    "mp3": AudioProfile("audio/mpeg", None, None, None, None),
+    "mp3-low": AudioProfile("audio/mpeg", "MP3", "MPEG_LAYER_III", 16000, 0.95),
+    "opus": AudioProfile("audio/ogg", "OGG", "OPUS", 24000, 0.94),
+    "opus-low": AudioProfile("audio/ogg", "OGG", "OPUS", 16000, 0.97),
+}
+
+# Sent back in Accept-CH so browsers include them in later requests
+CLIENT_HINTS = "Save-Data, ECT, Downlink"
+SLOW_CONNECTION_TYPES = {"slow-2g", "2g", "3g"}
+SLOW_DOWNLINK_MBPS = 1.0
+
+# Browsers fetch the first <source> whose type they can play
+CODECS = {"opus": "audio/ogg; codecs=opus", "mp3": "audio/mpeg"}
+MASTER_EXTENSION = ".mp3"
+
+_signer = Signer(salt="cbstg.renditions.master")
+
+
+def requested_profile(request):
+    """The profile picked with ?format=, remembered for the session, None lets the browser choose."""
+    requested = request.GET.get("format")
+    if requested in PROFILES:
+        request.session["audio_format"] = requested
+        return requested
+    remembered = request.session.get("audio_format")
+    return remembered if remembered in PROFILES else None
+
+
+def choose_profile(request, codec):
+    """Pick the rendition in codec ("mp3" or "opus") for an audio request.
+
+    A profile picked with ?format= wins, otherwise slow or data-saving clients
+    get the low-bitrate rendition of the codec.
+    """
+    requested = requested_profile(request)
+    if requested is not None:
+        return requested
+
+    try:
+        downlink = float(request.headers.get("Downlink", ""))
+    except ValueError:
+        downlink = None
+    slow = request.headers.get("Save-Data", "").lower() == "on" \
+        or request.headers.get("ECT", "").lower() in SLOW_CONNECTION_TYPES \
+        or (downlink is not None and downlink < SLOW_DOWNLINK_MBPS)
+    return f"{codec}-low" if slow else codec
+
+
+def audio_sources(token, profile=None):
+    """<source> elements for a master, Opus first, only profile's codec when one was picked."""
+    codecs = [profile.split("-")[0]] if profile else list(CODECS)
+    return [{"src": reverse("synthesized_audio", args=[token, codec]), "type": CODECS[codec]} for codec in codecs]
+
+
+def rendition_key(text, voice):
+    digest = hashlib.sha256(f"{voice}\n{text}".encode()).hexdigest()
+    return f"tts:{digest}:{MASTER_PROFILE}"
+
+
+def get_master(key):
+    """Cached master audio of a rendition_key, None when unknown or expired."""
+    return cache.get(key)
+
+
+def store_master(key, audio):
+    cache.set(key, audio, timeout=settings.TTS_CACHE_TIMEOUT)
+
+
+def _master_name(digest):
+    return f"tts/{digest[:2]}/{digest}{MASTER_EXTENSION}"
+
+
+def persist_master(audio):
+    """Write the master to storage, once per content, and return its token for the page."""
+    digest = hashlib.sha256(audio).hexdigest()
+    if not default_storage.exists(_master_name(digest)):
+        default_storage.save(_master_name(digest), ContentFile(audio))
+    return _signer.sign(digest)
+
+
+def master_digest(token):
+    """Digest of the master a token was issued for, None when it was not issued here."""
+    try:
+        return _signer.unsign(token or "")
+    except BadSignature:
+        return None
+
+
+def load_master(digest):
+    """The persisted master audio, None when it has expired."""
+    if not default_storage.exists(_master_name(digest)):
+        return None
+    with default_storage.open(_master_name(digest), "rb") as master_file:
+        return master_file.read()
+
+
+def get_rendition(digest, profile):
+    """Return (audio, content type) of the master in profile, transcoding it on first use.
+
+    Returns None when the master has expired. Falls back to the master while the
+    worker pool is busy or the master cannot be decoded, a bigger download is
+    better than an error.
+    """
+    key = f"tts:{digest}:{profile}"
+    audio = cache.get(key) if profile != MASTER_PROFILE else None
+    if audio is not None:
+        return audio, PROFILES[profile].content_type
+
+    master = load_master(digest)
+    if master is None:
+        return None
+    if profile == MASTER_PROFILE:
+        return master, PROFILES[MASTER_PROFILE].content_type
+
+    target = PROFILES[profile]
+    try:
+        with SharedBuffer(master) as shared_master:
+            name, size = run_cpu_bound(
+                transcode, shared_master.name, shared_master.size,
+                target.container, target.subtype, target.sample_rate, target.compression_level,
+            )
+    except Exception as e:
+        logger.info(f"Serving the master instead of {profile}: {e}")
+        return master, PROFILES[MASTER_PROFILE].content_type
+    with SharedBuffer(name=name) as encoded:
+        audio = bytes(encoded.shm.buf[:size])
+    cache.set(key, audio, timeout=settings.TTS_CACHE_TIMEOUT)
+    return audio, target.content_type
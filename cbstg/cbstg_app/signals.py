@@ -1,51 +1,60 @@
-from django.db.models.signals import post_migrate
-from django.dispatch import receiver
-from .models import Role
-from django.db.models.signals import post_save
-from django.contrib.auth import get_user_model
-
-User = get_user_model()
-
-@receiver(post_migrate)
-def create_default_roles(sender, **kwargs):
-    roles = [
-        {
-            'role_name': 'Free'
-        },
-        {
-            'role_name': 'Premium',
-            'daily_tts_limit': 10,
-            'daily_stt_limit': 10,
-            'char_limit': 450,
-            'audio_duration_limit': 45
-        },
-        {
-            'role_name': 'Enterprise',
-            'daily_tts_limit': 20,
-            'daily_stt_limit': 20,
-            'char_limit': 600,
-            'audio_duration_limit': 60
-        },
-        {
-            'role_name': 'Admin',
-            'daily_tts_limit': 999999,
-            'daily_stt_limit': 999999,
-            'char_limit': 600,
-            'audio_duration_limit': 60
-        },
-    ]
-
-    for role_data in roles:
-        Role.objects.update_or_create(role_name=role_data['role_name'], defaults=role_data)
-
-
-@receiver(post_save, sender=User)
-def assign_admin_role_to_superuser(sender, instance, created, **kwargs):
-    if instance.is_superuser:
-        try:
-            admin_role = Role.objects.get(role_name='Admin')
-            if instance.role != admin_role:
-                instance.role = admin_role
-                instance.save(update_fields=['role'])
-        except Role.DoesNotExist:
-            pass
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from .blobs import release_blob
+from .models import Role, SubmittedFile
+from django.db.models.signals import post_delete, post_save
+from django.contrib.auth import get_user_model
+
+User = get_user_model()
+
+@receiver(post_migrate)
+def create_default_roles(sender, **kwargs):
+    roles = [
+        {
+            'role_name': 'Free'
+        },
+        {
+            'role_name': 'Premium',
+            'daily_tts_limit': 10,
+            'daily_stt_limit': 10,
+            'char_limit': 450,
+            'audio_duration_limit': 45
+        },
+        {
+            'role_name': 'Enterprise',
+            'daily_tts_limit': 20,
+            'daily_stt_limit': 20,
+            'char_limit': 600,
+            'audio_duration_limit': 60
+        },
+        {
+            'role_name': 'Admin',
+            'daily_tts_limit': 999999,
+            'daily_stt_limit': 999999,
+            'char_limit': 600,
+            'audio_duration_limit': 60
+        },
+    ]
+
+    for role_data in roles:
+        Role.objects.update_or_create(role_name=role_data['role_name'], defaults=role_data)
+
+
+@receiver(post_save, sender=User)
+def assign_admin_role_to_superuser(sender, instance, created, update_fields=None, **kwargs):
+    if not instance.is_superuser:
+        return
+    # Partial saves that touch neither flag (e.g. last_login on every login) cannot
+    # change the outcome, skip the role lookup for them
+    if update_fields is not None and not {'role', 'is_superuser'} & set(update_fields):
+        return
+    admin_role_id = Role.objects.filter(role_name='Admin').values_list('role_id', flat=True).first()
+    if admin_role_id is not None and instance.role_id != admin_role_id:
+        instance.role_id = admin_role_id
+        instance.save(update_fields=['role'])
+
+
+@receiver(post_delete, sender=SubmittedFile)
+def release_blob_reference(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        release_blob(instance.blob_id)
@@ -0,0 +1,136 @@
+"""Coalesce identical concurrent operations onto one execution.
+
+The first caller for a key (the leader) runs the operation, callers arriving
+while it runs (followers) wait for its result or exception instead of
+repeating the download, processing and API call. Keys are tuples whose first
+item names the operation, e.g. ("transcribe", user id, content, languages).
+
+With SINGLEFLIGHT_SHARED the leader also holds a lock in the cache, so
+leaders in other processes sharing that cache (Redis, Memcached) are joined
+too. Their results reach followers through the cache, exceptions do not: when
+a remote leader fails, a waiting follower takes over as leader.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger('cbstg')
+
+LOCK_TIMEOUT = 300
+POLL_INTERVAL = 0.1
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = Counter()
+
+    def do(self, key, fn):
+        """Run fn once for concurrent callers with the same key, returns (result, leader).
+
+        Only callers that get leader=True ran fn, followers were served the
+        leader's result and must not be charged for it.
+        """
+        operation = key[0]
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(settings.SINGLEFLIGHT_WAIT):
+                self._count(operation, "followers")
+                if call.error is not None:
+                    raise call.error
+                return call.result, False
+            # The leader is stuck, do not hold this request hostage to it
+            self._count(operation, "wait_timeouts")
+            return fn(), True
+
+        try:
+            if settings.SINGLEFLIGHT_SHARED:
+                call.result, leader = self._do_shared(key, fn)
+            else:
+                call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        self._count(operation, "leaders" if leader else "shared_followers")
+        return call.result, leader
+
+    def _do_shared(self, key, fn):
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        lock_key = f"singleflight:{digest}:lock"
+        deadline = time.monotonic() + settings.SINGLEFLIGHT_WAIT
+
+        while True:
+            token = uuid.uuid4().hex
+            if cache.add(lock_key, token, timeout=LOCK_TIMEOUT):
+                try:
+                    result = fn()
+                    # Keyed by this flight's token, a later request never sees it
+                    cache.set(f"singleflight:{digest}:{token}", result, timeout=60)
+                    return result, True
+                finally:
+                    cache.delete(lock_key)
+
+            leader_token = cache.get(lock_key)
+            while leader_token is not None and time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                result = cache.get(f"singleflight:{digest}:{leader_token}", _MISSING)
+                if result is not _MISSING:
+                    return result, False
+                if cache.get(lock_key) != leader_token:
+                    # Leader finished, check its result once more before trying to lead
+                    result = cache.get(f"singleflight:{digest}:{leader_token}", _MISSING)
+                    if result is not _MISSING:
+                        return result, False
+                    break
+            if time.monotonic() >= deadline:
+                self._count(key[0], "wait_timeouts")
+                return fn(), True
+
+    def _count(self, operation, event):
+        with self._lock:
+            self._stats[f"{operation}.{event}"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_MISSING = object()
+
+single_flight = SingleFlight()
+
+
+def content_id(submitted_file):
+    """Identity of a submitted file's bytes, deduplicated blobs share it across files."""
+    if submitted_file.blob_id is not None:
+        return f"blob:{submitted_file.blob_id}"
+    return f"file:{submitted_file.file.name}"
+
+
+metrics.register("singleflight", single_flight.stats)
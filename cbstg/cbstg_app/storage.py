@@ -0,0 +1,194 @@
+import gzip
+import mimetypes
+import shutil
+import zlib
+from tempfile import SpooledTemporaryFile
+
+from django.contrib.staticfiles.storage import ManifestFilesMixin, ManifestStaticFilesStorage
+from django.core.files.base import ContentFile, File
+from storages.backends.gcloud import GoogleCloudStorage
+from storages.utils import clean_name, setting
+
+from .cache_control import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, is_hashed_name
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped, gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # TEXT_COMPRESSION = "zstd" falls back to gzip
+    zstandard = None
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".mjs", ".svg", ".txt", ".html", ".json", ".map", ".xml")
+
+# Submitted files stored compressed by TextCompressionMixin
+TEXT_EXTENSIONS = (".txt",)
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def compressed_variants(data):
+    """Yield (suffix, content encoding, bytes) for every encoding that actually saves space."""
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        yield ".gz", "gzip", gzipped
+    if brotli is not None:
+        brotlied = brotli.compress(data, quality=11)
+        if len(brotlied) < len(data):
+            yield ".br", "br", brotlied
+
+
+class PrecompressMixin:
+    """Write .gz/.br siblings of every collected text asset after hashing."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        names = set(self.hashed_files) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            with self.open(name) as original:
+                data = original.read()
+            for suffix, encoding, compressed in compressed_variants(data):
+                self.save_variant(name, suffix, encoding, compressed)
+
+
+class CompressedManifestStaticFilesStorage(PrecompressMixin, ManifestStaticFilesStorage):
+
+    def save_variant(self, name, suffix, encoding, data):
+        if self.exists(name + suffix):
+            self.delete(name + suffix)
+        self._save(name + suffix, ContentFile(data))
+
+
+class CompressedManifestGoogleCloudStorage(PrecompressMixin, ManifestFilesMixin, GoogleCloudStorage):
+    """Static files bucket with hashed names and far-future caching.
+
+    Text objects are stored gzip-encoded (enable the ``gzip`` option), GCS
+    transcodes them for clients without gzip support. Brotli copies are uploaded
+    next to them as ``<name>.br`` with ``Content-Encoding: br`` for CDNs that can
+    pick a variant by Accept-Encoding.
+    """
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        params.setdefault(
+            "cache_control", IMMUTABLE_CACHE_CONTROL if is_hashed_name(name) else REVALIDATE_CACHE_CONTROL
+        )
+        return params
+
+    def save_variant(self, name, suffix, encoding, data):
+        content_type = mimetypes.guess_type(name)[0]
+        if encoding == "gzip" and self.gzip and content_type in self.gzip_content_types:
+            # The object itself is already stored gzip-encoded
+            return
+        blob = self.bucket.blob(self._normalize_name(name + suffix))
+        blob.content_encoding = encoding
+        blob.cache_control = self.get_object_parameters(name)["cache_control"]
+        blob.upload_from_string(data, content_type=content_type)
+
+
+class TextCompressionMixin:
+    """Store text files gzip or zstd compressed and decompress them again on open.
+
+    Objects are recognised by their magic number when read, so objects stored
+    before compression was enabled are returned as they are.
+    """
+
+    text_compression = "gzip"
+    max_memory_size = 0
+
+    def text_codec(self, name):
+        if not self.text_compression or not name.lower().endswith(TEXT_EXTENSIONS):
+            return None
+        if self.text_compression == "zstd" and zstandard is not None:
+            return "zstd"
+        return "gzip"
+
+    def _save(self, name, content):
+        codec = self.text_codec(name)
+        if codec == "zstd":
+            content = ContentFile(zstandard.ZstdCompressor(level=10).compress(b"".join(content.chunks())))
+        elif codec == "gzip":
+            content = ContentFile(gzip.compress(b"".join(content.chunks()), compresslevel=9, mtime=0))
+        return super()._save(name, content)
+
+    def _open(self, name, mode="rb"):
+        stored = super()._open(name, mode)
+        if "r" not in mode or not name.lower().endswith(TEXT_EXTENSIONS):
+            return stored
+
+        magic = stored.read(4)
+        stored.seek(0)
+        if magic.startswith(ZSTD_MAGIC) and zstandard is not None:
+            reader = zstandard.ZstdDecompressor().stream_reader(stored)
+        elif magic.startswith(GZIP_MAGIC):
+            reader = gzip.GzipFile(fileobj=stored, mode="rb")
+        else:
+            return stored
+
+        decompressed = SpooledTemporaryFile(max_size=self.max_memory_size)
+        with reader:
+            shutil.copyfileobj(reader, decompressed)
+        stored.close()
+        decompressed.seek(0)
+        return File(decompressed, name=name)
+
+    def _open_stream(self, name, chunk_size):
+        """Readable file over the object's stored bytes, compressed or not."""
+        return super()._open(name, "rb")
+
+    def iter_chunks(self, name, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield a file's bytes chunk by chunk, text decompressed as it is read.
+
+        Unlike open(), nothing is downloaded ahead or spooled, only a chunk at a
+        time is held in memory.
+        """
+        with self._open_stream(name, chunk_size) as stored:
+            first = stored.read(chunk_size)
+            decompressor = None
+            if name.lower().endswith(TEXT_EXTENSIONS):
+                if first.startswith(ZSTD_MAGIC) and zstandard is not None:
+                    decompressor = zstandard.ZstdDecompressor().decompressobj()
+                elif first.startswith(GZIP_MAGIC):
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            chunk = first
+            while chunk:
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+                chunk = stored.read(chunk_size)
+
+
+class CompressedTextGoogleCloudStorage(TextCompressionMixin, GoogleCloudStorage):
+    """Media bucket storing .txt objects with ``Content-Encoding: gzip`` or ``zstd``.
+
+    Google's client already decodes gzip on download and GCS transcodes it for
+    clients that do not accept gzip. Neither handles zstd, that is decoded in
+    ``_open`` and for downloads by ``download_submitted``.
+    """
+
+    def get_default_settings(self):
+        return {**super().get_default_settings(), "text_compression": setting("TEXT_COMPRESSION", "gzip")}
+
+    def _open_stream(self, name, chunk_size):
+        # Ranged reads of the object as stored, the client would otherwise
+        # transcode gzip objects and GCS ignores ranges when it does
+        blob = self.bucket.blob(self._normalize_name(clean_name(name)))
+        return blob.open("rb", chunk_size=chunk_size, raw_download=True)
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        codec = self.text_codec(name)
+        if codec:
+            params.setdefault("content_encoding", codec)
+        return params
@@ -0,0 +1,26 @@
+"""Streaming response bodies under ASGI.
+
+Django serves a StreamingHttpResponse built on a sync iterator by reading the
+iterator to its end first (sync_to_async(list)), so nothing reaches the client
+before the last chunk. Streaming views wrap their generator in
+stream_in_thread(), which hands it to the server one chunk at a time.
+"""
+from asgiref.sync import sync_to_async
+
+_DONE = object()
+
+
+async def stream_in_thread(iterable):
+    """Async iterator over a sync iterable, every step runs in the request's thread.
+
+    The sync iterator is closed when the client goes away, so its cleanup runs
+    right away instead of at garbage collection.
+    """
+    iterator = iter(iterable)
+    step = sync_to_async(next)
+    try:
+        while (chunk := await step(iterator, _DONE)) is not _DONE:
+            yield chunk
+    finally:
+        if hasattr(iterator, "close"):
+            await sync_to_async(iterator.close)()
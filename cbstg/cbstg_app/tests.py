@@ -1,3 +1,1500 @@
-from django.test import TestCase
+import base64
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage, default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.utils import ConnectionHandler
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver, reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from cbstg import startup
+
+from . import recognition, usage, workers
+from .blobs import save_submitted_file
+from .cache_control import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, is_hashed_name
+from .db import database_stats
+from .dsp import PEAK_BUCKETS, SharedBuffer, compute_peaks, extract_pdf_text, prepare_for_recognition, \
+    split_at_pauses, unpack_peaks
+from .emulators import FaultInjectingClient, speech_client
+from .langid import TranslationPlan, detect, plan_translation
+from .limits import _get_cache_key, initialize_limit_if_needed
+from .listing import get_listing_version
+from .middleware import PrecompressedStaticMiddleware
+from .models import DailyUsage, RecognitionJob, Role, StoredBlob, SubmittedFile, TranslationMemory, UsageEvent
+from .recognition import running_job
+from .renditions import choose_profile, requested_profile
+from .singleflight import SingleFlight
+from .storage import GZIP_MAGIC, ZSTD_MAGIC, CompressedTextGoogleCloudStorage, TextCompressionMixin, zstandard
+from .streaming import stream_in_thread
+from .translation import TranslationBatcher, evict, translate_with_memory
+from .upstream import DeadlineExceeded, UpstreamUnavailable, call, deadline, upstream_stats
+from .workers import PoolBusy, pool_stats, run_cpu_bound
+
+
+class PersistentConnectionTests(unittest.TestCase):
+    """Connection reuse checked against a throwaway SQLite file, no PostgreSQL needed.
+
+    A plain TestCase: SimpleTestCase forbids connecting on every DatabaseWrapper.
+    """
+
+    def _probe_connection(self, conn_max_age):
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        handler = ConnectionHandler({
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": path,
+                "CONN_MAX_AGE": conn_max_age,
+                "CONN_HEALTH_CHECKS": True,
+            }
+        })
+        connection = handler["default"]
+        self.addCleanup(connection.close)
+        return connection
+
+    def _count_connects(self, connection, requests):
+        created = []
+
+        def on_created(sender, connection, **kwargs):
+            created.append(connection)
+
+        connection_created.connect(on_created)
+        self.addCleanup(connection_created.disconnect, on_created)
+
+        for _ in range(requests):
+            # What request_started/request_finished do through close_old_connections()
+            connection.close_if_unusable_or_obsolete()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.close_if_unusable_or_obsolete()
+        return len(created)
+
+    def test_connection_reused_across_requests(self):
+        connection = self._probe_connection(conn_max_age=60)
+        self.assertEqual(self._count_connects(connection, requests=5), 1)
+
+    def test_connection_per_request_without_max_age(self):
+        connection = self._probe_connection(conn_max_age=0)
+        self.assertEqual(self._count_connects(connection, requests=5), 5)
+
+    def test_stats_without_pool(self):
+        stats = database_stats()
+        self.assertFalse(stats["pooled"])
+        self.assertTrue(stats["health_checks"])
+
+
+Budget = namedtuple("Budget", "queries seconds")
+
+# Every named route has a budget, test_every_route_has_a_budget keeps this in sync
+# with the URLconfs. Query counts are exact figures for the request in the view
+# tests (ViewTestCase), raise them only together with the change that needs it.
+VIEW_BUDGETS = {
+    "index": Budget(queries=2, seconds=0.5),
+    "login_view": Budget(queries=9, seconds=0.5),
+    "logout_view": Budget(queries=4, seconds=0.5),
+    "register_view": Budget(queries=0, seconds=0.5),
+    "notes_view": Budget(queries=4, seconds=0.5),
+    "save_file": Budget(queries=9, seconds=0.5),
+    "download_submitted": Budget(queries=3, seconds=0.5),
+    "transcribe_audio": Budget(queries=6, seconds=2.0),
+    "transcribe_stream": Budget(queries=6, seconds=2.0),
+    "transcription_job": Budget(queries=16, seconds=1.0),
+    "delete_file": Budget(queries=5, seconds=0.5),
+    "export_files": Budget(queries=3, seconds=0.5),
+    "file_peaks": Budget(queries=3, seconds=0.5),
+    "synthesize_speech": Budget(queries=4, seconds=0.5),
+    "synthesized_audio": Budget(queries=2, seconds=1.0),
+    "save_synthesized_audio": Budget(queries=9, seconds=0.5),
+    "live_transcription": Budget(queries=2, seconds=0.5),
+    "change_role": Budget(queries=4, seconds=0.5),
+    "metrics": Budget(queries=2, seconds=0.5),
+}
+
+# Django's own admin site is not budgeted
+UNBUDGETED_NAMESPACES = {"admin"}
+
+
+def _normalize_sql(sql):
+    return re.sub(r"\b\d+\b|'[^']*'", "?", sql)
+
+
+def budget_report(name, budget, queries):
+    """Executed SQL as a diff against the budget: queries past the limit are "+" lines."""
+    lines = [f"--- {name}: budget {budget.queries} queries", f"+++ {name}: executed {len(queries)} queries"]
+    for i, query in enumerate(queries):
+        lines.append(f"{'+' if i >= budget.queries else ' '} {query['sql']}")
+
+    repeated = Counter(_normalize_sql(query["sql"]) for query in queries)
+    repeated = [(count, sql) for sql, count in repeated.items() if count > 1]
+    if repeated:
+        lines.append("Repeated statements (N+1 candidates):")
+        lines.extend(f"  {count}x {sql}" for count, sql in sorted(repeated, reverse=True))
+    return "\n".join(lines)
+
+
+def _route_names(patterns, namespace=None):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace in UNBUDGETED_NAMESPACES:
+                continue
+            yield from _route_names(pattern.url_patterns, pattern.namespace or namespace)
+        elif pattern.name:
+            yield f"{namespace}:{pattern.name}" if namespace else pattern.name
+
+
+def _wav_bytes(seconds=1.0, sample_rate=16000):
+    import numpy as np
+    import soundfile as sf
+
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    buffer = io.BytesIO()
+    sf.write(buffer, 0.5 * np.sin(2 * np.pi * 220 * t), sample_rate, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def _recording(*parts):
+    """Concatenate ("speech" | "silence", seconds) parts at 16 kHz."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    audio = []
+    for kind, seconds in parts:
+        n = int(seconds * 16000)
+        if kind == "speech":
+            audio.append(0.5 * np.sin(2 * np.pi * 220 * np.arange(n) / 16000))
+        else:
+            audio.append(0.001 * rng.standard_normal(n))
+    return np.concatenate(audio).astype(np.float32)
+
+
+def _streamed_body(response):
+    """Body of a streaming response, the way the ASGI server consumes it."""
+    if not response.is_async:
+        return b"".join(response.streaming_content)
+
+    async def collect():
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    return async_to_sync(collect)()
+
+
+@contextmanager
+def fake_google_clients():
+    """Stand-ins for the Cloud Storage, Text-to-Speech and Translation clients.
+
+    Speech-to-Text goes through the local emulator (SPEECH_EMULATOR).
+    """
+    from google.cloud import texttospeech
+
+    with mock.patch("google.cloud.storage.Client") as storage_client, \
+            mock.patch("google.cloud.texttospeech.TextToSpeechClient") as tts_client, \
+            mock.patch("google.cloud.translate_v2.Client") as translate_client:
+        blob = storage_client.return_value.bucket.return_value.blob.return_value
+        blob.generate_signed_url.return_value = "https://storage.example/signed"
+        tts_client.return_value.synthesize_speech.return_value = texttospeech.SynthesizeSpeechResponse(
+            audio_content=b"ID3 fake mp3"
+        )
+        translate_client.return_value.translate.side_effect = lambda values, target_language, **kwargs: [
+            {"translatedText": f"[{target_language}] {value}"} for value in values
+        ]
+        yield
+
+
+@override_settings(
+    STORAGES={
+        "default": {"BACKEND": "cbstg_app.tests.CompressedTextInMemoryStorage"},
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "budgets"}},
+    SERVICE_NAME=None,
+    GS_BUCKET_NAME="bucket",
+    GS_CREDENTIALS=None,
+    SPEECH_EMULATOR=True,
+    DSP_POOL_ENABLED=False,
+    SERVE_STATIC_FROM_APP=False,
+    USAGE_FLUSH_INTERVAL=0,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class ViewTestCase(TestCase):
+    """Base of the view tests: a logged-in user with one recording and one note, Google APIs faked.
+
+    Every view has a query-count and wall-time budget in VIEW_BUDGETS, checked
+    with assertWithinBudget.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # One-time import costs are paid at worker start in production, not per request
+        for module in ("numpy", "scipy.signal", "soundfile", "google.cloud.speech", "cbstg_app.vad"):
+            importlib.import_module(module)
+
+    def setUp(self):
+        cache.clear()
+        # Buffered usage is written inside the test transaction and rolled back with it
+        self.addCleanup(usage.flush)
+        self.user = get_user_model().objects.create_user("budget", password="secret")
+        self.client.force_login(self.user)
+        self.audio = self.add_file("recording.wav", _wav_bytes())
+        self.text = self.add_file("note.txt", b"Hello budgets")
+
+    def add_file(self, name, data):
+        return SubmittedFile.objects.create(user=self.user, file=ContentFile(data, name=name), original_name=name)
+
+    def upload(self, name, data):
+        """Submit a file through the upload view and return it."""
+        self.client.post(reverse("save_file"), {"file": ContentFile(data, name=name)})
+        return SubmittedFile.objects.get(user=self.user, original_name=name)
+
+    def assertWithinBudget(self, name, request, *args, **kwargs):
+        budget = VIEW_BUDGETS[name]
+        with fake_google_clients(), CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = request(*args, **kwargs)
+            elapsed = time.perf_counter() - started
+
+        if len(context.captured_queries) > budget.queries:
+            self.fail("Query budget exceeded\n" + budget_report(name, budget, context.captured_queries))
+        self.assertLessEqual(elapsed, budget.seconds, f"{name} took {elapsed:.3f}s, budget {budget.seconds}s")
+        return response
+
+
+class RouteBudgetTests(ViewTestCase):
+    """Budgets of the account, role and status pages, and the budget table itself."""
+
+    def test_every_route_has_a_budget(self):
+        routes = set(_route_names(get_resolver().url_patterns))
+        self.assertEqual(routes - set(VIEW_BUDGETS), set(), "Routes without a budget")
+        self.assertEqual(set(VIEW_BUDGETS) - routes, set(), "Budgets for removed routes")
+
+    def test_index(self):
+        self.assertWithinBudget("index", self.client.get, reverse("index"))
+
+    def test_login(self):
+        self.client.logout()
+        response = self.assertWithinBudget(
+            "login_view", self.client.post, reverse("login_view"), {"username": "budget", "password": "secret"}
+        )
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+
+    def test_logout(self):
+        self.assertWithinBudget("logout_view", self.client.get, reverse("logout_view"))
+
+    def test_register(self):
+        self.client.logout()
+        self.assertWithinBudget("register_view", self.client.get, reverse("register_view"))
+
+    def test_live_transcription(self):
+        self.assertWithinBudget("live_transcription", self.client.get, reverse("live_transcription"))
+
+    def test_change_role(self):
+        premium = Role.objects.get(role_name="Premium")
+        self.assertWithinBudget("change_role", self.client.get, reverse("change_role"))
+        self.assertWithinBudget("change_role", self.client.post, reverse("change_role"), {"role": premium.pk})
+
+    def test_metrics(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertWithinBudget("metrics", self.client.get, reverse("metrics"))
+
+    def test_superuser_login_skips_role_lookup(self):
+        admin = get_user_model().objects.create_superuser("root", password="secret")
+        self.assertEqual(admin.role.role_name, "Admin")
+        with self.assertNumQueries(1):
+            admin.save(update_fields=["last_login"])
+
+
+class FileListingViewTests(ViewTestCase):
+    """Uploads, the listing, deletes and waveform peaks."""
+
+    def test_notes(self):
+        for _ in range(3):
+            self.add_file("more.txt", b"more")
+        response = self.assertWithinBudget("notes_view", self.client.get, reverse("notes_view"))
+        self.assertContains(response, "recording")
+
+    def test_submit_file(self):
+        upload = ContentFile(b"Short note", name="upload.txt")
+        response = self.assertWithinBudget("save_file", self.client.post, reverse("save_file"), {"file": upload})
+        self.assertRedirects(response, reverse("notes_view"), fetch_redirect_response=False)
+
+    def test_unchanged_listing_is_not_modified(self):
+        etag = self.client.get(reverse("notes_view"))["ETag"]
+        with self.assertNumQueries(3):  # Session, user and listing version
+            response = self.client.get(reverse("notes_view"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.add_file("new.txt", b"new")
+        response = self.client.get(reverse("notes_view"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_delete_file(self):
+        self.assertWithinBudget("delete_file", self.client.post, reverse("delete_file", args=[self.text.pk]))
+        self.assertFalse(SubmittedFile.objects.filter(pk=self.text.pk).exists())
+
+    def test_file_peaks(self):
+        response = self.assertWithinBudget(
+            "file_peaks", self.client.get, reverse("file_peaks"), {"file_id": [self.audio.pk, self.text.pk]}
+        )
+        files = response.json()["files"]
+        self.assertEqual(list(files), [str(self.audio.pk)])
+        self.assertEqual(files[str(self.audio.pk)]["duration"], 1.0)
+        self.assertEqual(len(base64.b64decode(files[str(self.audio.pk)]["peaks"])), 2 * 64)
+        # Computed on the first request, cached by the browser from then on
+        self.assertIn("max-age", response["Cache-Control"])
+        self.assertEqual(self.client.get(reverse("file_peaks"), {"buckets": "100"}).status_code, 400)
+
+    def test_uploaded_audio_gets_peaks(self):
+        with fake_google_clients():
+            blob = self.upload("upload.wav", _wav_bytes()).blob
+        duration, levels = unpack_peaks(blob.peaks)
+        self.assertEqual(duration, 1.0)
+        self.assertEqual(sorted(levels), list(PEAK_BUCKETS))
+
+
+class DownloadViewTests(ViewTestCase):
+    """Single downloads and ZIP exports."""
+
+    def test_download_submitted(self):
+        response = self.assertWithinBudget(
+            "download_submitted", self.client.get, reverse("download_submitted", args=[self.text.pk])
+        )
+        self.assertEqual(response["Location"], "https://storage.example/signed")
+
+    def test_redirected_download_carries_no_validators(self):
+        etag = f'"{hashlib.sha256(b"Hello budgets").hexdigest()}"'
+        with fake_google_clients():
+            response = self.client.get(reverse("download_submitted", args=[self.text.pk]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("Last-Modified", response)
+
+    def test_unchanged_decompressed_download_is_not_modified(self):
+        with mock.patch("google.cloud.storage.Client") as storage_client, \
+                mock.patch.object(default_storage, "text_codec", return_value="zstd"):
+            blob = storage_client.return_value.bucket.return_value.blob.return_value
+            blob.generate_signed_url.return_value = "https://storage.example/signed"
+            response = self.client.get(reverse("download_submitted", args=[self.text.pk]))
+            self.assertEqual(b"".join(response.streaming_content), b"Hello budgets")
+            etag = response["ETag"]
+            response = self.client.get(reverse("download_submitted", args=[self.text.pk]), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+            # Zstd-accepting clients are redirected to the object as stored
+            response = self.client.get(reverse("download_submitted", args=[self.text.pk]),
+                                       HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING="zstd")
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(storage_client.call_count, 1)
+
+    def test_not_modified_download_makes_no_storage_call(self):
+        saved = save_submitted_file(self.user, "note.txt", ContentFile(b"Hello budgets"))
+        etag = f'"{hashlib.sha256(b"Hello budgets").hexdigest()}"'
+        with mock.patch("google.cloud.storage.Client") as storage_client, \
+                mock.patch.object(default_storage, "text_codec", return_value="zstd"):
+            response = self.client.get(reverse("download_submitted", args=[saved.pk]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        storage_client.assert_not_called()
+
+    def test_export_files(self):
+        self.add_file("note.txt", b"Second note")
+        response = self.assertWithinBudget("export_files", self.client.get, reverse("export_files"))
+        self.assertEqual(response["Content-Type"], "application/zip")
+
+        with zipfile.ZipFile(io.BytesIO(_streamed_body(response))) as archive:
+            infos = {info.filename: info for info in archive.infolist()}
+            self.assertEqual(sorted(infos), ["note (2).txt", "note.txt", "recording.wav"])
+            self.assertEqual(infos["recording.wav"].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos["note.txt"].compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.read("note.txt"), b"Hello budgets")
+
+    def test_export_selected_files(self):
+        response = self.client.get(reverse("export_files"), {"file_id": [self.audio.pk]})
+        with zipfile.ZipFile(io.BytesIO(_streamed_body(response))) as archive:
+            self.assertEqual(archive.namelist(), ["recording.wav"])
+            self.assertEqual(archive.read("recording.wav"), _wav_bytes())
+
+
+class TranscriptionViewTests(ViewTestCase):
+    """Speech-to-text, inline, streamed and from Cloud Storage."""
+
+    def test_transcribe_audio(self):
+        response = self.assertWithinBudget(
+            "transcribe_audio", self.client.get, reverse("transcribe_audio", args=[self.audio.pk]),
+            {"input_lang": "en", "target_lang": "de"},
+        )
+        self.assertContains(response, "[de] [speech")
+
+    def test_transcribe_stream(self):
+        page = self.client.get(reverse("transcribe_audio", args=[self.audio.pk]), {"stream": "1", "target_lang": "de"})
+        self.assertContains(page, "EventSource")
+
+        def stream(*args):
+            response = self.client.get(*args)
+            return response, _streamed_body(response).decode()
+
+        response, body = self.assertWithinBudget(
+            "transcribe_stream", stream, reverse("transcribe_stream", args=[self.audio.pk]),
+            {"input_lang": "en", "target_lang": "de"},
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = re.findall(r"event: (\w+)\ndata: (.*)\n\n", body)
+        self.assertEqual([event for event, _ in events], ["segment", "done"])
+        self.assertTrue(json.loads(events[-1][1])["transcript"].startswith("[de] [speech"))
+
+    @override_settings(TRANSCRIPT_STREAM_CHUNK_SECONDS=1.5)
+    def test_streamed_segments_are_timed_on_the_original_recording(self):
+        import soundfile as sf
+
+        recording = io.BytesIO()
+        sf.write(recording, _recording(("silence", 1), ("speech", 1), ("silence", 2), ("speech", 1), ("silence", 1)),
+                 16000, format="WAV", subtype="PCM_16")
+        paused = self.add_file("paused.wav", recording.getvalue())
+        with fake_google_clients():
+            response = self.client.get(reverse("transcribe_stream", args=[paused.pk]), {"target_lang": "en"})
+            self.assertTrue(response.is_async)
+            body = _streamed_body(response).decode()
+        segments = [json.loads(data) for data in re.findall(r"event: segment\ndata: (.*)\n\n", body)]
+        # Trimmed to [0.9, 2.1] + [3.9, 5.1] and split at the pause between them
+        self.assertEqual([(segment["start"], segment["end"]) for segment in segments], [(0.9, 2.1), (3.9, 5.1)])
+
+    def test_mono_wav_is_recognized_from_storage(self):
+        with fake_google_clients():
+            upload = self.upload("upload.wav", _wav_bytes())
+            response = self.client.get(reverse("transcribe_audio", args=[upload.pk]),
+                                       {"input_lang": "en", "target_lang": "de"})
+        job = RecognitionJob.objects.get()
+        self.assertRedirects(response, reverse("transcription_job", args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual(job.operation[:9], "emulator/")
+
+        response = self.assertWithinBudget("transcription_job", self.client.get,
+                                           reverse("transcription_job", args=[job.pk]))
+        self.assertContains(response, "saved to your files")
+        saved = SubmittedFile.objects.get(user=self.user, original_name="upload.txt")
+        self.assertTrue(saved.file.read().decode().startswith("[de] [speech"))
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_stt")), 1)
+
+    def test_streamed_request_for_mono_wav_is_not_a_job(self):
+        with fake_google_clients():
+            upload = self.upload("upload.wav", _wav_bytes())
+            response = self.client.get(reverse("transcribe_audio", args=[upload.pk]),
+                                       {"input_lang": "en", "target_lang": "de", "stream": "1"})
+        self.assertContains(response, reverse("transcribe_stream", args=[upload.pk]))
+        self.assertFalse(RecognitionJob.objects.exists())
+
+    def start_job(self):
+        with fake_google_clients():
+            upload = self.upload("upload.wav", _wav_bytes())
+            self.client.get(reverse("transcribe_audio", args=[upload.pk]),
+                            {"input_lang": "en", "target_lang": "de"})
+        return RecognitionJob.objects.get()
+
+    def test_job_left_finishing_is_taken_over(self):
+        job = self.start_job()
+        # The poller that claimed the job died before saving anything
+        claimed_at = timezone.now() - timedelta(seconds=30)
+        RecognitionJob.objects.filter(pk=job.pk).update(status=RecognitionJob.FINISHING, claimed_at=claimed_at)
+        self.assertEqual(running_job(self.user, job.source, "en", ["de"]), job)
+        call_command("finish_transcriptions", stdout=io.StringIO())
+        self.assertEqual(RecognitionJob.objects.get().status, RecognitionJob.FINISHING)
+
+        with override_settings(RECOGNITION_FINISH_LEASE=10):
+            self.assertIsNone(running_job(self.user, job.source, "en", ["de"]))
+            with fake_google_clients():
+                call_command("finish_transcriptions", stdout=io.StringIO())
+        self.assertEqual(RecognitionJob.objects.get().status, RecognitionJob.DONE)
+        self.assertTrue(SubmittedFile.objects.filter(user=self.user, original_name="upload.txt").exists())
+
+    def test_poller_that_lost_its_job_saves_nothing(self):
+        job = self.start_job()
+        RecognitionJob.objects.filter(pk=job.pk).update(status=RecognitionJob.FINISHING, claimed_at=timezone.now())
+        job.status, job.claimed_at = RecognitionJob.FINISHING, timezone.now() - timedelta(minutes=10)
+        with fake_google_clients():
+            recognition._finish(job, "Taken over")
+        self.assertEqual(job.status, RecognitionJob.FINISHING)
+        self.assertFalse(SubmittedFile.objects.filter(user=self.user, original_name="upload.txt").exists())
+
+    def test_other_audio_is_recognized_inline(self):
+        import numpy as np
+        import soundfile as sf
+
+        stereo = io.BytesIO()
+        sf.write(stereo, np.zeros((16000, 2)), 16000, format="WAV", subtype="PCM_16")
+        upload = self.upload("stereo.wav", stereo.getvalue())
+        self.assertEqual(upload.blob.audio_info["channels"], 2)
+        with fake_google_clients():
+            response = self.client.get(reverse("transcribe_audio", args=[upload.pk]), {"target_lang": "de"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(RecognitionJob.objects.exists())
+
+    def test_transcribe_fans_out_to_several_languages(self):
+        with fake_google_clients():
+            response = self.client.get(reverse("transcribe_audio", args=[self.audio.pk]),
+                                       {"input_lang": "en", "target_lang": ["de", "fr", "en"]})
+        self.assertContains(response, "[de] [speech")
+        self.assertContains(response, "[fr] [speech")
+        self.assertContains(response, "transcription_en")
+        # Recognized once, charged once
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_stt")), 1)
+
+
+class SynthesisViewTests(ViewTestCase):
+    """Text-to-speech and saving the synthesized audio."""
+
+    def test_synthesize_speech(self):
+        response = self.assertWithinBudget(
+            "synthesize_speech", self.client.get, reverse("synthesize_speech", args=[self.text.pk]),
+            {"input_lang": "en", "target_lang": "en"},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_synthesize_fans_out_to_all_languages(self):
+        with fake_google_clients(), mock.patch("google.cloud.texttospeech.TextToSpeechClient") as tts_client:
+            from google.cloud import texttospeech
+
+            tts_client.return_value.synthesize_speech.return_value = texttospeech.SynthesizeSpeechResponse(
+                audio_content=b"ID3 fake mp3"
+            )
+            response = self.client.get(reverse("synthesize_speech", args=[self.text.pk]),
+                                       {"input_lang": "en", "target_lang": "all"})
+        self.assertEqual(response.status_code, 200)
+        voices = [call.kwargs["voice"].language_code for call in tts_client.return_value.synthesize_speech.call_args_list]
+        self.assertEqual(sorted(voices), ["de", "en", "es", "fr", "pl"])
+        self.assertContains(response, "speech_pl")
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_tts")), 1)
+
+    def test_short_text_in_the_declared_language_is_not_translated(self):
+        with fake_google_clients(), mock.patch("google.cloud.translate_v2.Client") as translate_client:
+            response = self.client.get(reverse("synthesize_speech", args=[self.text.pk]),
+                                       {"input_lang": "en", "target_lang": "en"})
+        self.assertEqual(response.status_code, 200)
+        translate_client.assert_not_called()
+
+    def test_synthesize_skips_translation_of_text_in_target_language(self):
+        german = self.add_file("de.txt", "Das Treffen wurde auf Montag verschoben.".encode())
+        with fake_google_clients(), mock.patch("google.cloud.translate_v2.Client") as translate_client:
+            self.client.get(reverse("synthesize_speech", args=[german.pk]), {"input_lang": "en", "target_lang": "de"})
+        translate_client.return_value.translate.assert_not_called()
+
+    def synthesize_master(self, **extra):
+        """Synthesize self.text with a real MP3 master, return (master bytes, page)."""
+        import numpy as np
+        import soundfile as sf
+
+        master = io.BytesIO()
+        sf.write(master, 0.3 * np.sin(np.arange(48000) / 10), 24000, format="MP3", subtype="MPEG_LAYER_III")
+        with fake_google_clients(), mock.patch("google.cloud.texttospeech.TextToSpeechClient") as tts_client:
+            from google.cloud import texttospeech
+
+            tts_client.return_value.synthesize_speech.return_value = texttospeech.SynthesizeSpeechResponse(
+                audio_content=master.getvalue()
+            )
+            response = self.client.get(reverse("synthesize_speech", args=[self.text.pk]),
+                                       {"target_lang": "en", **extra})
+        return master.getvalue(), response
+
+    def test_browser_picks_the_codec_and_slow_clients_get_a_smaller_rendition(self):
+        master, response = self.synthesize_master()
+        sources = re.findall(r'<source src="([^"]+)" type="([^"]+)">', response.content.decode())
+        self.assertEqual([content_type for _, content_type in sources], ["audio/ogg; codecs=opus", "audio/mpeg"])
+        (opus, _), (mp3, _) = sources
+
+        response = self.assertWithinBudget("synthesized_audio", self.client.get, opus, HTTP_SAVE_DATA="on")
+        self.assertEqual(response.content[:4], b"OggS")
+        self.assertIn("Save-Data", response["Vary"])
+        normal = self.client.get(opus)
+        self.assertGreater(len(normal.content), len(response.content))
+        self.assertEqual(self.client.get(mp3).content, master)
+
+    def test_explicit_format_lists_a_single_source(self):
+        master, response = self.synthesize_master(format="mp3-low")
+        sources = re.findall(r'<source src="([^"]+)" type="([^"]+)">', response.content.decode())
+        self.assertEqual(len(sources), 1)
+        self.assertEqual(sources[0][1], "audio/mpeg")
+        self.assertLess(len(self.client.get(sources[0][0]).content), len(master))
+
+    def test_master_is_saved_from_another_instance(self):
+        master, response = self.synthesize_master()
+        audio_key = re.search(r'name="audio_key" value="([^"]+)"', response.content.decode()).group(1)
+        # Nothing of the synthesis is left in this process
+        cache.clear()
+        self.client.post(reverse("save_synthesized_audio"), {"audio_key": audio_key, "filename": "slow"})
+        saved = SubmittedFile.objects.get(user=self.user, original_name="slow.mp3")
+        self.assertEqual(saved.file.read(), master)
+        self.assertEqual(StoredBlob.objects.get(pk=saved.blob_id).ref_count, 1)
+
+        digest = audio_key.split(":")[0]
+        for forged in ("budgets", digest, f"{'0' * 64}:{audio_key.split(':')[1]}"):
+            response = self.client.post(reverse("save_synthesized_audio"), {"audio_key": forged, "filename": "x"})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse("synthesized_audio", args=[digest, "mp3"])).status_code, 404)
+
+    def test_expired_master_cannot_be_played_or_saved(self):
+        master, response = self.synthesize_master()
+        self.assertFalse(StoredBlob.objects.filter(size=len(master)).exists())
+        audio_key = re.search(r'name="audio_key" value="([^"]+)"', response.content.decode()).group(1)
+        digest = audio_key.split(":")[0]
+        # The bucket's lifecycle rule deletes unsaved masters
+        default_storage.delete(f"tts/{digest[:2]}/{digest}.mp3")
+        response = self.client.post(reverse("save_synthesized_audio"), {"audio_key": audio_key, "filename": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse("synthesized_audio", args=[audio_key, "mp3"])).status_code, 404)
+
+    def test_save_synthesized_audio(self):
+        self.assertWithinBudget(
+            "save_synthesized_audio", self.client.post, reverse("save_synthesized_audio"),
+            {"file_id": self.text.pk, "filename": "speech", "audio_data": base64.b64encode(b"ID3").decode()},
+        )
+
+
+class UsageAccountingTests(ViewTestCase):
+    """One ledger event per limit charge, so counters rehydrated from the ledger match."""
+
+    def assertLedgerMatchesLimit(self, limit_name, action):
+        charged = cache.get(_get_cache_key(self.user.id, limit_name))
+        self.assertEqual(usage.usage_today(self.user.id, action), charged)
+        cache.clear()
+        initialize_limit_if_needed(self.user, limit_name)
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, limit_name)), charged)
+
+    @override_settings(TRANSCRIPT_STREAM_CHUNK_SECONDS=0.5)
+    def test_streamed_transcription_is_one_event(self):
+        with fake_google_clients():
+            response = self.client.get(reverse("transcribe_stream", args=[self.audio.pk]), {"target_lang": "de"})
+            body = _streamed_body(response).decode()
+        self.assertEqual(body.count("event: segment"), 2)
+        self.assertLedgerMatchesLimit("daily_stt", "stt")
+
+    def test_cached_syntheses_are_counted(self):
+        with fake_google_clients():
+            for _ in range(2):
+                self.client.get(reverse("synthesize_speech", args=[self.text.pk]), {"target_lang": "en"})
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_tts")), 2)
+        self.assertLedgerMatchesLimit("daily_tts", "tts")
+        usage.flush()
+        units = UsageEvent.objects.filter(user=self.user, action="tts").order_by("id").values_list("units", flat=True)
+        self.assertEqual(list(units), [len("Hello budgets"), 0])
+
+    def start_storage_job(self):
+        with fake_google_clients():
+            upload = self.upload("upload.wav", _wav_bytes())
+            self.client.get(reverse("transcribe_audio", args=[upload.pk]), {"target_lang": "de"})
+        return RecognitionJob.objects.get()
+
+    def test_storage_job_is_counted_when_charged(self):
+        self.start_storage_job()
+        # The counter is rebuilt while the job is still running
+        self.assertLedgerMatchesLimit("daily_stt", "stt")
+
+    def test_failed_storage_job_withdraws_its_event(self):
+        job = self.start_storage_job()
+        usage.flush()
+        with mock.patch.object(recognition, "_finish", side_effect=RuntimeError("boom")):
+            job = recognition.poll(speech_client(), job)
+        self.assertEqual(job.status, RecognitionJob.FAILED)
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_stt")), 0)
+        self.assertLedgerMatchesLimit("daily_stt", "stt")
+
+    def test_disconnected_live_session_is_counted(self):
+        from .consumers import LiveTranscriptionSession
+
+        messages = iter([
+            {"type": "websocket.receive", "bytes": _wav_bytes(0.5)[44:]},
+            {"type": "websocket.disconnect"},
+        ])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message)
+
+        session = LiveTranscriptionSession(self.user, send, language="en", save=False, filename="live")
+        async_to_sync(session.run)(receive)
+        self.assertFalse(any(message.get("type") == "websocket.close" for message in sent))
+        self.assertLedgerMatchesLimit("daily_stt", "stt")
+
+    def test_malformed_control_message_ends_the_live_session(self):
+        from .consumers import LiveTranscriptionSession
+
+        for text in ("{not json", "[]"):
+            messages = iter([
+                {"type": "websocket.receive", "bytes": _wav_bytes(0.5)[44:]},
+                {"type": "websocket.receive", "text": text},
+            ])
+            sent = []
+
+            async def receive():
+                return next(messages)
+
+            async def send(message):
+                sent.append(message)
+
+            session = LiveTranscriptionSession(self.user, send, language="en", save=False, filename="live")
+            async_to_sync(session.run)(receive)
+            self.assertEqual(sent[-1], {"type": "websocket.close", "code": 1007})
+            self.assertIn({"type": "error", "error": "Malformed control message."},
+                          [json.loads(message["text"]) for message in sent if "text" in message])
+        self.assertLedgerMatchesLimit("daily_stt", "stt")
+
+
+class ListingVersionTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("listing")
+        self.files = [
+            SubmittedFile.objects.create(user=self.user, file=f"textfiles/textsubmissions/{name}")
+            for name in ("a.txt", "b.txt")
+        ]
+
+    def test_version_follows_the_files(self):
+        versions = [get_listing_version(self.user.id)]
+        # Other instances with their own caches compute the same version
+        cache.clear()
+        self.assertEqual(get_listing_version(self.user.id), versions[0])
+
+        self.files[0].original_name = "renamed.txt"
+        self.files[0].save()
+        versions.append(get_listing_version(self.user.id))
+        self.files[0].delete()
+        versions.append(get_listing_version(self.user.id))
+        SubmittedFile.objects.create(user=self.user, file="textfiles/textsubmissions/c.txt")
+        versions.append(get_listing_version(self.user.id))
+        self.assertEqual(len(set(versions)), 4)
+
+    def test_same_files_give_the_same_version(self):
+        before = get_listing_version(self.user.id)
+        newest = SubmittedFile.objects.create(user=self.user, file="textfiles/textsubmissions/c.txt")
+        newest.delete()
+        other = get_user_model().objects.create_user("other")
+        SubmittedFile.objects.create(user=other, file="textfiles/textsubmissions/d.txt")
+        self.assertEqual(get_listing_version(self.user.id), before)
+        self.files[1].delete()
+        self.assertNotEqual(get_listing_version(self.user.id), before)
+
+    def test_empty_listing(self):
+        other = get_user_model().objects.create_user("empty")
+        self.assertEqual(get_listing_version(other.id), "0.0.0.000000")
+
+
+@override_settings(
+    STORAGES={
+        "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "blobs"}},
+)
+class BlobDeduplicationTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("blobs", password="secret")
+        self.other = get_user_model().objects.create_user("other", password="secret")
+        self.client.force_login(self.user)
+
+    def test_duplicate_upload_skips_storage_write(self):
+        content = b"The same lecture notes"
+        self.client.post(reverse("save_file"), {"file": ContentFile(content, name="lecture.txt")})
+        with mock.patch.object(default_storage, "save", wraps=default_storage.save) as save:
+            save_submitted_file(self.other, "copy.txt", ContentFile(content))
+        save.assert_not_called()
+
+        blob = StoredBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(blob.key, hashlib.sha256(content).hexdigest() + ".txt")
+        self.assertEqual(
+            sorted(SubmittedFile.objects.values_list("original_name", flat=True)), ["copy.txt", "lecture.txt"]
+        )
+
+    def test_delete_releases_reference_and_sweeper_reclaims(self):
+        first = save_submitted_file(self.user, "a.txt", ContentFile(b"shared"))
+        save_submitted_file(self.other, "b.txt", ContentFile(b"shared"))
+        blob = first.blob
+
+        self.client.post(reverse("delete_file", args=[first.pk]))
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(default_storage.exists(blob.file.name))
+
+        SubmittedFile.objects.filter(user=self.other).delete()
+        call_command("sweep_blobs", min_age=0, stdout=io.StringIO())
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(default_storage.exists(blob.file.name))
+
+    def test_sweeper_recount_keeps_referenced_blob(self):
+        submitted = save_submitted_file(self.user, "a.txt", ContentFile(b"kept"))
+        StoredBlob.objects.update(ref_count=0)
+        call_command("sweep_blobs", min_age=0, recount=True, stdout=io.StringIO())
+        self.assertEqual(StoredBlob.objects.get(pk=submitted.blob_id).ref_count, 1)
+
+
+class CompressedTextInMemoryStorage(TextCompressionMixin, InMemoryStorage):
+    pass
+
+
+class TextCompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = CompressedTextInMemoryStorage()
+        self.text = "Transcript of the lecture. " * 50
+
+    def _stored_bytes(self, name):
+        with InMemoryStorage._open(self.storage, name) as f:
+            return f.read()
+
+    def test_gzip_round_trip(self):
+        name = self.storage.save("notes/lecture.txt", ContentFile(self.text.encode()))
+        stored = self._stored_bytes(name)
+        self.assertTrue(stored.startswith(GZIP_MAGIC))
+        self.assertLess(len(stored), len(self.text))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read().decode(), self.text)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        self.storage.text_compression = "zstd"
+        name = self.storage.save("notes/lecture.txt", ContentFile(self.text.encode()))
+        self.assertTrue(self._stored_bytes(name).startswith(ZSTD_MAGIC))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read().decode(), self.text)
+
+    def test_uncompressed_objects_are_read_as_is(self):
+        name = InMemoryStorage._save(self.storage, "notes/legacy.txt", ContentFile(b"stored before compression"))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b"stored before compression")
+
+    def test_other_files_are_not_compressed(self):
+        name = self.storage.save("audio/take.wav", ContentFile(b"RIFF...."))
+        self.assertEqual(self._stored_bytes(name), b"RIFF....")
+
+    def test_chunks_are_decompressed_as_they_are_read(self):
+        name = self.storage.save("notes/lecture.txt", ContentFile(self.text.encode()))
+        legacy = InMemoryStorage._save(self.storage, "notes/legacy.txt", ContentFile(b"stored before compression"))
+        audio = self.storage.save("audio/take.wav", ContentFile(b"RIFF" * 100))
+        self.assertEqual(b"".join(self.storage.iter_chunks(name, chunk_size=16)).decode(), self.text)
+        self.assertEqual(b"".join(self.storage.iter_chunks(legacy, chunk_size=16)), b"stored before compression")
+        self.assertEqual(list(self.storage.iter_chunks(audio, chunk_size=256)), [b"RIFF" * 64, b"RIFF" * 36])
+
+    def test_bucket_objects_are_read_in_ranges_as_stored(self):
+        with mock.patch.object(CompressedTextGoogleCloudStorage, "bucket", new_callable=mock.PropertyMock) as bucket:
+            blob = bucket.return_value.blob.return_value
+            blob.open.return_value = io.BytesIO(gzip.compress(b"Hello bucket"))
+            chunks = list(CompressedTextGoogleCloudStorage(bucket_name="bucket").iter_chunks("notes/a.txt"))
+        self.assertEqual(chunks, [b"Hello bucket"])
+        bucket.return_value.blob.assert_called_once_with("notes/a.txt")
+        blob.open.assert_called_once_with("rb", chunk_size=64 * 1024, raw_download=True)
+
+
+class LanguageDetectionTests(unittest.TestCase):
+
+    def test_detects_supported_languages(self):
+        samples = {
+            "en": "I forgot my umbrella at the station yesterday.",
+            "de": "Ich habe gestern meinen Regenschirm am Bahnhof vergessen.",
+            "es": "Ayer olvidé mi paraguas en la estación.",
+            "fr": "J'ai oublié mon parapluie à la gare hier.",
+            "pl": "Wczoraj zapomniałem parasola na dworcu.",
+        }
+        for language, text in samples.items():
+            self.assertEqual(detect(text)[0], language, text)
+
+    def test_short_text_is_not_classified(self):
+        self.assertEqual(detect("[speech 0.0s]"), (None, 0.0))
+
+    def test_neighbouring_unsupported_languages_are_rejected(self):
+        samples = [
+            "Ieri ho dimenticato il mio ombrello alla stazione.",  # Italian
+            "A reunião foi adiada para a próxima segunda-feira.",  # Portuguese
+            "La reunió s'ha traslladat al proper dilluns.",  # Catalan
+            "De vergadering is verplaatst naar maandag.",  # Dutch
+        ]
+        for text in samples:
+            self.assertIsNone(detect(text)[0], text)
+
+    def test_plan_corrects_mislabelled_source(self):
+        plan = plan_translation("La reunión se ha trasladado al próximo lunes.", "en", "de")
+        self.assertEqual(plan, TranslationPlan(source="es", detected="es", translate=True))
+
+    def test_plan_skips_text_already_in_target(self):
+        plan = plan_translation("The meeting has been moved to Monday.", "pl", "en-US")
+        self.assertFalse(plan.translate)
+
+    def test_undetected_text_falls_back_to_the_declared_source(self):
+        italian = "Per favore mandami il rapporto prima della fine della settimana."
+        self.assertEqual(plan_translation(italian, "es", "es"),
+                         TranslationPlan(source="es", detected=None, translate=False))
+        self.assertEqual(plan_translation(italian, "es", "de"),
+                         TranslationPlan(source="es", detected=None, translate=True))
+
+
+class TranslationMemoryTests(TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.translate.side_effect = lambda values, target_language, **kwargs: [
+            {"translatedText": value.upper()} for value in values
+        ]
+
+    def test_only_unseen_sentences_are_sent(self):
+        original = "First sentence. Second sentence!\nThird line"
+        translated, stats = translate_with_memory(self.client, original, "de", "en")
+        self.assertEqual(translated, "FIRST SENTENCE. SECOND SENTENCE!\nTHIRD LINE")
+        self.assertEqual((stats.sentences, stats.reused), (3, 0))
+
+        revised = "First sentence.  Second  sentence!\nA new third line"
+        translated, stats = translate_with_memory(self.client, revised, "de", "en")
+        self.assertEqual(translated, "FIRST SENTENCE.  SECOND SENTENCE!\nA NEW THIRD LINE")
+        self.client.translate.assert_called_with(["A new third line"], target_language="de", source_language="en")
+        self.assertEqual((stats.reused, stats.chars_sent), (2, len("A new third line")))
+        self.assertEqual(stats.chars_total - stats.chars_sent, len("First sentence.") + len("Second sentence!"))
+
+    def test_memory_is_per_language_pair(self):
+        translate_with_memory(self.client, "Hello there.", "de", "en")
+        _, stats = translate_with_memory(self.client, "Hello there.", "fr", "en")
+        self.assertEqual(stats.reused, 0)
+        _, stats = translate_with_memory(self.client, "Hello there.", "de", "es")
+        self.assertEqual(stats.reused, 0)
+
+    def test_eviction_drops_stale_then_least_recently_used(self):
+        translate_with_memory(self.client, "One. Two. Three. Four.", "de", "en")
+        TranslationMemory.objects.filter(translation="ONE.").update(
+            last_used_at=timezone.now() - timedelta(days=100)
+        )
+        TranslationMemory.objects.filter(translation="TWO.").update(
+            last_used_at=timezone.now() - timedelta(days=1)
+        )
+        self.assertEqual(evict(max_entries=2, max_age_days=90), (1, 1))
+        self.assertEqual(sorted(TranslationMemory.objects.values_list("translation", flat=True)), ["FOUR.", "THREE."])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "usage"}},
+    USAGE_FLUSH_INTERVAL=0,
+    USAGE_FLUSH_SIZE=3,
+)
+class UsageLedgerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(usage.flush)
+        self.user = get_user_model().objects.create_user("usage", password="secret")
+
+    def test_events_are_buffered_until_the_size_threshold(self):
+        with self.assertNumQueries(0):
+            usage.record_usage(self.user.id, "stt", 12)
+            usage.record_usage(self.user.id, "tts", 300)
+        self.assertFalse(UsageEvent.objects.exists())
+
+        usage.record_usage(self.user.id, "stt", 30)
+        self.assertEqual(UsageEvent.objects.count(), 3)
+        daily = DailyUsage.objects.get(user=self.user, action="stt", date=timezone.localdate())
+        self.assertEqual((daily.count, daily.units), (2, 42))
+
+    def test_flush_recomputes_daily_totals(self):
+        usage.record_usage(self.user.id, "tts", 100)
+        usage.flush()
+        usage.record_usage(self.user.id, "tts", 50)
+        self.assertEqual(usage.flush(), 1)
+        daily = DailyUsage.objects.get(user=self.user, action="tts")
+        self.assertEqual((daily.count, daily.units), (2, 150))
+
+    def test_limiter_rehydrates_from_ledger(self):
+        usage.record_usage(self.user.id, "stt", 10)
+        usage.flush()
+        usage.record_usage(self.user.id, "stt", 10)  # still buffered
+        cache.clear()  # restart or eviction
+
+        initialize_limit_if_needed(self.user, "daily_stt")
+        self.assertEqual(cache.get(_get_cache_key(self.user.id, "daily_stt")), 2)
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_execution(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "transcript"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do(("transcribe", 1), work)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do(("transcribe", 1), work)))
+                     for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        # Give followers time to find the running call before the leader finishes
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("transcript", False)] * 3 + [("transcript", True)])
+        self.assertEqual(flight.stats(), {"transcribe.leaders": 1, "transcribe.followers": 3})
+        # Finished calls are forgotten, the next request runs again
+        self.assertEqual(flight.do(("transcribe", 1), lambda: "again"), ("again", True))
+
+    def test_followers_receive_the_leaders_exception(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError("File is empty.")
+
+        errors = []
+
+        def call():
+            try:
+                flight.do(("synthesize", 1), fail)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, ["File is empty."] * 2)
+
+    @override_settings(SINGLEFLIGHT_SHARED=True)
+    def test_shared_mode_joins_leaders_in_other_processes(self):
+        cache.clear()
+        # Two instances stand in for two processes sharing the cache
+        here, there = SingleFlight(), SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def work():
+            started.set()
+            release.wait(5)
+            return "audio"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(there.do(("synthesize", 1), work)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(here.do(("synthesize", 1), lambda: "duplicate")))
+        follower.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in [leader, follower]:
+            thread.join(5)
+
+        self.assertEqual(sorted(results), [("audio", False), ("audio", True)])
+        self.assertEqual(here.stats(), {"synthesize.shared_followers": 1})
+
+
+@override_settings(UPSTREAM_BACKOFF=0.01, UPSTREAM_RETRIES=2, UPSTREAM_BREAKER_FAILURES=3)
+class UpstreamCallTests(SimpleTestCase):
+
+    def setUp(self):
+        # Breaker state is per service, every test gets its own
+        self.service = self.id()
+
+    def faulty(self, *faults):
+        return FaultInjectingClient(SimpleNamespace(recognize=lambda **kwargs: "transcript"), recognize=faults)
+
+    def test_transient_failures_are_retried_for_idempotent_calls(self):
+        client = self.faulty(ConnectionError("reset"), ConnectionError("reset"))
+        self.assertEqual(call(self.service, lambda timeout: client.recognize(timeout=timeout)), "transcript")
+        self.assertEqual(client.calls["recognize"], 3)
+
+        client = self.faulty(ConnectionError("reset"))
+        with self.assertRaises(ConnectionError):
+            call(self.service + "-once", lambda timeout: client.recognize(timeout=timeout), idempotent=False)
+        self.assertEqual(client.calls["recognize"], 1)
+
+    def test_errors_of_the_request_itself_are_not_retried(self):
+        client = self.faulty(ValueError("bad config"))
+        with self.assertRaises(ValueError):
+            call(self.service, lambda timeout: client.recognize(timeout=timeout))
+        self.assertEqual(client.calls["recognize"], 1)
+
+    def test_deadline_bounds_the_whole_request(self):
+        client = self.faulty(5.0, 5.0, 5.0)
+        started = time.monotonic()
+        with deadline(0.3), self.assertRaises(DeadlineExceeded):
+            call(self.service, lambda timeout: client.recognize(timeout=timeout))
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    @override_settings(UPSTREAM_RETRIES=0, UPSTREAM_BREAKER_COOLDOWN=0.2)
+    def test_breaker_fails_fast_then_probes(self):
+        client = self.faulty(*[ConnectionError("reset")] * 3)
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                call(self.service, lambda timeout: client.recognize(timeout=timeout))
+
+        with self.assertRaises(UpstreamUnavailable):
+            call(self.service, lambda timeout: client.recognize(timeout=timeout))
+        self.assertEqual(client.calls["recognize"], 3)
+        self.assertEqual(upstream_stats()[self.service]["state"], "open")
+
+        time.sleep(0.25)
+        self.assertEqual(call(self.service, lambda timeout: client.recognize(timeout=timeout)), "transcript")
+        self.assertEqual(upstream_stats()[self.service]["state"], "closed")
+
+    @override_settings(UPSTREAM_HEDGING=True)
+    def test_slow_attempt_is_hedged(self):
+        client = self.faulty(*[0.01] * 20, 2.0)
+        for _ in range(20):
+            call(self.service, lambda timeout: client.recognize(timeout=timeout), hedge=True)
+
+        started = time.monotonic()
+        self.assertEqual(call(self.service, lambda timeout: client.recognize(timeout=timeout), hedge=True),
+                         "transcript")
+        self.assertLess(time.monotonic() - started, 1.0)
+        stats = upstream_stats()[self.service]
+        self.assertEqual((stats["hedged"], stats["hedge_wins"]), (1, 1))
+
+
+@override_settings(DSP_POOL_ENABLED=True, DSP_POOL_WORKERS=1, DSP_POOL_MAX_PENDING=1)
+class WorkerPoolTests(SimpleTestCase):
+    """The real spawned pool, one worker so tests can fill it."""
+
+    def setUp(self):
+        # A pool of its own, started with the settings above and shut down after
+        patcher = mock.patch.multiple(workers, _executor=None, _slots=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: workers._executor and workers._executor.shutdown())
+
+    def test_recognition_audio_is_prepared_in_a_worker(self):
+        with SharedBuffer(_wav_bytes(seconds=1.0, sample_rate=8000)) as shared_audio:
+            pcm_name, num_samples, time_map, peaks = run_cpu_bound(
+                prepare_for_recognition, shared_audio.name, shared_audio.size, False, 2)
+        with SharedBuffer(name=pcm_name) as pcm:
+            self.assertEqual(len(pcm.shm.buf[:num_samples * 2]), 32000)
+        # Resampled to 16 kHz, nothing trimmed, the map is the identity
+        self.assertEqual(time_map.segments.tolist(), [[0.0, 1.0, 0.0]])
+        self.assertEqual(unpack_peaks(peaks)[0], 1.0)
+        self.assertEqual(pool_stats()["tasks"]["prepare_for_recognition"]["count"], 1)
+
+    def test_pdf_text_is_extracted_in_a_worker(self):
+        import pymupdf
+
+        document = pymupdf.open()
+        document.new_page().insert_text((72, 72), "Hello pool")
+        with SharedBuffer(document.tobytes()) as shared_pdf:
+            text = run_cpu_bound(extract_pdf_text, shared_pdf.name, shared_pdf.size)
+        self.assertEqual(text.strip(), "Hello pool")
+
+    def test_full_pool_rejects_instead_of_queueing(self):
+        running = threading.Thread(target=run_cpu_bound, args=(time.sleep, 1.0))
+        running.start()
+        self.addCleanup(running.join)
+        while not pool_stats()["in_flight"]:
+            time.sleep(0.01)
+
+        rejected = pool_stats()["rejected"]
+        with self.assertRaises(PoolBusy):
+            run_cpu_bound(time.sleep, 0)
+        self.assertEqual(pool_stats()["rejected"], rejected + 1)
+
+    def test_shared_memory_is_released_when_decoding_fails(self):
+        from multiprocessing import shared_memory
+
+        with SharedBuffer(b"not audio" * 100) as shared_audio:
+            with self.assertRaisesRegex(Exception, "Format not recognised"):
+                run_cpu_bound(prepare_for_recognition, shared_audio.name, shared_audio.size, True, 2)
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=shared_audio.name)
+
+
+class StreamInThreadTests(SimpleTestCase):
+
+    async def test_chunks_are_passed_on_as_they_are_produced(self):
+        produced = []
+
+        def generate():
+            for i in range(3):
+                produced.append(i)
+                yield i
+
+        seen = [(chunk, len(produced)) async for chunk in stream_in_thread(generate())]
+        self.assertEqual(seen, [(0, 1), (1, 2), (2, 3)])
+
+    async def test_abandoned_streams_close_the_generator(self):
+        closed = []
+
+        def generate():
+            try:
+                yield from range(10)
+            finally:
+                closed.append(True)
+
+        stream = stream_in_thread(generate())
+        self.assertEqual(await anext(stream), 0)
+        await stream.aclose()
+        self.assertEqual(closed, [True])
+
+
+class SilenceTrimmingTests(unittest.TestCase):
+
+    def test_pauses_are_dropped_with_a_hangover_around_speech(self):
+        from .vad import trim_silence
+
+        audio = _recording(("silence", 1), ("speech", 1), ("silence", 2), ("speech", 1), ("silence", 1))
+        trimmed, time_map = trim_silence(audio, 16000, aggressiveness=2)
+
+        # 90 ms of silence is kept on both sides of each region at level 2
+        self.assertEqual(time_map.segments.round(2).tolist(), [[0.9, 2.1, 0.0], [3.9, 5.1, 1.2]])
+        self.assertEqual(len(trimmed), 2.4 * 16000)
+        self.assertAlmostEqual(time_map.removed_seconds, 3.6)
+        self.assertEqual(time_map.cuts(16000), [19200])
+        # Stricter levels keep less silence around speech
+        self.assertLess(len(trim_silence(audio, 16000, aggressiveness=3)[0]), len(trimmed))
+        self.assertGreater(len(trim_silence(audio, 16000, aggressiveness=0)[0]), len(trimmed))
+
+    def test_time_map_leads_back_to_the_original_recording(self):
+        from .vad import trim_silence
+
+        audio = _recording(("silence", 1), ("speech", 1), ("silence", 2), ("speech", 1), ("silence", 1))
+        _, time_map = trim_silence(audio, 16000, aggressiveness=2)
+        self.assertEqual(time_map.to_original([0.0, 1.0, 1.2, 1.7]).round(2).tolist(), [0.9, 1.9, 3.9, 4.4])
+
+    def test_audio_without_clear_silence_is_kept_whole(self):
+        from .vad import trim_silence
+
+        audio = _recording(("speech", 2))
+        trimmed, time_map = trim_silence(audio, 16000)
+        self.assertEqual(len(trimmed), len(audio))
+        self.assertEqual(time_map.cuts(16000), [])
+        self.assertEqual(time_map.removed_seconds, 0)
+
+
+class TranscriptChunkingTests(unittest.TestCase):
+
+    def test_chunks_end_at_the_last_pause_that_fits(self):
+        self.assertEqual(split_at_pauses(100, [30, 55, 90], 60), [(0, 55), (55, 100)])
+        # Speech without a pause is cut hard at the limit
+        self.assertEqual(split_at_pauses(100, [], 40), [(0, 40), (40, 80), (80, 100)])
+        self.assertEqual(split_at_pauses(0, [], 40), [])
+
+
+class WaveformPeaksTests(unittest.TestCase):
+
+    def test_every_level_summarises_the_same_signal(self):
+        import numpy as np
+
+        samples = np.zeros(16000, dtype=np.float32)
+        samples[8000:8014] = [0.5, -1.0] * 7
+        duration, levels = unpack_peaks(compute_peaks(samples, 16000))
+        self.assertEqual(duration, 1.0)
+        for buckets in PEAK_BUCKETS:
+            pairs = np.frombuffer(levels[buckets], dtype=np.int8).reshape(-1, 2)
+            loud = np.flatnonzero(pairs[:, 1])
+            # The burst shows up in the bucket halfway through at every zoom level
+            self.assertEqual(loud.tolist(), [buckets // 2])
+            self.assertEqual(pairs[buckets // 2].tolist(), [-127, 64])
+
+    def test_short_and_empty_recordings(self):
+        import numpy as np
+
+        for samples in (np.full(10, 0.25, dtype=np.float32), np.zeros(0, dtype=np.float32)):
+            _, levels = unpack_peaks(compute_peaks(samples, 16000))
+            self.assertEqual(len(levels[PEAK_BUCKETS[-1]]), 2 * PEAK_BUCKETS[-1])
+        with self.assertRaises(ValueError):
+            unpack_peaks(b"RIFF" + bytes(16))
+
+
+class TranslationBatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.translate.side_effect = lambda values, target_language, **kwargs: [
+            {"translatedText": f"[{target_language}] {value}"} for value in values
+        ]
+
+    def translate_concurrently(self, batcher, requests):
+        results = {}
+
+        def run(name, segments, target_language):
+            results[name] = batcher.translate(self.client, segments, target_language, "en")
+
+        threads = [threading.Thread(target=run, args=request) for request in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    @override_settings(TRANSLATION_BATCH_WINDOW=0.2)
+    def test_concurrent_callers_share_one_request_per_language(self):
+        results = self.translate_concurrently(TranslationBatcher(), [
+            ("a", ["Hello.", "Bye."], "de"),
+            ("b", ["Hello."], "de"),
+            ("c", ["Hello."], "fr"),
+        ])
+        self.assertEqual(results["a"], ["[de] Hello.", "[de] Bye."])
+        self.assertEqual(results["b"], ["[de] Hello."])
+        self.assertEqual(results["c"], ["[fr] Hello."])
+        sent = sorted((call.kwargs["target_language"], call.args[0]) for call in self.client.translate.call_args_list)
+        self.assertEqual(sent, [("de", ["Hello.", "Bye."]), ("fr", ["Hello."])])
+
+    @override_settings(TRANSLATION_BATCH_WINDOW=10, TRANSLATION_BATCH_MAX_SEGMENTS=2)
+    def test_full_batch_is_sent_without_waiting_for_the_window(self):
+        started = time.monotonic()
+        results = self.translate_concurrently(TranslationBatcher(), [("a", ["One."], "de"), ("b", ["Two."], "de")])
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(results, {"a": ["[de] One."], "b": ["[de] Two."]})
+        self.assertEqual(self.client.translate.call_count, 1)
+
+
+class AudioProfileTests(unittest.TestCase):
+
+    def request(self, path="/", **headers):
+        request = RequestFactory().get(path, **headers)
+        request.session = {}
+        return request
+
+    def test_client_hints_pick_the_rendition(self):
+        self.assertEqual(choose_profile(self.request(), "mp3"), "mp3")
+        self.assertEqual(choose_profile(self.request(HTTP_ECT="4g", HTTP_DOWNLINK="10"), "mp3"), "mp3")
+        self.assertEqual(choose_profile(self.request(HTTP_ECT="3g"), "mp3"), "mp3-low")
+        self.assertEqual(choose_profile(self.request(HTTP_DOWNLINK="0.4"), "opus"), "opus-low")
+        self.assertEqual(choose_profile(self.request(), "opus"), "opus")
+
+    def test_explicit_format_is_remembered(self):
+        request = self.request("/?format=opus")
+        self.assertEqual(requested_profile(request), "opus")
+        later = self.request(HTTP_SAVE_DATA="on")
+        later.session = request.session
+        self.assertEqual(choose_profile(later, "opus"), "opus")
+        self.assertIsNone(requested_profile(self.request()))
+
+
+class StaticCachingTests(SimpleTestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        for name, data in (("app.0123456789ab.js", b"console.log(1);" * 20), ("app.js", b"console.log(1);" * 20)):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(data)
+        with open(os.path.join(self.root, "app.0123456789ab.js.br"), "wb") as f:
+            f.write(b"brotli")
+        settings_override = override_settings(STATIC_ROOT=self.root, STATIC_URL="/static/", SERVE_STATIC_FROM_APP=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.middleware = PrecompressedStaticMiddleware(lambda request: None)
+
+    def get(self, path, **headers):
+        return self.middleware(RequestFactory().get(path, **headers))
+
+    def test_hashed_names(self):
+        self.assertTrue(is_hashed_name("css/site.0123456789ab.css"))
+        self.assertFalse(is_hashed_name("css/site.css"))
+        self.assertFalse(is_hashed_name("css/site.0123456789ab.css.br"))
+
+    def test_hashed_files_are_immutable(self):
+        response = self.get("/static/app.0123456789ab.js")
+        self.assertEqual(response["Cache-Control"], IMMUTABLE_CACHE_CONTROL)
+        self.assertNotIn("Content-Encoding", response)
+        response.close()
+        response = self.get("/static/app.js")
+        self.assertEqual(response["Cache-Control"], REVALIDATE_CACHE_CONTROL)
+        response.close()
+
+    def test_precompressed_variant_and_revalidation(self):
+        response = self.get("/static/app.0123456789ab.js", HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(b"".join(response.streaming_content), b"brotli")
+        etag = response["ETag"]
+        response.close()
+
+        revalidated = self.get("/static/app.0123456789ab.js", HTTP_ACCEPT_ENCODING="br", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(revalidated.status_code, 304)
+        # The identity variant is a different representation with its own ETag
+        plain = self.get("/static/app.0123456789ab.js", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(plain.status_code, 200)
+        self.assertNotEqual(plain["ETag"], etag)
+        plain.close()
+
+    def test_other_paths_pass_through(self):
+        self.assertIsNone(self.get("/static/missing.js"))
+        self.assertIsNone(self.get("/static/app.0123456789ab.js.br"))
+        self.assertIsNone(self.get("/static/../secret"))
+
+
+class DeploymentDiscoveryTests(unittest.TestCase):
+
+    def deployment_values(self, cache_file=None, **values):
+        return startup.deployment_values(lambda name, default=None: values.get(name, default),
+                                         "project", values.get("SERVICE_NAME"), cache_file)
+
+    def test_configured_values_skip_discovery(self):
+        with mock.patch.object(startup, "discover_region") as discover_region, \
+                mock.patch.object(startup, "discover_service_uri") as discover_service_uri:
+            values = self.deployment_values(K_SERVICE="cbstg", SERVICE_NAME="cbstg", REGION="europe-west1",
+                                            SERVICE_URI="https://cbstg.run.app")
+        self.assertEqual(values, ("europe-west1", "https://cbstg.run.app"))
+        discover_region.assert_not_called()
+        discover_service_uri.assert_not_called()
+
+    def test_discovered_uri_is_cached(self):
+        fd, cache_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, cache_file)
+        with mock.patch.object(startup, "discover_region", return_value="europe-west1"), \
+                mock.patch.object(startup, "discover_service_uri", return_value="https://cbstg.run.app"):
+            self.deployment_values(cache_file, K_SERVICE="cbstg", SERVICE_NAME="cbstg")
+        with mock.patch.object(startup, "discover_service_uri") as discover_service_uri:
+            values = self.deployment_values(cache_file, K_SERVICE="cbstg", SERVICE_NAME="cbstg")
+        self.assertEqual(values, ("europe-west1", "https://cbstg.run.app"))
+        discover_service_uri.assert_not_called()
+
+    def test_unknown_uri_fails_closed_on_cloud_run(self):
+        with mock.patch.object(startup, "discover_region", return_value="europe-west1"), \
+                mock.patch.object(startup, "discover_service_uri", return_value=None):
+            with self.assertRaises(ImproperlyConfigured):
+                self.deployment_values(K_SERVICE="cbstg", SERVICE_NAME="cbstg")
+            with self.assertRaises(ImproperlyConfigured):
+                self.deployment_values(K_SERVICE="cbstg")
+            # Local runs keep working without a service URL
+            self.assertEqual(self.deployment_values(), (None, None))
+
+    def test_lookup_failures_are_logged(self):
+        with mock.patch("google.cloud.run_v2.services.services.client.ServicesClient") as services_client, \
+                self.assertLogs("cbstg", "ERROR") as logs:
+            services_client.return_value.get_service.side_effect = RuntimeError("permission denied")
+            self.assertIsNone(startup.discover_service_uri("project", "europe-west1", "cbstg"))
+        self.assertIn("permission denied", logs.output[0])
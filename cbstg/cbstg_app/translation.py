@@ -0,0 +1,313 @@
+"""Sentence-level translation memory.
+
+Documents are split into sentences, sentences translated before (same
+normalised text, source and target language) are taken from the database and
+only the rest is sent to the Translation API. Revised documents and
+re-recorded transcripts therefore only pay for the sentences that changed.
+"""
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics, upstream
+from .langid import TranslationPlan
+from .models import TranslationMemory
+from .usage import record_usage
+
+logger = logging.getLogger('cbstg')
+
+# Sentence ends followed by whitespace, or line breaks; captured so the
+# document can be rebuilt with its original spacing
+SENTENCE_BOUNDARY = re.compile(r"((?<=[.!?…])\s+|\n+)")
+# The v2 API accepts at most 128 segments per request
+MAX_SEGMENTS_PER_CALL = 100
+
+MemoryStats = namedtuple("MemoryStats", "sentences reused chars_total chars_sent")
+
+_lock = threading.Lock()
+_totals = Counter()
+
+
+class _Waiter:
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class _Batch:
+
+    def __init__(self):
+        self.waiters = []
+        self.segments = 0
+        self.full = threading.Event()
+
+
+class TranslationBatcher:
+    """Merges translate calls of concurrent requests into multi-segment API requests.
+
+    The first caller for a (target, source) language pair leads the batch: it
+    waits up to TRANSLATION_BATCH_WINDOW seconds, or until
+    TRANSLATION_BATCH_MAX_SEGMENTS segments are queued, then translates every
+    queued segment once and hands each caller its own results.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._stats = Counter()
+
+    def translate(self, client, segments, target_language, source_language=None):
+        """Return the translations of segments, in order."""
+        if settings.TRANSLATION_BATCH_WINDOW <= 0:
+            return self._send(client, segments, target_language, source_language)
+
+        key = (target_language, source_language)
+        waiter = _Waiter(segments)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            batch.waiters.append(waiter)
+            batch.segments += len(segments)
+            if batch.segments >= settings.TRANSLATION_BATCH_MAX_SEGMENTS:
+                # Closed to newcomers, the next caller starts a new batch
+                del self._batches[key]
+                batch.full.set()
+
+        if not leader:
+            left = upstream.remaining()
+            if not waiter.done.wait(settings.UPSTREAM_DEADLINE if left is None else max(left, 0)):
+                raise upstream.DeadlineExceeded("The translate service did not answer in time.")
+            if waiter.error is not None:
+                raise waiter.error
+            return waiter.results
+
+        batch.full.wait(settings.TRANSLATION_BATCH_WINDOW)
+        with self._lock:
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+            waiters = list(batch.waiters)
+            self._stats["batches"] += 1
+            self._stats["callers"] += len(waiters)
+            self._stats["segments"] += batch.segments
+
+        unique = list(dict.fromkeys(segment for queued in waiters for segment in queued.segments))
+        try:
+            translations = dict(zip(unique, self._send(client, unique, target_language, source_language)))
+        except Exception as e:
+            for queued in waiters:
+                queued.error = e
+                queued.done.set()
+            raise
+        for queued in waiters:
+            queued.results = [translations[segment] for segment in queued.segments]
+            queued.done.set()
+        return waiter.results
+
+    def _send(self, client, segments, target_language, source_language):
+        results = []
+        for start in range(0, len(segments), MAX_SEGMENTS_PER_CALL):
+            batch = segments[start:start + MAX_SEGMENTS_PER_CALL]
+            # translate_v2 takes no timeout, upstream.call stops waiting at the deadline
+            response = upstream.call("translate", lambda timeout: client.translate(
+                batch, target_language=target_language, source_language=source_language,
+            ), hedge=True)
+            results.extend(result["translatedText"] for result in response)
+            with self._lock:
+                self._stats["api_calls"] += 1
+                self._stats["segments_sent"] += len(batch)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+batcher = TranslationBatcher()
+
+
+def split_sentences(text):
+    """Return (sentences, separators), interleaving them gives back the text."""
+    parts = SENTENCE_BOUNDARY.split(text)
+    return parts[0::2], parts[1::2]
+
+
+def _normalize(sentence):
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+
+def _sentence_hash(source_language, normalized):
+    return hashlib.sha256(f"{source_language or 'auto'}\n{normalized}".encode()).hexdigest()
+
+
+def translate_with_memory(client, text, target_language, source_language=None):
+    """Translate text through the memory, returns (translated text, MemoryStats)."""
+    translated, failed = translate_into(client, text, [target_language], source_language)
+    if failed:
+        raise failed[target_language]
+    return translated[target_language]
+
+
+def translate_into(client, text, target_languages, source_language=None):
+    """Translate text through the memory into several languages at once.
+
+    The memory is read and written once for all languages and the API calls
+    for different languages run concurrently. Returns ({language: (translated
+    text, MemoryStats)}, {language: exception}), a failing language does not
+    affect the others.
+    """
+    sentences, separators = split_sentences(text)
+    normalized = [_normalize(sentence) for sentence in sentences]
+    # Sentences without letters (numbers, bullets) are kept as they are
+    hashes = {n: _sentence_hash(source_language, n) for n in normalized if any(c.isalpha() for c in n)}
+
+    stored = {target_language: {} for target_language in target_languages}
+    for target_language, sentence_hash, translation in TranslationMemory.objects.filter(
+        sentence_hash__in=set(hashes.values()), target_language__in=target_languages,
+    ).values_list("target_language", "sentence_hash", "translation"):
+        stored[target_language][sentence_hash] = translation
+
+    def fetch(target_language):
+        unseen = [n for n in hashes if hashes[n] not in stored[target_language]]
+        if not unseen:
+            return {}, None
+        try:
+            return dict(zip(unseen, batcher.translate(client, unseen, target_language, source_language))), None
+        except Exception as e:
+            return None, e
+
+    fetched = dict(zip(target_languages, upstream.fan_out(fetch, target_languages)))
+    failed = {target_language: error for target_language, (_, error) in fetched.items() if error is not None}
+    fresh_by_language = {target_language: fresh for target_language, (fresh, _) in fetched.items() if fresh is not None}
+
+    new_entries = [
+        TranslationMemory(
+            sentence_hash=hashes[n], source_language=source_language or "auto",
+            target_language=target_language, translation=translation,
+        )
+        for target_language, fresh in fresh_by_language.items()
+        for n, translation in fresh.items()
+    ]
+    if new_entries:
+        TranslationMemory.objects.bulk_create(new_entries, ignore_conflicts=True)
+
+    translated = {}
+    for target_language, fresh in fresh_by_language.items():
+        if stored[target_language]:
+            TranslationMemory.objects.filter(
+                sentence_hash__in=list(stored[target_language]), target_language=target_language,
+            ).update(last_used_at=timezone.now(), hits=F("hits") + 1)
+        translated[target_language] = (
+            _assemble(sentences, separators, normalized, hashes,
+                      {**stored[target_language], **{hashes[n]: t for n, t in fresh.items()}}),
+            _record_stats(hashes, fresh),
+        )
+    return translated, failed
+
+
+def translate_text(text, target_language='en', source_language=None, user_id=None):
+    plan = TranslationPlan(source=source_language, detected=None, translate=True)
+    return translate_texts(text, {target_language: plan}, user_id=user_id)[target_language]
+
+
+def translate_texts(text, plans, user_id=None):
+    """Translate text into the target languages of plans, returns {target: (text, error)}.
+
+    Targets the plan does not translate into get the text unchanged, the
+    others are translated concurrently and fail independently.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    results = {target: (text, None) for target, plan in plans.items() if not plan.translate}
+    targets = [target for target, plan in plans.items() if plan.translate]
+    if not targets:
+        return results
+
+    try:
+        from google.cloud import translate_v2 as translate
+
+        logger.info(f"Connecting to translate Client")
+        client = translate.Client()
+        # Every plan carries the same source, the text was classified once
+        translated, failed = translate_into(client, text, targets, plans[targets[0]].source)
+    except Exception as e:
+        translated, failed = {}, {target: e for target in targets}
+
+    for target in targets:
+        if target in failed:
+            logger.error(f"Translation failed: {failed[target]}")
+            results[target] = (text, "Translation failed: " + str(failed[target]) + "\n")
+            continue
+        result, stats = translated[target]
+        logger.info(f"Translation memory reused {stats.reused}/{stats.sentences} sentences, "
+                    f"saved {stats.chars_total - stats.chars_sent}/{stats.chars_total} characters")
+        if user_id is not None and stats.chars_sent:
+            record_usage(user_id, "translation", stats.chars_sent)
+        results[target] = (result, None)
+    return {target: results[target] for target in plans}
+
+
+def _assemble(sentences, separators, normalized, hashes, translations):
+    """Rebuild the text with every sentence replaced by its translation (keyed by hash)."""
+    translated = []
+    for sentence, n in zip(sentences, normalized):
+        if n in hashes:
+            leading = sentence[:len(sentence) - len(sentence.lstrip())]
+            trailing = sentence[len(sentence.rstrip()):]
+            translated.append(leading + translations[hashes[n]] + trailing)
+        else:
+            translated.append(sentence)
+    return translated[0] + "".join(sep + part for sep, part in zip(separators, translated[1:]))
+
+
+def _record_stats(hashes, fresh):
+    stats = MemoryStats(
+        sentences=len(hashes),
+        reused=len(hashes) - len(fresh),
+        chars_total=sum(len(n) for n in hashes),
+        chars_sent=sum(len(n) for n in fresh),
+    )
+    with _lock:
+        _totals["requests"] += 1
+        _totals["sentences"] += stats.sentences
+        _totals["sentences_reused"] += stats.reused
+        _totals["chars_total"] += stats.chars_total
+        _totals["chars_sent"] += stats.chars_sent
+    return stats
+
+
+def evict(max_entries, max_age_days):
+    """Drop entries unused for max_age_days, then the least recently used beyond max_entries."""
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    expired, _ = TranslationMemory.objects.filter(last_used_at__lt=cutoff).delete()
+
+    overflow = 0
+    boundary = TranslationMemory.objects.order_by("-last_used_at").values_list("last_used_at", flat=True)[
+        max_entries:max_entries + 1
+    ]
+    if boundary:
+        overflow, _ = TranslationMemory.objects.filter(last_used_at__lte=boundary[0]).delete()
+    return expired, overflow
+
+
+def memory_stats():
+    with _lock:
+        stats = dict(_totals)
+    stats["chars_saved"] = stats.get("chars_total", 0) - stats.get("chars_sent", 0)
+    return stats
+
+
+metrics.register("translation_memory", memory_stats)
+metrics.register("translation_batching", batcher.stats)
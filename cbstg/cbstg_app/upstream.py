@@ -0,0 +1,264 @@
+"""Deadlines, retries, hedging and circuit breaking for Google API calls.
+
+Work done for a request runs inside deadline(), every call() made under it
+gets the time left as its RPC timeout and gives up once the budget is spent,
+so a hung upstream cannot hold a web thread for good. Attempts run on a small
+thread pool: the request thread stops waiting at the deadline even for client
+methods that take no timeout, and a second (hedged) attempt can be started
+when the first is slower than the service usually is.
+
+Each service has a circuit breaker. After UPSTREAM_BREAKER_FAILURES failed
+calls in a row it opens and calls fail fast with UpstreamUnavailable for
+UPSTREAM_BREAKER_COOLDOWN seconds, then a single probe call decides whether
+it closes again.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger('cbstg')
+
+# Recent latencies per service, hedging starts once HEDGE_MIN_SAMPLES are known
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling the service while its circuit breaker is open."""
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """Raised when the request's time budget ran out before the service answered."""
+
+
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+_lock = threading.Lock()
+_services = {}
+_executor = None
+
+
+@contextmanager
+def deadline(seconds):
+    """Give the calls made inside an end-to-end budget, a nested budget never extends it."""
+    ends = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(ends if current is None else min(ends, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left in the current budget, None outside deadline()."""
+    ends = _deadline.get()
+    return None if ends is None else ends - time.monotonic()
+
+
+class _Service:
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.stats = Counter()
+
+    def admit(self):
+        """Raise UpstreamUnavailable while open, after the cooldown let one probe through."""
+        with _lock:
+            self.stats["calls"] += 1
+            if self.opened_at is None:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < settings.UPSTREAM_BREAKER_COOLDOWN:
+                self.stats["short_circuited"] += 1
+                raise UpstreamUnavailable(f"The {self.name} service is unavailable, please try again shortly.")
+            self.probing = True
+            return True
+
+    def succeeded(self, latency=None):
+        with _lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def failed(self):
+        with _lock:
+            self.failures += 1
+            self.stats["failures"] += 1
+            if self.probing or (self.opened_at is None and self.failures >= settings.UPSTREAM_BREAKER_FAILURES):
+                logger.error(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+                self.stats["opened"] += 1
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def end_probe(self):
+        with _lock:
+            self.probing = False
+
+    @property
+    def is_open(self):
+        with _lock:
+            return self.opened_at is not None
+
+    def hedge_delay(self):
+        with _lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def count(self, event):
+        with _lock:
+            self.stats[event] += 1
+
+    def snapshot(self):
+        delay = self.hedge_delay()
+        with _lock:
+            return {
+                **self.stats,
+                "state": "closed" if self.opened_at is None else "half-open" if self.probing else "open",
+                "p95_latency": delay,
+            }
+
+
+def _service(name):
+    with _lock:
+        if name not in _services:
+            _services[name] = _Service(name)
+        return _services[name]
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Abandoned attempts keep their thread until the client gives up,
+            # so the pool is larger than the number of request threads
+            _executor = ThreadPoolExecutor(max_workers=settings.WEB_THREADS * 2, thread_name_prefix="upstream")
+        return _executor
+
+
+def _is_transient(error):
+    if isinstance(error, (ConnectionError, TimeoutError, DeadlineExceeded)):
+        return True
+    try:
+        from google.api_core import exceptions
+        import requests
+    except ImportError:
+        return False
+    return isinstance(error, (
+        exceptions.DeadlineExceeded, exceptions.GatewayTimeout, exceptions.InternalServerError,
+        exceptions.ServiceUnavailable, exceptions.TooManyRequests,
+        requests.ConnectionError, requests.Timeout,
+    ))
+
+
+def call(service, fn, idempotent=True, hedge=False):
+    """Call fn(timeout) within the remaining budget and return its result.
+
+    fn gets the seconds left and should pass them to the RPC as its timeout.
+    Transient failures are retried with jittered exponential backoff, but only
+    for idempotent calls. With hedge (and UPSTREAM_HEDGING) a second attempt
+    starts when the first takes longer than the service's recent p95 latency.
+    Raises DeadlineExceeded when the budget runs out and UpstreamUnavailable
+    while the service's circuit breaker is open.
+    """
+    state = _service(service)
+    ends = _deadline.get() or time.monotonic() + settings.UPSTREAM_DEADLINE
+    attempts = 1 + (settings.UPSTREAM_RETRIES if idempotent else 0)
+    hedge = hedge and idempotent and settings.UPSTREAM_HEDGING
+
+    probe = state.admit()
+    try:
+        for attempt in range(attempts):
+            left = ends - time.monotonic()
+            if left <= 0:
+                raise DeadlineExceeded(f"The {service} service did not answer in time.")
+            try:
+                return _attempt(state, fn, ends, hedge)
+            except Exception as e:
+                if not _is_transient(e):
+                    # The service answered, the request itself was wrong
+                    state.succeeded()
+                    raise
+                state.failed()
+                backoff = random.uniform(0, settings.UPSTREAM_BACKOFF * 2 ** attempt)
+                if time.monotonic() + backoff >= ends and not isinstance(e, DeadlineExceeded):
+                    raise DeadlineExceeded(f"The {service} service did not answer in time.") from e
+                if attempt == attempts - 1 or state.is_open or time.monotonic() + backoff >= ends:
+                    raise
+                logger.info(f"Retrying {service} after {type(e).__name__}")
+                state.count("retries")
+                time.sleep(backoff)
+    finally:
+        if probe:
+            state.end_probe()
+
+
+def _attempt(state, fn, ends, hedge):
+    started = time.monotonic()
+    delay = state.hedge_delay() if hedge else None
+    pending = {_get_executor().submit(fn, ends - started)}
+    hedged = None
+    error = None
+    while pending:
+        wake = ends if delay is None or hedged else min(ends, started + delay)
+        done, pending = wait(pending, timeout=max(wake - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is hedged:
+                state.count("hedge_wins")
+            # A hedged win says little about the latency of a single attempt
+            state.succeeded(None if future is hedged else time.monotonic() - started)
+            for other in pending:
+                other.cancel()
+            return result
+        now = time.monotonic()
+        if now >= ends and pending:
+            raise DeadlineExceeded(f"The {state.name} service did not answer in time.")
+        if pending and hedged is None and delay is not None and now >= started + delay:
+            state.count("hedged")
+            hedged = _get_executor().submit(fn, ends - now)
+            pending.add(hedged)
+    raise error
+
+
+def fan_out(fn, items):
+    """Run fn(item) for every item concurrently and return the results in order.
+
+    The workers inherit the caller's deadline. fn should catch its own errors,
+    the first exception raised is re-raised after all items finished.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=len(items), thread_name_prefix="fan-out") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def upstream_stats():
+    with _lock:
+        services = list(_services.values())
+    return {state.name: state.snapshot() for state in services}
+
+
+metrics.register("upstream", upstream_stats)
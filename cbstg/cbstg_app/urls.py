@@ -1,15 +1,23 @@
 from django.urls import path
 
 from .views import myfiles_view, submit_file, download_submitted, transcribe_audio, delete_file, synthesize_speech, \
-    save_synthesized_audio, change_role
+    save_synthesized_audio, change_role, live_transcription_view, metrics_view, export_files, transcribe_stream, \
+    file_peaks, transcription_job, synthesized_audio
 
 urlpatterns = [
     path("notes/", myfiles_view, name='notes_view'),
     path("notes/submit_file", submit_file, name='save_file'),
     path('notes/download_submitted/<int:file_id>/', download_submitted, name='download_submitted'),
     path('notes/transcribe_audio/<int:file_id>/', transcribe_audio, name='transcribe_audio'),
+    path('notes/transcribe_audio/<int:file_id>/stream/', transcribe_stream, name='transcribe_stream'),
+    path('notes/transcriptions/<int:job_id>/', transcription_job, name='transcription_job'),
     path('notes/delete_file/<int:file_id>/', delete_file, name='delete_file'),
+    path('notes/export/', export_files, name='export_files'),
+    path('notes/peaks/', file_peaks, name='file_peaks'),
     path('notes/synthesize_speech/<int:file_id>/', synthesize_speech, name='synthesize_speech'),
+    path('notes/synthesized_audio/<str:token>/<str:codec>/', synthesized_audio, name='synthesized_audio'),
     path('notes/save_synthesized_audio/', save_synthesized_audio, name='save_synthesized_audio'),
+    path('notes/live/', live_transcription_view, name='live_transcription'),
     path('account/', change_role, name='change_role'),
+    path('ops/metrics/', metrics_view, name='metrics'),
 ]
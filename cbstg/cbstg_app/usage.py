@@ -0,0 +1,160 @@
+"""Write-behind usage ledger.
+
+Requests only append UsageEvent objects to an in-process buffer. A background
+thread writes the buffer with one bulk_create every USAGE_FLUSH_INTERVAL
+seconds, or as soon as USAGE_FLUSH_SIZE events are waiting, and the buffer is
+flushed once more at interpreter exit. Each flush recomputes the DailyUsage
+rows it touched, which the admin shows and the limiter rehydrates from when
+its cache counters are gone.
+"""
+import atexit
+import logging
+import threading
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import metrics
+from .models import DailyUsage, UsageEvent
+
+logger = logging.getLogger('cbstg')
+
+_lock = threading.Lock()
+_buffer = []
+_wakeup = threading.Event()
+_flusher = None
+_stats = {"recorded": 0, "flushed": 0, "flushes": 0, "failed_flushes": 0}
+
+
+def record_usage(user_id, action, units=0):
+    with _lock:
+        _buffer.append(UsageEvent(user_id=user_id, action=action, units=int(units), created_at=timezone.now()))
+        _stats["recorded"] += 1
+        full = len(_buffer) >= settings.USAGE_FLUSH_SIZE
+
+    if settings.USAGE_FLUSH_INTERVAL <= 0:
+        # No background thread, flush from the request once the buffer is full
+        if full:
+            flush()
+        return
+    _ensure_flusher()
+    if full:
+        _wakeup.set()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run, name="usage-flusher", daemon=True)
+            _flusher.start()
+            atexit.register(flush)
+
+
+def _run():
+    while True:
+        _wakeup.wait(settings.USAGE_FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Usage flush failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def flush():
+    """Write buffered events and refresh their daily aggregates, returns the number written."""
+    with _lock:
+        events = _buffer[:]
+        _buffer.clear()
+    if not events:
+        return 0
+
+    try:
+        with transaction.atomic():
+            UsageEvent.objects.bulk_create(events)
+            _refresh_daily_usage(events)
+    except DatabaseError:
+        # Keep the events for the next attempt rather than losing them
+        with _lock:
+            _buffer[:0] = events
+            _stats["failed_flushes"] += 1
+        raise
+
+    with _lock:
+        _stats["flushed"] += len(events)
+        _stats["flushes"] += 1
+    return len(events)
+
+
+def _refresh_daily_usage(events):
+    days = {(event.user_id, timezone.localdate(event.created_at)) for event in events}
+    users = {user_id for user_id, _ in days}
+    first_day = min(day for _, day in days)
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+
+    totals = (
+        UsageEvent.objects.filter(user_id__in=users, created_at__gte=start)
+        .annotate(date=TruncDate("created_at"))
+        .values("user_id", "action", "date")
+        .annotate(count=Count("id"), units=Sum("units"))
+    )
+    DailyUsage.objects.bulk_create(
+        [DailyUsage(**row) for row in totals if (row["user_id"], row["date"]) in days],
+        update_conflicts=True,
+        unique_fields=["user", "action", "date"],
+        update_fields=["count", "units"],
+    )
+
+
+def withdraw_usage(user_id, action, units, since):
+    """Remove the event recorded for a charge that was refunded later, e.g. a failed recognition job.
+
+    The first matching event at or after since is removed, from the buffer if
+    it was not written yet, otherwise from the ledger and its DailyUsage row.
+    """
+    with _lock:
+        for index, event in enumerate(_buffer):
+            if event.user_id == user_id and event.action == action and event.units == units \
+                    and event.created_at >= since:
+                del _buffer[index]
+                return
+
+    with transaction.atomic():
+        event = UsageEvent.objects.select_for_update().filter(
+            user_id=user_id, action=action, units=units, created_at__gte=since,
+        ).order_by("created_at").first()
+        if event is None:
+            return
+        event.delete()
+        DailyUsage.objects.filter(user_id=user_id, action=action, date=timezone.localdate(event.created_at)) \
+            .update(count=F("count") - 1, units=F("units") - units)
+
+
+def usage_today(user_id, action):
+    """Today's event count for a user and action, persisted plus still buffered."""
+    today = timezone.localdate()
+    persisted = DailyUsage.objects.filter(user_id=user_id, action=action, date=today) \
+        .values_list("count", flat=True).first() or 0
+    with _lock:
+        pending = sum(
+            1 for event in _buffer
+            if event.user_id == user_id and event.action == action
+            and timezone.localdate(event.created_at) == today
+        )
+    return persisted + pending
+
+
+def usage_stats():
+    with _lock:
+        return {**_stats, "buffered": len(_buffer)}
+
+
+metrics.register("usage_ledger", usage_stats)
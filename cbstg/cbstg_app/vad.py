@@ -0,0 +1,96 @@
+import numpy as np
+
+FRAME_MS = 30
+
+# aggressiveness -> (energy threshold above noise floor in dB, zero-crossing rate
+# that marks unvoiced speech, seconds of silence kept around speech)
+AGGRESSIVENESS_LEVELS = {
+    0: (6.0, 0.35, 0.50),
+    1: (9.0, 0.30, 0.35),
+    2: (12.0, 0.25, 0.20),
+    3: (15.0, 0.20, 0.10),
+}
+
+
+class TimeMap:
+    """Maps positions in trimmed audio back to the original recording.
+
+    Each row of ``segments`` is (original_start, original_end, trimmed_start) in seconds.
+    """
+
+    def __init__(self, segments, original_duration):
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 3)
+        self.original_duration = original_duration
+
+    @property
+    def kept_duration(self):
+        return float(np.sum(self.segments[:, 1] - self.segments[:, 0]))
+
+    @property
+    def removed_seconds(self):
+        return self.original_duration - self.kept_duration
+
+    def cuts(self, sample_rate):
+        """Sample offsets in the trimmed audio where two kept regions were joined."""
+        return [int(round(start * sample_rate)) for start in self.segments[1:, 2]]
+
+    def to_original(self, t):
+        t = np.asarray(t, dtype=np.float64)
+        if not len(self.segments):
+            return t
+        idx = np.searchsorted(self.segments[:, 2], t, side="right") - 1
+        idx = np.clip(idx, 0, len(self.segments) - 1)
+        return self.segments[idx, 0] + (t - self.segments[idx, 2])
+
+
+def speech_mask(audio_data, sample_rate, aggressiveness=2):
+    """Classify fixed-size frames as speech (True) or silence (False)."""
+    energy_threshold, zcr_threshold, keep_seconds = AGGRESSIVENESS_LEVELS[aggressiveness]
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    n_frames = len(audio_data) // frame_len
+    if n_frames == 0:
+        return np.ones(0, dtype=bool), frame_len
+
+    frames = audio_data[:n_frames * frame_len].reshape(n_frames, frame_len)
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-12)
+    zcr = np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1)
+
+    noise_floor = np.percentile(energy_db, 10)
+    if energy_db.max() - noise_floor < energy_threshold:
+        # No clear separation between speech and background, keep everything
+        return np.ones(n_frames, dtype=bool), frame_len
+
+    voiced = energy_db > noise_floor + energy_threshold
+    unvoiced = (energy_db > noise_floor + energy_threshold / 2) & (zcr > zcr_threshold)
+    mask = voiced | unvoiced
+
+    # Hangover: keep a little silence on both sides of every speech frame
+    pad = int(keep_seconds * 1000 / FRAME_MS / 2)
+    if pad:
+        mask = np.convolve(mask, np.ones(2 * pad + 1), mode="same") > 0
+    return mask, frame_len
+
+
+def trim_silence(audio_data, sample_rate, aggressiveness=2):
+    """Drop leading/trailing silence and shorten long pauses in mono audio.
+
+    Returns the trimmed samples and a TimeMap back to the original timeline.
+    """
+    duration = len(audio_data) / sample_rate
+    mask, frame_len = speech_mask(audio_data, sample_rate, aggressiveness)
+
+    if not mask.any() or mask.all():
+        return audio_data, TimeMap([(0.0, duration, 0.0)], duration)
+
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1) * frame_len
+    ends = np.flatnonzero(edges == -1) * frame_len
+    if ends[-1] == len(mask) * frame_len:
+        ends[-1] = len(audio_data)
+
+    lengths = ends - starts
+    trimmed_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    trimmed = np.concatenate([audio_data[s:e] for s, e in zip(starts, ends)])
+
+    segments = np.column_stack((starts, ends, trimmed_starts)) / sample_rate
+    return trimmed, TimeMap(segments, duration)
@@ -1,29 +1,52 @@
 import base64
+import hashlib
 import io
+import json
+import math
 from datetime import timedelta
 import os
-import pymupdf
 
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from django.db.models import Q
-from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest
+from django.http import FileResponse, Http404, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, \
+    JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect
-from django.utils import timezone
-from django.views.decorators.http import require_POST
-from google.cloud import storage, speech, texttospeech
-from google.cloud import translate_v2 as translate
-import soundfile as sf
-import numpy as np
-from scipy.signal import resample
+from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, urlencode
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition, require_POST
 from .models import Role
 
+from . import metrics, upstream
+from .blobs import save_submitted_file
+from .dsp import PEAK_BUCKETS, SharedBuffer, extract_pdf_text, prepare_for_recognition, split_at_pauses, \
+    unpack_peaks
 from .forms import SubmittedFileForm
-from .models import SubmittedFile
-from .limits import check_and_increment_limit, initialize_limit_if_needed, is_within_file_limit
+from .models import RecognitionJob, SubmittedFile
+from .emulators import speech_client
+from .export import stream_zip
+from .middleware import accepted_encodings
+from .langid import SUPPORTED_LANGUAGES, detect, get_stt_language_hint, plan_translation, \
+    plan_translations, remember_stt_language
+from .listing import CSRF_PLACEHOLDER, get_cached_listing, get_listing_version, listing_etag, set_cached_listing
+from .limits import check_and_increment_limit, initialize_limit_if_needed, is_within_file_limit, refund_limit
+from .peaks import ensure_peaks, get_peaks, store_peaks
+from .recognition import poll, recognized_seconds, remember_audio_format, running_job, start_recognition, \
+    storage_uri
+from .renditions import CLIENT_HINTS, CODECS, audio_sources, choose_profile, get_master, get_rendition, load_master, \
+    master_digest, persist_master, rendition_key, requested_profile, store_master
+from .singleflight import content_id, single_flight
+from .streaming import stream_in_thread
+from .translation import translate_text, translate_texts
+from .upstream import UpstreamUnavailable, deadline
+from .usage import record_usage
+from .workers import PoolBusy, run_cpu_bound
 import logging
 
 logger = logging.getLogger('cbstg')  # Use your app's logger
@@ -35,12 +58,11 @@ def submit_file(request):
         logger.info("File submittion")
         form = SubmittedFileForm(request.POST, request.FILES)
         if form.is_valid():
-            submitted_file = form.save(commit=False)
-            submitted_file.user = request.user
             uploaded_file = request.FILES.get("file")
 
             filename = uploaded_file.name
             ext = os.path.splitext(filename)[-1].lower()
+            info = None
 
             try:
                 if ext in ['.txt', '.pdf']:
@@ -55,10 +77,13 @@ def submit_file(request):
                             'error': f"Character limit exceeded."
                         })
 
-                elif ext in ['.mp3', '.wav']:
+                elif ext in ['.mp3', '.wav', '.flac']:
                     # --- LIMIT AUDIO DURATION ---
-                    audio_data, sample_rate = sf.read(uploaded_file)  # or .flac, .ogg, etc.
-                    duration_seconds = len(audio_data) // sample_rate
+                    import soundfile as sf
+
+                    # Header only, no need to decode the whole recording
+                    info = sf.info(uploaded_file)
+                    duration_seconds = info.frames // info.samplerate
 
                     if not is_within_file_limit(request.user, "audio_duration", duration_seconds):
                         logger.info(f"Audio duration limit exceeded, duration: {duration_seconds}")
@@ -69,9 +94,21 @@ def submit_file(request):
                         })
 
                 # --- ZAPIS ---
-                submitted_file.save()
+                # Hashed by HashingUploadHandler while the upload streamed in
+                digest = getattr(request, "upload_digests", {}).get("file")
+                saved = save_submitted_file(request.user, filename, uploaded_file, digest)
+                if saved.is_audio:
+                    uploaded_file.seek(0)
+                    ensure_peaks(saved, uploaded_file.read())
+                if info is not None:
+                    remember_audio_format(saved, info)
                 return redirect('notes_view')
 
+            except PoolBusy as e:
+                return _busy_response(request, 'notes/submit_file.html', {
+                    'form': form,
+                    'error': str(e)
+                })
             except Exception as e:
                 logger.error(f"Error in submit_file: {e}")
                 return render(request, 'notes/submit_file.html', {
@@ -84,17 +121,47 @@ def submit_file(request):
     return render(request, 'notes/submit_file.html', {'form': form})
 
 
+def _file_etag(submitted_file):
+    if submitted_file.blob_id is not None:
+        # Blob keys are the SHA-256 of the content
+        return f'"{submitted_file.blob.key[:64]}"'
+    # Files saved before deduplication are never rewritten in place
+    digest = hashlib.sha256(f"{submitted_file.file.name}:{submitted_file.modified_at.isoformat()}".encode())
+    return f'"{digest.hexdigest()}"'
+
+
 @login_required
 def download_submitted(request, file_id):
     try:
-        submitted_text = SubmittedFile.objects.get(id=file_id, user=request.user)
+        submitted_text = SubmittedFile.objects.select_related("blob").get(id=file_id, user=request.user)
     except SubmittedFile.DoesNotExist as e:
         logger.error(f"Error in download_submitted: {e}")
         raise Http404("File not found.")
 
+    file_path = submitted_text.file.name
+    filename = submitted_text.display_name
+    # GCS only transcodes gzip, zstd objects are decompressed here for clients
+    # without zstd. Only these bodies carry validators, a redirect's signed URL
+    # expires, so they alone are answered with 304, before any storage call
+    if default_storage.text_codec(file_path) == "zstd" and "zstd" not in accepted_encodings(request):
+        etag = _file_etag(submitted_text)
+        last_modified = int(submitted_text.modified_at.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            try:
+                response = FileResponse(default_storage.open(file_path, "rb"), as_attachment=True,
+                                        filename=filename)
+            except Exception as e:
+                logger.error(f"Error in download_submitted: {e}")
+                raise Http404(f"Problem during file download: {e}")
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+
     try:
-        file_path = submitted_text.file.name
-        filename = submitted_text.file.name.split("/")[-1]
+        from google.cloud import storage
 
         # Initialize GCS client
         if settings.SERVICE_NAME is None:  # local development
@@ -120,37 +187,129 @@ def download_submitted(request, file_id):
         raise Http404(f"Problem during file download: {e}")
 
 
+def _listing_version(request):
+    # Shared by the condition callbacks and the view, looked up once per request
+    if not hasattr(request, "listing_version"):
+        request.listing_version = get_listing_version(request.user.id)
+    return request.listing_version
+
+
+def _myfiles_etag(request):
+    get_token(request)
+    return listing_etag(request.user, _listing_version(request), request.META["CSRF_COOKIE"])
+
+
+# No Last-Modified: deleting the newest file moves the latest modification back
 @login_required(login_url="/login")
+@condition(etag_func=_myfiles_etag)
 def myfiles_view(request):
     user = request.user
 
-    try:
-        # Get all submitted files for the user
-        files = SubmittedFile.objects.filter(user=user).order_by("-creation_date")
-
-        # Define audio extensions
-        audio_extensions = [".wav", ".mp3", ".m4a", ".aac", ".ogg", ".flac", ".webm"]
-
-        # Build a Q object to OR-match all audio extensions
-        audio_query = Q()
-        for ext in audio_extensions:
-            audio_query |= Q(file__iendswith=ext)
+    # The file tables only change on upload, save or delete, which all change
+    # the version (see listing.py), so they are rendered once per version
+    version = _listing_version(request)
+    file_tables = get_cached_listing(user.id, version)
 
-        # Filter audio and text files
-        audio_files = files.filter(audio_query)
-        text_files = files.exclude(audio_query)
+    if file_tables is None:
+        # Get all submitted files for the user in one query, split by extension
+        files = SubmittedFile.objects.filter(user=user).order_by("-creation_date")
+        audio_files = [f for f in files if f.is_audio]
+        text_files = [f for f in files if not f.is_audio]
 
-    except ObjectDoesNotExist:
-        logger.info("No file objects present")
-        audio_files = None
-        text_files = None
+        file_tables = render_to_string("notes/file_tables.html", {
+            "audio_files": audio_files,
+            "text_files": text_files,
+            "csrf_token": CSRF_PLACEHOLDER,
+        })
+        set_cached_listing(user.id, version, file_tables)
     logger.info("Rendering myfiles view")
 
-    return render(
+    response = render(
         request,
         "notes/myfiles.html",
-        {"audio_files": audio_files, "text_files": text_files}
+        {"file_tables": mark_safe(file_tables.replace(CSRF_PLACEHOLDER, get_token(request)))}
     )
+    # Lets synthesized_audio pick the bitrate for the connection
+    response["Accept-CH"] = CLIENT_HINTS
+    # Revalidated on every visit, unchanged listings are answered with 304
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required(login_url="/login")
+def export_files(request):
+    files = SubmittedFile.objects.filter(user=request.user).order_by("creation_date", "id")
+    selected = request.GET.getlist("file_id")
+    if selected:
+        try:
+            files = files.filter(id__in=[int(file_id) for file_id in selected])
+        except ValueError:
+            return HttpResponseBadRequest("Invalid file id.")
+
+    entries = []
+    used_names = set()
+    for submitted_file in files:
+        arcname = submitted_file.display_name
+        stem, ext = os.path.splitext(arcname)
+        copy = 1
+        while arcname in used_names:
+            copy += 1
+            arcname = f"{stem} ({copy}){ext}"
+        used_names.add(arcname)
+        date = submitted_file.creation_date
+        entries.append((submitted_file.file.name, arcname, (date.year, date.month, date.day, 0, 0, 0)))
+
+    logger.info(f"Exporting {len(entries)} files")
+    response = StreamingHttpResponse(stream_in_thread(stream_zip(entries, settings.EXPORT_PREFETCH)),
+                                     content_type="application/zip")
+    response["Content-Disposition"] = 'attachment; filename="cbstg-export.zip"'
+    return response
+
+
+@login_required(login_url="/login")
+def file_peaks(request):
+    """Waveform peaks of the user's audio files, for the listing to draw.
+
+    Returns {"buckets": n, "files": {id: {"duration", "peaks"}}}, peaks being
+    base64 interleaved int8 (min, max) pairs. Peaks never change for a file,
+    so complete answers are cached by the browser.
+    """
+    try:
+        file_ids = [int(file_id) for file_id in request.GET.getlist("file_id")]
+        buckets = int(request.GET.get("buckets", PEAK_BUCKETS[0]))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid file id or bucket count.")
+    if buckets not in PEAK_BUCKETS:
+        return HttpResponseBadRequest(f"Bucket count must be one of {', '.join(map(str, PEAK_BUCKETS))}.")
+
+    files = SubmittedFile.objects.filter(user=request.user, id__in=file_ids[:settings.PEAKS_MAX_FILES]) \
+        .select_related("blob")
+    backfill = settings.PEAKS_BACKFILL_PER_REQUEST
+    complete = True
+    result = {}
+    for submitted_file in files:
+        if not submitted_file.is_audio:
+            continue
+        peaks = get_peaks(submitted_file)
+        if peaks is None and backfill > 0:
+            # Older files are summarised a few at a time
+            backfill -= 1
+            peaks = ensure_peaks(submitted_file)
+        if peaks is None:
+            complete = False
+            continue
+        duration, levels = unpack_peaks(peaks)
+        result[str(submitted_file.id)] = {
+            "duration": round(duration, 2),
+            "peaks": base64.b64encode(levels[buckets]).decode(),
+        }
+
+    response = JsonResponse({"buckets": buckets, "files": result})
+    if complete:
+        patch_cache_control(response, private=True, max_age=settings.PEAKS_MAX_AGE)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
 
 
 @require_POST
@@ -158,8 +317,9 @@ def myfiles_view(request):
 def delete_file(request, file_id):
     try:
         file = SubmittedFile.objects.get(id=file_id, user=request.user)
-        file.file.delete()  # Deletes the file from storage
-        file.delete()  # Deletes the database record
+        if file.blob_id is None:
+            file.file.delete(save=False)  # Deletes the file from storage
+        file.delete()  # Deletes the database record, a shared blob only loses a reference
         logger.info(f"Deleted file {file_id}")
 
     except SubmittedFile.DoesNotExist:
@@ -167,76 +327,136 @@ def delete_file(request, file_id):
     return redirect('notes_view')
 
 
+def _recognition_pcm(submitted_file):
+    """Return (16 kHz LINEAR16 bytes, number of samples, vad.TimeMap) for a recording."""
+    with default_storage.open(submitted_file.file.name, "rb") as audio_file:
+        raw_audio = audio_file.read()
+
+    # Decode, convert to 16 kHz mono and drop silent regions (we pay for every
+    # second sent to the API) in the worker pool, samples come back as raw PCM
+    with SharedBuffer(raw_audio) as shared_audio:
+        pcm_name, num_samples, time_map, peaks = run_cpu_bound(
+            prepare_for_recognition, shared_audio.name, shared_audio.size,
+            settings.VAD_ENABLED, settings.VAD_AGGRESSIVENESS,
+        )
+    with SharedBuffer(name=pcm_name) as pcm:
+        pcm_data = bytes(pcm.shm.buf[:num_samples * 2])
+    if settings.VAD_ENABLED:
+        logger.info(f"Silence trimming removed {time_map.removed_seconds:.2f}s "
+                    f"of {time_map.original_duration:.2f}s audio")
+    # Files uploaded before waveforms existed get theirs on their first transcription
+    store_peaks(submitted_file, peaks)
+    return pcm_data, num_samples, time_map
+
+
+def _recognize(client, pcm_data, input_lang, user_id):
+    from google.cloud import speech
+
+    recognition_audio = speech.RecognitionAudio(content=pcm_data)
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        language_code=input_lang,
+        # Language earlier recordings were detected in despite their label
+        alternative_language_codes=_stt_alternatives(user_id, input_lang),
+        sample_rate_hertz=16000,  # Standardized sample rate
+        enable_automatic_punctuation=True,
+    )
+
+    response = upstream.call("speech", lambda timeout: client.recognize(
+        config=config, audio=recognition_audio, timeout=timeout, retry=None))
+    logger.info(f"Getting response from SpeechClient")
+    return " ".join([result.alternatives[0].transcript for result in response.results])
+
+
+def _transcribe(user, submitted_file, input_lang, target_langs):
+    """Charge the daily STT limit, recognize once and translate into every target language.
+
+    Returns ({target language: (transcript, translation error)}, error), the
+    error is set when nothing could be transcribed.
+    """
+    # --- LIMIT CHECK ---
+    initialize_limit_if_needed(user, "daily_stt")
+    if not check_and_increment_limit(user, "daily_stt"):
+        return {}, "Daily STT limit exceeded."
+    logger.info(f"File submitted for transcription")
+
+    seconds = 0
+    try:
+        client = speech_client()
+        logger.info(f"Connecting to SpeechClient")
+        pcm_data, num_samples, _ = _recognition_pcm(submitted_file)
+        seconds = math.ceil(num_samples / 16000)
+        transcript = _recognize(client, pcm_data, input_lang, user.id)
+
+        plans = plan_translations(transcript, input_lang, target_langs)
+        remember_stt_language(user.id, input_lang, plans[target_langs[0]].detected)
+        return translate_texts(transcript, plans, user_id=user.id), None
+
+    except (PoolBusy, UpstreamUnavailable):
+        refund_limit(user, "daily_stt")
+        seconds = None
+        raise
+    except Exception as e:
+        error = "Transcription failed: " + str(e)
+        logger.error(error)
+        return {}, error
+    finally:
+        # One ledger event per charge that stands, the limiter rehydrates from them
+        if seconds is not None:
+            record_usage(user.id, "stt", seconds)
+
+
 @login_required(login_url="/login")
 def transcribe_audio(request, file_id):
     transcript = None
-    err1 = None
     err2 = None
     if request.method == 'GET':
         try:
-            submitted_file = SubmittedFile.objects.get(id=file_id, user=request.user)
-            input_lang = request.GET.get("input_lang", "en")
-            target_lang = request.GET.get("target_lang", "en")
-
-            # --- LIMIT CHECK ---
-            initialize_limit_if_needed(request.user, "daily_stt")
-            if not check_and_increment_limit(request.user, "daily_stt"):
-                return render(request, "notes/text/viewText.html", {
-                    "transcript": None,
-                    "error": "Daily STT limit exceeded."
-                })
-            logger.info(f"File submitted for transcription")
-
+            submitted_file = SubmittedFile.objects.select_related("blob").get(id=file_id, user=request.user)
         except SubmittedFile.DoesNotExist:
             raise Http404("File not found.")
+        input_lang = request.GET.get("input_lang", "en")
+        target_langs = _target_languages(request)
+
+        # Streaming wins over recognition from storage, segments show up as
+        # they are recognized and silence is trimmed
+        if request.GET.get("stream") and len(target_langs) == 1:
+            # The page fills itself from transcribe_stream as segments finish
+            query = urlencode({"input_lang": input_lang, "target_lang": target_langs[0]})
+            return render(request, "notes/text/streamText.html", {
+                "stream_url": f"{reverse('transcribe_stream', args=[file_id])}?{query}",
+            })
 
-        try:
-            client = speech.SpeechClient()
-            logger.info(f"Connecting to SpeechClient")
-            with default_storage.open(submitted_file.file.name, "rb") as audio_file:
-                audio_data = io.BytesIO(audio_file.read())
-
-            # Read the audio file
-            audio_data, sample_rate = sf.read(audio_data)  # or .flac, .ogg, etc.
-
-            # If stereo, convert to mono by averaging channels
-            if len(audio_data.shape) > 1 and audio_data.shape[1] > 1:
-                audio_data = np.mean(audio_data, axis=1)
-
-            # Resample to 16000 Hz if needed
-            target_rate = 16000
-            if sample_rate != target_rate:
-                num_samples = int(len(audio_data) * target_rate / sample_rate)
-                audio_data = resample(audio_data, num_samples)
-                sample_rate = target_rate
-
-            # Save converted audio to memory
-            wav_data = io.BytesIO()
-            sf.write(wav_data, audio_data, sample_rate, format='WAV')
-            wav_data.seek(0)
-
-            recognition_audio = speech.RecognitionAudio(content=wav_data.read())
-            config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                language_code=input_lang,
-                sample_rate_hertz=16000,  # Standardized sample rate
-                enable_automatic_punctuation=True,
-            )
-
-            response = client.recognize(config=config, audio=recognition_audio)
-            logger.info(f"Getting response from SpeechClient")
-            transcript = " ".join([result.alternatives[0].transcript for result in response.results])
-
-            if target_lang != input_lang:
-                transcript, err1 = translate_text(transcript, target_lang)
+        uri = storage_uri(submitted_file)
+        if uri:
+            # The Speech API reads the recording from the bucket itself
+            return _start_recognition_job(request, submitted_file, uri, input_lang, target_langs)
 
-        except Exception as e:
-            err2 = "Transcription failed: " + str(e)
-            logger.error(err2)
+        # A double click or a second tab waits for the transcription already
+        # running for the same recording instead of paying for another one
+        key = ("transcribe", request.user.id, content_id(submitted_file), input_lang, tuple(target_langs))
+        try:
+            with deadline(settings.UPSTREAM_DEADLINE):
+                (transcripts, error), _ = single_flight.do(
+                    key, lambda: _transcribe(request.user, submitted_file, input_lang, target_langs))
+        except (PoolBusy, UpstreamUnavailable) as e:
+            return _busy_response(request, "notes/text/viewText.html", {
+                "transcript": None,
+                "error": str(e),
+            })
 
+        if len(target_langs) > 1:
+            return render(request, "notes/text/viewTexts.html", {
+                "transcripts": [
+                    {"language": language, "transcript": transcript, "error": translation_error}
+                    for language, (transcript, translation_error) in transcripts.items()
+                ],
+                "error": error,
+            })
+        transcript, translation_error = transcripts.get(target_langs[0], (None, None))
         return render(request, "notes/text/viewText.html", {
             "transcript": transcript,
-            "error": err1 or err2 if (err1 and err2) is None else err1 + "\n" + err2,
+            "error": "\n".join(filter(None, [translation_error, error])) or None,
         })
     elif request.method == 'POST':
         filename = request.POST.get('filename', 'transcription.txt')
@@ -245,15 +465,7 @@ def transcribe_audio(request, file_id):
 
         try:
             # Save the transcript as a new SubmittedFile (text)
-            new_file = SubmittedFile(
-                user=request.user,
-                file=None  # We will set this in memory below
-            )
-
-            # Create the file in memory
-
-            new_file.file.save(filename, ContentFile(request.POST.get('transcript', '').encode()), save=False)
-            new_file.save()
+            save_submitted_file(request.user, filename, ContentFile(request.POST.get('transcript', '').encode()))
             return redirect('notes_view')
         except Exception as e:
             err2 = f"Failed to save transcription: {e}"
@@ -267,6 +479,149 @@ def transcribe_audio(request, file_id):
     return redirect('notes_view')
 
 
+def _start_recognition_job(request, submitted_file, uri, input_lang, target_langs):
+    job = running_job(request.user, submitted_file, input_lang, target_langs)
+    if job is None:
+        initialize_limit_if_needed(request.user, "daily_stt")
+        if not check_and_increment_limit(request.user, "daily_stt"):
+            return render(request, "notes/text/viewText.html", {"error": "Daily STT limit exceeded."})
+        try:
+            with deadline(settings.UPSTREAM_DEADLINE):
+                job = start_recognition(speech_client(), request.user, submitted_file, uri, input_lang, target_langs)
+        except UpstreamUnavailable as e:
+            refund_limit(request.user, "daily_stt")
+            return _busy_response(request, "notes/text/viewText.html", {"error": str(e)})
+        except Exception as e:
+            refund_limit(request.user, "daily_stt")
+            logger.error(f"Transcription failed: {e}")
+            return render(request, "notes/text/viewText.html", {"error": f"Transcription failed: {e}"})
+        # The charge stands from here, a failed job withdraws the event with its refund (see recognition.poll)
+        record_usage(request.user.id, "stt", recognized_seconds(submitted_file))
+    return redirect("transcription_job", job.pk)
+
+
+@login_required(login_url="/login")
+def transcription_job(request, job_id):
+    try:
+        job = RecognitionJob.objects.select_related("source__blob", "user").get(id=job_id, user=request.user)
+    except RecognitionJob.DoesNotExist:
+        raise Http404("Transcription not found.")
+
+    try:
+        with deadline(settings.UPSTREAM_DEADLINE):
+            job = poll(speech_client(), job)
+    except UpstreamUnavailable as e:
+        # Still running as far as anyone knows, the next reload asks again
+        logger.info(f"Polling {job.operation} failed: {e}")
+    return render(request, "notes/text/jobText.html", {
+        "job": job,
+        "poll_seconds": settings.RECOGNITION_POLL_SECONDS,
+    })
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _transcription_events(user, submitted_file, input_lang, target_lang):
+    """Server-Sent Events for a transcription, one "segment" per chunk of speech.
+
+    Every segment is recognized and translated on its own, the last event is
+    "done" with the assembled transcript or "error" when nothing can be shown.
+    """
+    initialize_limit_if_needed(user, "daily_stt")
+    if not check_and_increment_limit(user, "daily_stt"):
+        yield _sse("error", {"error": "Daily STT limit exceeded."})
+        return
+    logger.info(f"File submitted for streamed transcription")
+
+    try:
+        client = speech_client()
+        pcm_data, num_samples, time_map = _recognition_pcm(submitted_file)
+    except (PoolBusy, UpstreamUnavailable) as e:
+        refund_limit(user, "daily_stt")
+        yield _sse("error", {"error": str(e)})
+        return
+    except Exception as e:
+        logger.error(f"Transcription failed: {e}")
+        record_usage(user.id, "stt", 0)
+        yield _sse("error", {"error": f"Transcription failed: {e}"})
+        return
+
+    sources = []
+    results = []
+    errors = []
+    recognized_samples = 0
+    refunded = False
+    chunks = split_at_pauses(num_samples, time_map.cuts(16000), int(settings.TRANSCRIPT_STREAM_CHUNK_SECONDS * 16000))
+    try:
+        for index, (start, end) in enumerate(chunks):
+            try:
+                # Each segment gets the budget of a whole request, a long file takes longer
+                with deadline(settings.UPSTREAM_DEADLINE):
+                    source = _recognize(client, pcm_data[start * 2:end * 2], input_lang, user.id)
+                    recognized_samples += end - start
+                    result, error = source, None
+                    plan = plan_translation(source, input_lang, target_lang)
+                    if source and plan.translate:
+                        result, error = translate_text(source, target_lang, plan.source, user_id=user.id)
+            except Exception as e:
+                if isinstance(e, UpstreamUnavailable) and not results:
+                    refund_limit(user, "daily_stt")
+                    refunded = True
+                error = f"Transcription failed: {e}"
+                logger.error(error)
+                errors.append(error)
+                break
+            sources.append(source)
+            results.append(result)
+            if error:
+                errors.append(error.strip())
+            if source:
+                # Positions on the original recording, silence trimming shifted them
+                yield _sse("segment", {
+                    "index": index,
+                    "start": round(float(time_map.to_original(start / 16000)), 3),
+                    "end": round(float(time_map.to_original((end - 1) / 16000)) + 1 / 16000, 3),
+                    "transcript": result,
+                })
+
+        remember_stt_language(user.id, input_lang, detect(" ".join(sources))[0])
+        yield _sse("done", {
+            "transcript": " ".join(filter(None, results)),
+            "error": "\n".join(errors) or None,
+        })
+    finally:
+        # One ledger event for the request's one charge, also when the client leaves midway
+        if not refunded:
+            record_usage(user.id, "stt", math.ceil(recognized_samples / 16000))
+
+
+@login_required(login_url="/login")
+def transcribe_stream(request, file_id):
+    try:
+        submitted_file = SubmittedFile.objects.get(id=file_id, user=request.user)
+    except SubmittedFile.DoesNotExist:
+        raise Http404("File not found.")
+
+    # Each segment is sent as soon as it is translated, see streaming.py
+    response = StreamingHttpResponse(
+        stream_in_thread(_transcription_events(request.user, submitted_file, request.GET.get("input_lang", "en"),
+                                               request.GET.get("target_lang", "en"))),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Keep proxies from holding segments back until the response ends
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@login_required(login_url="/login")
+def live_transcription_view(request):
+    # Audio is streamed over the /ws/live/ websocket, see consumers.py
+    return render(request, "notes/live.html")
+
+
 def extract_text_from_file(file_obj, filename=None):
     ext = os.path.splitext(filename)[-1].lower() if filename else ''
 
@@ -274,12 +629,8 @@ def extract_text_from_file(file_obj, filename=None):
         return file_obj.read().decode("utf-8")
 
     elif ext == ".pdf":
-        file_bytes = file_obj.read()
-        doc = pymupdf.open(stream=file_bytes, filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        return text
+        with SharedBuffer(file_obj.read()) as shared_pdf:
+            return run_cpu_bound(extract_pdf_text, shared_pdf.name, shared_pdf.size)
 
     else:
         logger.error(
@@ -287,41 +638,60 @@ def extract_text_from_file(file_obj, filename=None):
         raise ValueError("Unsupported file type. Only .txt and .pdf are supported.")
 
 
-@login_required
-def synthesize_speech(request, file_id):
-    err1 = None
+def _synthesize(user, text_file, input_lang, target_langs):
+    """Charge the daily TTS limit, extract the text once and synthesize it in every target language.
+
+    Returns ([{"language", "audio_key", "text", "synthesized", "error"}, ...],
+    error), the languages are translated and synthesized concurrently.
+    audio_key is the persisted master's token (see renditions.py),
+    synthesized is False for masters found in the cache.
+    """
+    # --- LIMIT CHECK ---
+    initialize_limit_if_needed(user, "daily_tts")
+    if not check_and_increment_limit(user, "daily_tts"):
+        return [], "Daily TTS limit exceeded."
+
+    # One ledger event per charge that stands, units are the characters
+    # synthesized, none for cached masters
+    synthesized_chars = 0
     try:
-        text_file = SubmittedFile.objects.get(id=file_id, user=request.user)
-        input_lang = request.GET.get("input_lang", "en")
-        target_lang = request.GET.get("target_lang", "en")
+        syntheses = _synthesize_charged(user, text_file, input_lang, target_langs)
+        synthesized_chars = sum(len(synthesis["text"]) for synthesis in syntheses if synthesis["synthesized"])
+        return syntheses, None
+    except (PoolBusy, UpstreamUnavailable):
+        refund_limit(user, "daily_tts")
+        synthesized_chars = None
+        raise
+    finally:
+        if synthesized_chars is not None:
+            record_usage(user.id, "tts", synthesized_chars)
 
-        # --- LIMIT CHECK ---
-        initialize_limit_if_needed(request.user, "daily_tts")
-        if not check_and_increment_limit(request.user, "daily_tts"):
-            return render(request, "notes/audio/viewAudio.html", {
-                "audio_data": None,
-                "file_id": file_id,
-                "text": "",
-                "error": "Daily TTS limit exceeded."
-            })
 
-        with default_storage.open(text_file.file.name, "rb") as f:
-            text = extract_text_from_file(f, text_file.file.name)
+def _synthesize_charged(user, text_file, input_lang, target_langs):
+    """_synthesize once the limit is charged, returns the list of syntheses."""
+    with default_storage.open(text_file.file.name, "rb") as f:
+        text = extract_text_from_file(f, text_file.file.name)
 
-        if not text.strip():
-            logger.error(f"Error: File is empty.")
-            raise ValueError("File is empty.")
+    if not text.strip():
+        logger.error(f"Error: File is empty.")
+        raise ValueError("File is empty.")
 
-        if target_lang != input_lang:
-            text, err1 = translate_text(text, target_lang)
-            text = text.encode("utf-8")
-            logger.info(f"Error while translating text: {err1}")
+    # Text already in a target language is not sent to the API
+    translations = translate_texts(text, plan_translations(text, input_lang, target_langs), user_id=user.id)
 
-        # Initialize the TTS client
-        logger.info(f"Connecting to TextToSpeechClient")
-        client = texttospeech.TextToSpeechClient()
+    # Initialize the TTS client
+    from google.cloud import texttospeech
 
-        synthesis_input = texttospeech.SynthesisInput(text=text)
+    logger.info(f"Connecting to TextToSpeechClient")
+    client = texttospeech.TextToSpeechClient()
+
+    def synthesize(target_lang):
+        master_key = rendition_key(translations[target_lang][0], target_lang)
+        master = get_master(master_key)
+        if master is not None:
+            return master, False, None
+
+        synthesis_input = texttospeech.SynthesisInput(text=translations[target_lang][0])
 
         voice = texttospeech.VoiceSelectionParams(
             language_code=target_lang,
@@ -332,46 +702,120 @@ def synthesize_speech(request, file_id):
             audio_encoding=texttospeech.AudioEncoding.MP3
         )
 
-        logger.info(f"Getting response from TextToSpeechClient")
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
+        try:
+            response = upstream.call("text-to-speech", lambda timeout: client.synthesize_speech(
+                input=synthesis_input, voice=voice, audio_config=audio_config, timeout=timeout, retry=None,
+            ), hedge=True)
+        except Exception as e:
+            return None, False, e
+        store_master(master_key, response.audio_content)
+        return response.audio_content, True, None
+
+    logger.info(f"Getting response from TextToSpeechClient")
+    responses = upstream.fan_out(synthesize, target_langs)
+    failures = [error for _, _, error in responses if error is not None]
+    if len(failures) == len(target_langs) and all(isinstance(e, UpstreamUnavailable) for e in failures):
+        raise failures[0]
+
+    syntheses = []
+    for target_lang, (master, synthesized, error) in zip(target_langs, responses):
+        translated, translation_error = translations[target_lang]
+        audio_key = None
+        if master is not None:
+            audio_key = persist_master(master)
+        else:
+            logger.error(f"Synthesis in {target_lang} failed: {error}")
+        syntheses.append({
+            "language": target_lang,
+            "audio_key": audio_key,
+            "text": translated,
+            "synthesized": synthesized,
+            "error": "\n".join(filter(None, [translation_error, error and f"Synthesis failed: {error}"])) or None,
+        })
+    return syntheses
+
 
-        # Return as downloadable audio file
-        # response_audio = HttpResponse(response.audio_content, content_type="audio/mpeg")
-        # response_audio["Content-Disposition"] = f'attachment; filename="synthesized_{file_id}.mp3"'
-        # return response_audio
-        # Save audio to a temporary file
-        # Store audio in memory
-        audio_buffer = io.BytesIO(response.audio_content)
-        audio_base64 = base64.b64encode(audio_buffer.getvalue()).decode('utf-8')
-
-        # Show playback and allow user to save
-        return render(request, "notes/audio/viewAudio.html", {
-            "audio_data": audio_base64,
+@login_required
+def synthesize_speech(request, file_id):
+    try:
+        text_file = SubmittedFile.objects.get(id=file_id, user=request.user)
+        input_lang = request.GET.get("input_lang", "en")
+        target_langs = _target_languages(request)
+        profile = requested_profile(request)
+
+        # Several tabs asking for the same file and languages share one synthesis
+        key = ("synthesize", request.user.id, content_id(text_file), input_lang, tuple(target_langs))
+        with deadline(settings.UPSTREAM_DEADLINE):
+            (syntheses, error), _ = single_flight.do(
+                key, lambda: _synthesize(request.user, text_file, input_lang, target_langs))
+        syntheses = [
+            {**synthesis, "sources": audio_sources(synthesis["audio_key"], profile) if synthesis["audio_key"] else None}
+            for synthesis in syntheses
+        ]
+
+        if len(target_langs) > 1:
+            response = render(request, "notes/audio/viewAudios.html", {
+                "syntheses": syntheses,
+                "file_id": file_id,
+                "error": error,
+            })
+        else:
+            # Show playback and allow user to save
+            context = syntheses[0] if syntheses else {"sources": None, "text": "", "error": error}
+            response = render(request, "notes/audio/viewAudio.html", {**context, "file_id": file_id})
+        # The audio requests carry the hints, synthesized_audio picks the bitrate
+        response["Accept-CH"] = CLIENT_HINTS
+        return response
+    except (PoolBusy, UpstreamUnavailable) as e:
+        return _busy_response(request, "notes/audio/viewAudio.html", {
+            "sources": None,
             "file_id": file_id,
-            "text": text,
-            "error": err1,
+            "text": "",
+            "error": str(e),
         })
     except (SubmittedFile.DoesNotExist, ValueError) as e:
         logger.error(f"Error in synthesize_speech {e}")
         raise Http404("Text file not found or invalid.")
 
 
+@login_required
+def synthesized_audio(request, token, codec):
+    """One rendition of a synthesized master, the page's <audio> element lists a source per codec."""
+    digest = master_digest(token)
+    rendition = get_rendition(digest, choose_profile(request, codec)) if digest and codec in CODECS else None
+    if rendition is None:
+        raise Http404("Synthesized audio expired.")
+    audio, content_type = rendition
+    response = HttpResponse(audio, content_type=content_type)
+    # The token names the master, only the client hints change the rendition
+    patch_vary_headers(response, CLIENT_HINTS.split(", "))
+    patch_cache_control(response, private=True, max_age=settings.TTS_CACHE_TIMEOUT)
+    return response
+
+
 @login_required
 @require_POST
 def save_synthesized_audio(request):
     file_id = request.POST.get("file_id")
     filename = request.POST.get("filename")
     audio_data = request.POST.get("audio_data")
+    audio_key = request.POST.get("audio_key")
 
-    if not filename or not audio_data:
+    if not filename or not (audio_data or audio_key):
         return HttpResponseBadRequest("Missing filename or audio data.")
 
     try:
-        decoded_audio = base64.b64decode(audio_data)
-        path = default_storage.save(f"submitted/{filename}.mp3", ContentFile(decoded_audio))
-        SubmittedFile.objects.create(user=request.user, file=path, creation_date=timezone.now())
+        digest = None
+        if audio_key:
+            # The page may play a smaller rendition, the saved file is the master
+            digest = master_digest(audio_key)
+            decoded_audio = load_master(digest) if digest else None
+            if decoded_audio is None:
+                return HttpResponseBadRequest("Synthesized audio expired, please synthesize it again.")
+        else:
+            decoded_audio = base64.b64decode(audio_data)
+        saved = save_submitted_file(request.user, f"{filename}.mp3", ContentFile(decoded_audio), digest)
+        ensure_peaks(saved, decoded_audio)
     except Exception as e:
         logger.error(f"Failed to save audio: {e}")
         return HttpResponse(f"Failed to save audio: {e}", status=500)
@@ -379,19 +823,6 @@ def save_synthesized_audio(request):
     return redirect("notes_view")
 
 
-def translate_text(text, target_language='en'):
-    try:
-        if isinstance(text, bytes):
-            text = text.decode("utf-8")
-        logger.info(f"Connecting to translate Client")
-        client = translate.Client()
-        result = client.translate(text, target_language=target_language)
-        return result["translatedText"], None
-    except Exception as e:
-        logger.error(f"Translation failed: {e}")
-        return text, "Translation failed: " + str(e) + "\n"
-
-
 @login_required
 def change_role(request):
     user = request.user
@@ -421,3 +852,27 @@ def change_role(request):
         'roles': available_roles,
         'current_role': user.role
     })
+
+
+@staff_member_required
+def metrics_view(request):
+    return JsonResponse(metrics.snapshot())
+
+
+def _stt_alternatives(user_id, input_lang):
+    hint = get_stt_language_hint(user_id)
+    return [hint] if hint and hint != input_lang else []
+
+
+def _target_languages(request):
+    """Target languages of a request, repeating target_lang or passing "all" fans out."""
+    targets = request.GET.getlist("target_lang") or ["en"]
+    if "all" in targets:
+        targets = list(SUPPORTED_LANGUAGES)
+    return list(dict.fromkeys(targets))[:len(SUPPORTED_LANGUAGES)]
+
+
+def _busy_response(request, template_name, context):
+    response = render(request, template_name, context, status=503)
+    response["Retry-After"] = "5"
+    return response
@@ -0,0 +1,108 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from . import metrics
+from .dsp import timed_call
+
+logger = logging.getLogger('cbstg')
+
+
+class PoolBusy(Exception):
+    """Raised instead of queueing when the worker pool is saturated."""
+
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+_in_flight = 0
+_stats = {"rejected": 0, "tasks": {}}
+
+
+def _get_executor():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            # Spawned, not forked: the web process runs threads and an event loop
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.DSP_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _slots = threading.BoundedSemaphore(settings.DSP_POOL_MAX_PENDING)
+        return _executor, _slots
+
+
+def run_cpu_bound(fn, *args):
+    """Run fn(*args) in the shared process pool and wait for the result.
+
+    Raises PoolBusy straight away when DSP_POOL_MAX_PENDING tasks are already
+    queued or running, so requests fail fast instead of piling up.
+    """
+    global _executor, _in_flight
+    if not settings.DSP_POOL_ENABLED:
+        return fn(*args)
+
+    executor, slots = _get_executor()
+    if not slots.acquire(blocking=False):
+        with _lock:
+            _stats["rejected"] += 1
+        logger.info(f"Worker pool busy, rejected {fn.__name__}")
+        raise PoolBusy("Server is busy, please try again shortly.")
+
+    with _lock:
+        _in_flight += 1
+    submitted = time.time()
+    try:
+        result, started, finished = executor.submit(timed_call, fn, *args).result()
+    except BrokenProcessPool:
+        logger.error("Worker pool broken, it will be recreated")
+        with _lock:
+            if _executor is executor:
+                _executor = None
+        raise
+    finally:
+        with _lock:
+            _in_flight -= 1
+        slots.release()
+
+    _record(fn.__name__, started - submitted, finished - started)
+    return result
+
+
+def _record(name, wait, run):
+    with _lock:
+        task = _stats["tasks"].setdefault(name, {"count": 0, "wait_total": 0.0, "run_total": 0.0, "run_max": 0.0})
+        task["count"] += 1
+        task["wait_total"] += max(wait, 0.0)
+        task["run_total"] += run
+        task["run_max"] = max(task["run_max"], run)
+
+
+def pool_stats():
+    with _lock:
+        workers = settings.DSP_POOL_WORKERS
+        return {
+            "enabled": settings.DSP_POOL_ENABLED,
+            "workers": workers,
+            "max_pending": settings.DSP_POOL_MAX_PENDING,
+            "in_flight": _in_flight,
+            "queue_depth": max(_in_flight - workers, 0),
+            "rejected": _stats["rejected"],
+            "tasks": {
+                name: {
+                    "count": task["count"],
+                    "avg_wait": task["wait_total"] / task["count"],
+                    "avg_run": task["run_total"] / task["count"],
+                    "max_run": task["run_max"],
+                }
+                for name, task in _stats["tasks"].items()
+            },
+        }
+
+
+metrics.register("dsp_pool", pool_stats)
@@ -13,7 +13,8 @@ resource "google_project_service" "required_services" {
     "iam.googleapis.com",
     "translate.googleapis.com",
     "texttospeech.googleapis.com",
-    "speech.googleapis.com"
+    "speech.googleapis.com",
+    "cloudscheduler.googleapis.com"
   ])
 
   service            = each.key
@@ -48,6 +49,18 @@ resource "google_storage_bucket" "media_files" {
     }
   }
 
+  # Synthesized audio nobody saved, see renditions.py
+  lifecycle_rule {
+    action {
+      type = "Delete"
+    }
+
+    condition {
+      age            = 1
+      matches_prefix = ["tts/"]
+    }
+  }
+
   depends_on = [google_project_service.required_services]
 }
 
@@ -101,12 +114,16 @@ resource "google_sql_database" "app_db" {
   depends_on = [google_project_service.required_services]
 }
 
+data "google_project" "project" {}
+
 # Create local variables
 locals {
   service_account = "serviceAccount:${google_service_account.django_sa.email}"
   repository_id   = google_artifact_registry_repository.main.repository_id
   ar_repository   = "${var.region}-docker.pkg.dev/${var.project_id}/${local.repository_id}"
   image           = "${local.ar_repository}/${var.service_name}"
+  # Deterministic Cloud Run URL, passed to the app so it does not look it up on every cold start
+  service_uri     = "https://${var.service_name}-${data.google_project.project.number}.${var.region}.run.app"
 }
 
 # Secret Manager: DB Password
@@ -256,6 +273,14 @@ resource "google_storage_bucket_iam_binding" "staticfiles" {
   depends_on = [google_project_service.required_services]
 }
 
+# Static assets are content-hashed and served with unsigned, long-cached URLs
+resource "google_storage_bucket_iam_member" "staticfiles_public" {
+  bucket = google_storage_bucket.staticfiles.name
+  role   = "roles/storage.objectViewer"
+  member = "allUsers"
+  depends_on = [google_project_service.required_services]
+}
+
 # Permissions for Cloud Run to access Cloud SQL and Run
 resource "google_project_iam_member" "service_roles" {
   for_each = toset([
@@ -372,6 +397,76 @@ resource "google_cloud_run_v2_job" "create_superuser" {
   ]
 }
 
+# Create the finish_transcriptions Cloud Run job, it finishes the
+# long-running recognitions nobody is polling from the job page
+resource "google_cloud_run_v2_job" "finish_transcriptions" {
+  name     = "finish-transcriptions"
+  location = var.region
+
+  template {
+    template {
+      service_account = google_service_account.django_sa.email
+
+      volumes {
+        name = "cloudsql"
+        cloud_sql_instance {
+          instances = [google_sql_database_instance.postgres_instance.connection_name]
+        }
+      }
+
+      containers {
+        image   = local.image
+        command = ["finish_transcriptions"]
+
+        env {
+          name = "APPLICATION_SETTINGS"
+          value_source {
+            secret_key_ref {
+              version = google_secret_manager_secret_version.application_settings.version
+              secret  = google_secret_manager_secret_version.application_settings.secret
+            }
+          }
+        }
+        volume_mounts {
+          name       = "cloudsql"
+          mount_path = "/cloudsql"
+        }
+      }
+    }
+  }
+  depends_on = [
+    terraform_data.cbstg_app,
+  ]
+}
+
+# Let the service account start the finish_transcriptions job from Cloud Scheduler
+resource "google_cloud_run_v2_job_iam_member" "finish_transcriptions_invoker" {
+  name     = google_cloud_run_v2_job.finish_transcriptions.name
+  location = google_cloud_run_v2_job.finish_transcriptions.location
+  role     = "roles/run.invoker"
+  member   = local.service_account
+}
+
+# Run finish_transcriptions every five minutes, within RECOGNITION_FINISH_LEASE
+resource "google_cloud_scheduler_job" "finish_transcriptions" {
+  name     = "finish-transcriptions"
+  region   = var.region
+  schedule = "*/5 * * * *"
+
+  http_target {
+    http_method = "POST"
+    uri         = "https://run.googleapis.com/v2/${google_cloud_run_v2_job.finish_transcriptions.id}:run"
+
+    oauth_token {
+      service_account_email = google_service_account.django_sa.email
+    }
+  }
+  depends_on = [
+    google_project_service.required_services,
+    google_cloud_run_v2_job_iam_member.finish_transcriptions_invoker,
+  ]
+}
+
 # Run the migrate_collectstatic the Cloud Run job
 resource "terraform_data" "execute_migrate_collectstatic" {
   provisioner "local-exec" {
@@ -405,6 +500,18 @@ resource "google_cloud_run_v2_service" "app" {
         name  = "SERVICE_NAME"
         value = var.service_name
       }
+      env {
+        name  = "PROJECT_ID"
+        value = var.project_id
+      }
+      env {
+        name  = "REGION"
+        value = var.region
+      }
+      env {
+        name  = "SERVICE_URI"
+        value = local.service_uri
+      }
       env {
         name = "APPLICATION_SETTINGS"
         value_source {